@@ -0,0 +1,388 @@
+# Benchmarks for the geometry helpers, the design view and the pipeline
+#
+# Suites:
+#   geometry   resize_polygon, point_in_polygon and validate_coil_positions
+#              at a range of vertex and coil counts
+#   rendering  the design view figure (build_design_figure) and the
+#              uncached isoflux boundary
+#   app        streamlit_app.py run through Streamlit's testing harness, a
+#              first run and a rerun with nothing changed
+#   pipeline   a cold mesh build and every pipeline stage of run_pipeline,
+#              taken from the run's stage timings after an untimed run has
+#              filled the mesh and wall-mode caches; with the stand-in it
+#              first checks that a run whose VDEs lose the O-point at once
+#              still completes
+#   startup    a fresh interpreter importing everything streamlit_app.py
+#              imports at module level, without OFT or the stand-in on the
+#              path (it fails if any of them loads OpenFUSIONToolkit), next
+#              to a bare interpreter; -X importtime's slowest top-level
+#              imports are printed and stored with the results
+#
+# Unless --oft is given, OpenFUSIONToolkit is replaced by the stand-in in
+# benchmarks/stand_in, so the suite runs without OFT. Its TokaMaker sleeps
+# --solver-cost seconds per solve (scaled per call, see its COSTS), so 0
+# measures only this package's own work. The stand-in's meshes and runs go
+# to a temporary TOKAMAK_CACHE_DIR, never the real caches.
+#
+# Results (median and best seconds per call for every benchmark) are written
+# as JSON and compared with a stored baseline. A benchmark regresses when
+# its median grows past its suite's threshold ratio and by more than
+# MIN_DELTA seconds; the exit status is 1 if any did.
+#
+#   python -m benchmarks.run
+#   python -m benchmarks.run --suite geometry rendering --quick
+#   python -m benchmarks.run --update-baseline
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import ast
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAND_IN_DIR = os.path.join(ROOT, "benchmarks", "stand_in")
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+DEFAULT_OUTPUT = os.path.join(ROOT, ".cache", "benchmarks", "results.json")
+DESIGN = os.path.join(ROOT, "examples", "negative_triangulation", "design_20250630_171055.json")
+
+SUITES = ("geometry", "rendering", "app", "pipeline", "startup")
+# Median ratio to the baseline above which a benchmark counts as a regression
+THRESHOLDS = {"geometry": 1.5, "rendering": 1.5, "app": 2.0, "pipeline": 1.5, "startup": 1.5}
+# Differences below this many seconds are noise whatever the ratio
+MIN_DELTA = 20E-6
+
+REPEAT = 7
+MIN_SAMPLE_SECONDS = 0.05
+PIPELINE_REPEAT = 3
+
+VERTEX_COUNTS = (16, 128, 1024, 8192)
+COIL_COUNTS = (4, 16, 64, 256)
+QUICK_VERTEX_COUNTS = (16, 1024)
+QUICK_COIL_COUNTS = (4, 64)
+
+
+def setup_environment(stand_in, cost):
+    """Select the solver and give the run its own cache directory before tokamak is imported
+
+    Returns the temporary directory holding the caches and pipeline outputs.
+    """
+    work_dir = tempfile.mkdtemp(prefix="tokamak_bench_")
+    os.environ["TOKAMAK_CACHE_DIR"] = work_dir
+    if stand_in:
+        sys.path.insert(0, STAND_IN_DIR)
+        os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [STAND_IN_DIR, ROOT, os.environ.get("PYTHONPATH")]))
+        from OpenFUSIONToolkit import STAND_IN_COST_ENV
+        os.environ[STAND_IN_COST_ENV] = str(cost)
+    else:
+        from tokamak import oft
+        oft.ensure_oft_path()
+    return work_dir
+
+
+def measure(fn, repeat=REPEAT, min_seconds=MIN_SAMPLE_SECONDS):
+    """Median and best seconds per call of fn(), calling it often enough per sample to last min_seconds"""
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_seconds or number >= 1_000_000:
+            break
+        number *= max(2, min(10, int(min_seconds/max(elapsed, 1E-9)) + 1))
+    samples = [timer.timeit(number)/number for _ in range(repeat)]
+    return {"median": float(np.median(samples)), "min": float(np.min(samples)), "number": number,
+            "repeat": repeat}
+
+
+def _ellipse(n, r0=4.5, a=2.0, kappa=1.6):
+    theta = np.linspace(0.0, 2.0*np.pi, n, endpoint=False)
+    return np.column_stack((r0 + a*np.cos(theta), a*kappa*np.sin(theta)))
+
+
+def _coils(n, seed=0):
+    """n coils, half of them inside the vessel so validation has work to do"""
+    rng = np.random.default_rng(seed)
+    angle = rng.uniform(0.0, 2.0*np.pi, n)
+    radius = np.where(np.arange(n) % 2 == 0, rng.uniform(2.5, 3.5, n), rng.uniform(0.3, 0.8, n))
+    return np.column_stack((4.5 + radius*np.cos(angle), 1.6*radius*np.sin(angle))).tolist()
+
+
+def geometry_benchmarks(quick=False):
+    from tokamak.geometry import point_in_polygon, resize_polygon, validate_coil_positions
+    from tokamak.rendering import isoflux_boundary
+
+    for n in QUICK_VERTEX_COUNTS if quick else VERTEX_COUNTS:
+        polygon = _ellipse(n).tolist()
+        yield f"geometry.resize_polygon[{n}]", lambda polygon=polygon: resize_polygon(polygon, 0.04)
+        yield f"geometry.point_in_polygon[{n}]", lambda polygon=polygon: point_in_polygon([4.6, 0.3], polygon)
+    vv = _ellipse(64).tolist()
+    plasma = isoflux_boundary(30, 4.5, 0.0, 1.2, 1.4, -0.5)
+    for n in QUICK_COIL_COUNTS if quick else COIL_COUNTS:
+        coils = _coils(n)
+        yield (f"geometry.validate_coil_positions[{n}]",
+               lambda coils=coils: validate_coil_positions(coils, vv, plasma))
+
+
+def rendering_benchmarks(quick=False):
+    from tokamak.geometry import find_invalid_coils
+    from tokamak.rendering import _isoflux_boundary, build_design_figure, isoflux_boundary
+
+    def uncached_isoflux():
+        _isoflux_boundary.cache_clear()
+        return isoflux_boundary(30, 4.5, 0.0, 1.2, 1.4, -0.5)
+
+    yield "rendering.isoflux_boundary", uncached_isoflux
+    plasma = isoflux_boundary(30, 4.5, 0.0, 1.2, 1.4, -0.5)
+    for n in QUICK_VERTEX_COUNTS[:1] if quick else (16, 128):
+        vv = _ellipse(n).tolist()
+        coils = _coils(8)
+        invalid = find_invalid_coils(coils, vv, plasma)
+        yield (f"rendering.build_design_figure[{n}]",
+               lambda vv=vv, coils=coils, invalid=invalid: build_design_figure(vv, plasma, coils, invalid))
+
+
+def app_benchmarks(quick=False):
+    from streamlit.testing.v1 import AppTest
+
+    app = os.path.join(ROOT, "streamlit_app.py")
+
+    def first_run():
+        at = AppTest.from_file(app, default_timeout=120)
+        at.run()
+        if at.exception:
+            raise RuntimeError(f"streamlit_app.py raised: {at.exception[0].message}")
+        return at
+
+    at = first_run()
+    yield "app.first_run", first_run
+    yield "app.rerun", lambda: at.run()
+
+
+def pipeline_benchmarks(quick=False):
+    """A cold mesh build, then each stage's wall time over PIPELINE_REPEAT warm-cache runs of run_pipeline"""
+    from tokamak import mesh_cache, pipeline
+
+    work_dir = os.environ["TOKAMAK_CACHE_DIR"]
+    run = pipeline.AnalysisRun(DESIGN, tempfile.mkdtemp(dir=work_dir))
+    pipeline.prepare_geometry(run)
+    res = run.resolution
+    yield "pipeline.build_mesh", lambda: mesh_cache.build_mesh(run.vv_boundary, run.vv_outer, run.coil_locs,
+                                                               res["plasma_dx"], res["coil_dx"], res["vv_dx"],
+                                                               res["vac_dx"])
+
+    # One untimed run fills the mesh and wall-mode caches, so every timed run (the single one in quick mode
+    # too) sees the same warm caches the baseline's median was taken from
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline.run_pipeline(DESIGN, tempfile.mkdtemp(dir=work_dir))
+    lost_opoint_check(work_dir)
+    timings = []
+    for _ in range(1 if quick else PIPELINE_REPEAT):
+        with contextlib.redirect_stdout(io.StringIO()):
+            done = pipeline.run_pipeline(DESIGN, tempfile.mkdtemp(dir=work_dir))
+        timings.append(dict(done.timings, total=done.elapsed))
+    for stage in pipeline.STAGES + ["total"]:
+        samples = [t[stage] for t in timings if stage in t]
+        if samples:
+            yield f"pipeline.{stage}", {"median": float(np.median(samples)), "min": float(np.min(samples)),
+                                        "number": 1, "repeat": len(samples)}
+
+
+def lost_opoint_check(work_dir):
+    """Fail unless a run whose VDEs lose the O-point on their first step still completes (stand-in only)
+
+    Every scan point then keeps only its t = 0 zhist row and no psi
+    snapshots; the nonlinear evolution figure and the summary must still be
+    written.
+    """
+    from OpenFUSIONToolkit.TokaMaker import TokaMaker
+    from tokamak import pipeline
+
+    if not hasattr(TokaMaker, "lose_opoint"):
+        return
+    TokaMaker.lose_opoint = True
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run = pipeline.run_pipeline(DESIGN, tempfile.mkdtemp(dir=work_dir), scan_workers=1)
+    finally:
+        TokaMaker.lose_opoint = False
+    missing = [name for name in ("07_nonlinear_plasma_evolution.png", pipeline.SUMMARY_FILENAME)
+               if not os.path.exists(os.path.join(run.output_dir, name))]
+    assert run.status == "completed" and not missing, \
+        f"run with the O-point lost ended {run.status!r}, missing {missing}"
+
+
+def designer_imports():
+    """streamlit_app.py's module-level import statements as one line of Python"""
+    with open(os.path.join(ROOT, "streamlit_app.py")) as f:
+        tree = ast.parse(f.read())
+    return "; ".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def _python(code, *flags):
+    """Run code in a fresh interpreter that sees this package but neither OFT nor the stand-in"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, env=env, check=True,
+                          capture_output=True, text=True)
+
+
+def import_profile(code=None, top=15):
+    """Slowest top-level imports of code under -X importtime: [(module, self s, cumulative s)]"""
+    code = designer_imports() if code is None else code
+    rows = []
+    for line in _python(code, "-X", "importtime").stderr.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        # Nested imports are indented under the module that triggered them
+        if name.startswith(" ") and not name.startswith("  "):
+            rows.append((name.strip(), int(parts[0])*1E-6, int(parts[1])*1E-6))
+    return sorted(rows, key=lambda row: row[2], reverse=True)[:top]
+
+
+def startup_benchmarks(quick=False):
+    check = "import sys; assert 'OpenFUSIONToolkit' not in sys.modules, 'the designer imported OpenFUSIONToolkit'"
+    code = f"{designer_imports()}; {check}"
+    _python(code)
+    yield "startup.interpreter", lambda: _python("pass")
+    yield "startup.designer_imports", lambda: _python(code)
+
+
+BENCHMARKS = {
+    "geometry": geometry_benchmarks,
+    "rendering": rendering_benchmarks,
+    "app": app_benchmarks,
+    "pipeline": pipeline_benchmarks,
+    "startup": startup_benchmarks,
+}
+
+
+def run_benchmarks(suites=SUITES, quick=False, log=print):
+    """{name: {"median", "min", "number", "repeat"}} for every benchmark in suites"""
+    results = {}
+    repeat = 3 if quick else REPEAT
+    for suite in suites:
+        for name, case in BENCHMARKS[suite](quick):
+            entry = case if isinstance(case, dict) else measure(case, repeat=repeat)
+            results[name] = entry
+            log(f"  {name:<45s} {entry['median']*1E3:12.4f} ms")
+    return results
+
+
+def machine_info():
+    return {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+            "numpy": np.__version__}
+
+
+def threshold(name, scale=1.0):
+    return THRESHOLDS[name.split(".", 1)[0]]*scale
+
+
+def compare(results, baseline, scale=1.0, min_delta=MIN_DELTA):
+    """Rows (name, baseline s, current s, ratio, status) with status ok, faster, regression or new"""
+    rows = []
+    base = baseline.get("benchmarks", {})
+    for name, entry in results["benchmarks"].items():
+        if name not in base:
+            rows.append((name, None, entry["median"], None, "new"))
+            continue
+        before, now = base[name]["median"], entry["median"]
+        ratio = now/before if before > 0 else float("inf")
+        limit = threshold(name, scale)
+        if ratio > limit and now - before > min_delta:
+            status = "regression"
+        elif ratio < 1.0/limit and before - now > min_delta:
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append((name, before, now, ratio, status))
+    return rows
+
+
+def format_comparison(rows):
+    lines = [f"  {'benchmark':<45s} {'baseline':>12s} {'current':>12s} {'ratio':>7s}  status"]
+    for name, before, now, ratio, status in rows:
+        before = f"{before*1E3:9.4f} ms" if before is not None else ""
+        ratio = f"{ratio:7.2f}" if ratio is not None else ""
+        lines.append(f"  {name:<45s} {before:>12s} {now*1E3:9.4f} ms {ratio:>7s}  {status}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the geometry helpers, design view and pipeline")
+    parser.add_argument("--suite", nargs="+", choices=SUITES, default=list(SUITES), help="Suites to run")
+    parser.add_argument("--quick", action="store_true", help="Fewer sizes and repeats")
+    parser.add_argument("--oft", action="store_true", help="Use the installed OpenFUSIONToolkit instead of the stand-in")
+    parser.add_argument("--solver-cost", type=float, default=0.0,
+                        help="Seconds the stand-in TokaMaker sleeps per solve")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT, help="Where to write the results JSON")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline results JSON to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results over the baseline")
+    parser.add_argument("--threshold-scale", type=float, default=1.0,
+                        help="Multiply every suite's regression threshold by this")
+    args = parser.parse_args(argv)
+
+    work_dir = setup_environment(not args.oft, args.solver_cost)
+    import matplotlib
+    matplotlib.use("Agg")
+
+    print("Running benchmarks:")
+    try:
+        benchmarks = run_benchmarks(args.suite, args.quick)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": machine_info(),
+        "solver": "oft" if args.oft else "stand-in",
+        "solver_cost": None if args.oft else args.solver_cost,
+        "quick": args.quick,
+        "benchmarks": benchmarks,
+    }
+    if "startup" in args.suite:
+        profile = import_profile()
+        results["import_profile"] = [{"module": name, "self": own, "cumulative": total}
+                                     for name, own, total in profile]
+        print("Slowest imports of streamlit_app.py:")
+        print(f"  {'module':<45s} {'self':>12s} {'cumulative':>12s}")
+        for name, own, total in profile:
+            print(f"  {name:<45s} {own*1E3:9.1f} ms {total*1E3:9.1f} ms")
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results: {args.output}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; write one with --update-baseline")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if (baseline.get("solver"), baseline.get("solver_cost")) != (results["solver"], results["solver_cost"]):
+        print(f"WARNING: baseline used solver {baseline.get('solver')} with cost {baseline.get('solver_cost')}, "
+              "pipeline timings are not comparable")
+    rows = compare(results, baseline, args.threshold_scale)
+    print(f"Compared with {args.baseline} ({baseline.get('created')}, {baseline.get('machine', {}).get('platform')}):")
+    print(format_comparison(rows))
+    regressions = [row[0] for row in rows if row[4] == "regression"]
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
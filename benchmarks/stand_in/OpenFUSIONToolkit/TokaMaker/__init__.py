@@ -0,0 +1,186 @@
+# Stand-in for OpenFUSIONToolkit.TokaMaker
+#
+# The equilibrium is psi = 1 - rho^2 on the mesh nodes, with rho the shaped
+# minor radius of the init_psi parameters (or the plasma region's extent),
+# so contours, O-point and psi_bounds look like a real solve. beta_pol
+# follows Ip_ratio, the vertical mode grows faster with elongation and beta,
+# and step_td moves the O-point along a saturating exponential. Each call
+# sleeps cost*COSTS[name] seconds, cost coming from the
+# TOKAMAKER_STAND_IN_COST environment variable. Setting TokaMaker.lose_opoint
+# makes step_td report no O-point, as when a VDE loses the plasma at once.
+
+import os
+import time
+
+import numpy as np
+
+from OpenFUSIONToolkit import STAND_IN_COST_ENV
+
+# Sleep per call relative to the configured cost
+COSTS = {"solve": 1.0, "eig_td": 2.0, "eig_wall": 2.0, "setup_td": 0.5, "step_td": 0.25}
+PLASMA_REGION = 1
+# Initial O-point displacement of a VDE, as a fraction of the minor radius
+VDE_KICK = 1E-3
+
+
+class _Settings:
+    pm = True
+    maxits = 40
+
+
+class TokaMaker:
+    lose_opoint = False
+
+    def __init__(self, oft_env):
+        self.oft_env = oft_env
+        self.settings = _Settings()
+        self.cost = float(os.environ.get(STAND_IN_COST_ENV, "0"))
+        self.reset()
+
+    def _work(self, name):
+        if self.cost > 0.0:
+            time.sleep(self.cost*COSTS[name])
+
+    def reset(self):
+        self.r = None
+        self.Ip = 8E6
+        self.Ip_ratio = 1.0
+        self.o_point = None
+
+    def setup_mesh(self, r, lc, reg):
+        self.r = np.asarray(r, dtype=np.float64)
+        self.lc = np.asarray(lc)
+        self.reg = np.asarray(reg)
+        plasma = np.unique(self.lc[self.reg == PLASMA_REGION])
+        (rmin, zmin), (rmax, zmax) = self.r[plasma].min(axis=0), self.r[plasma].max(axis=0)
+        a = 0.4*(rmax - rmin)
+        self.shape = [0.5*(rmin + rmax), 0.5*(zmin + zmax), a, 0.8*(zmax - zmin)/(2*a), 0.0]
+
+    def setup_regions(self, cond_dict=None, coil_dict=None):
+        self.coil_dict = coil_dict or {}
+        self.ncoils = len(self.coil_dict)
+        self.coil_sets = {name: {"id": i} for i, name in enumerate(self.coil_dict)}
+
+    def setup(self, order=2, F0=0.0, full_domain=False):
+        self.F0 = F0
+        self.psi = np.zeros(len(self.r))
+        self.psi_bounds = [0.0, 1.0]
+        self.o_point = np.array(self.shape[:2])
+
+    def update_settings(self):
+        pass
+
+    def set_targets(self, Ip=None, Ip_ratio=None, **kwargs):
+        if Ip is not None:
+            self.Ip = Ip
+        if Ip_ratio is not None:
+            self.Ip_ratio = Ip_ratio
+
+    def set_profiles(self, ffp_prof=None, pp_prof=None, **kwargs):
+        pass
+
+    def set_isoflux(self, isoflux, weights=None):
+        self.isoflux = np.asarray(isoflux)
+
+    def set_saddles(self, saddles, weights=None):
+        pass
+
+    def set_coil_reg(self, reg_mat, reg_targets=None, reg_weights=None):
+        pass
+
+    def _shaped_psi(self, dz=0.0):
+        r0, z0, a, kappa, delta = self.shape
+        dr = self.r[:, 0] - r0 + delta*a*((self.r[:, 1] - z0 - dz)/(kappa*a))**2
+        rho2 = (dr/a)**2 + ((self.r[:, 1] - z0 - dz)/(kappa*a))**2
+        return 1.0 - rho2
+
+    def init_psi(self, r0, z0, a, kappa, delta):
+        self.shape = [r0, z0, a, kappa, delta]
+        self.psi = self._shaped_psi()
+        self.o_point = np.array([r0, z0])
+
+    def solve(self, vacuum=False):
+        self._work("solve")
+        self.psi = self._shaped_psi()
+        self.psi_bounds = [0.0, 1.0]
+        self.o_point = np.array(self.shape[:2])
+        return 0
+
+    def get_psi(self, normalized=True):
+        if normalized:
+            return (self.psi_bounds[1] - self.psi)/(self.psi_bounds[1] - self.psi_bounds[0])
+        return self.psi.copy()
+
+    def set_psi(self, psi):
+        self.psi = np.array(psi, dtype=np.float64)
+
+    def get_stats(self):
+        r0, _, a, kappa, delta = self.shape
+        beta_pol = 130.0/(1.0 + self.Ip_ratio)
+        return {"Ip": self.Ip, "beta_pol": beta_pol, "beta_tor": 0.02*beta_pol, "beta_n": 0.03*beta_pol,
+                "q_95": 3.0 + 0.5*(kappa - 1.0), "l_i": 0.9, "kappa": kappa, "delta": delta, "R_geo": r0,
+                "a_geo": a, "vol": 2*np.pi**2*r0*a**2*kappa}
+
+    def get_coil_currents(self):
+        weights = np.linspace(1.0, 0.4, self.ncoils)
+        return {name: self.Ip*w/self.ncoils for name, w in zip(self.coil_dict, weights)}, None
+
+    def _growth(self):
+        kappa = self.shape[3]
+        return 200.0 + 600.0*max(kappa - 1.0, 0.0) + 2.0*self.get_stats()["beta_pol"]
+
+    def eig_td(self, omega=-1E4, neigs=4, include_bounds=True, pm=False):
+        self._work("eig_td")
+        vals = np.zeros((neigs, 2))
+        vals[:, 0] = -self._growth()*0.5**np.arange(neigs)
+        _, z0, a, kappa, _ = self.shape
+        # Vertical shift mode dpsi/dZ, with harmonics for the rest
+        zeta = (self.r[:, 1] - z0)/(kappa*a)
+        vecs = np.array([zeta*np.exp(-zeta**2)**(i + 1) for i in range(neigs)])
+        return vals, vecs
+
+    def eig_wall(self, neigs=4, pm=False):
+        self._work("eig_wall")
+        vals = np.zeros((neigs, 2))
+        vals[:, 0] = np.linspace(10.0, 100.0, neigs)
+        return vals, np.ones((neigs, len(self.r)))
+
+    def setup_td(self, dt, lin_tol, nl_tol, pre_plasma=False):
+        self._work("setup_td")
+        self.dt = dt
+        self.gamma = self._growth()
+        self.dz = VDE_KICK*self.shape[2]
+
+    def step_td(self, time, dt):
+        self._work("step_td")
+        # Logistic growth of the displacement, saturating at the plasma half-height
+        limit = self.shape[2]*self.shape[3]
+        growth = np.exp(self.gamma*dt)
+        self.dz = self.dz*growth/(1.0 + self.dz*(growth - 1.0)/limit)
+        self.psi = self._shaped_psi(self.dz)
+        self.o_point = None if self.lose_opoint else np.array([self.shape[0], self.shape[1] + self.dz])
+        nl_its = 2 + int(self.gamma*dt*4)
+        return time + dt, 0.0, nl_its, 5*nl_its, 0
+
+    def plot_machine(self, fig, ax, vacuum_color='whitesmoke', cond_color='gray', limiter_color='k', coil_color='gray'):
+        conductors = self.reg != PLASMA_REGION
+        if limiter_color is not None or cond_color is not None:
+            ax.tripcolor(self.r[:, 0], self.r[:, 1], self.lc[conductors], np.ones(conductors.sum()),
+                         cmap='Greys', vmin=0.0, vmax=4.0)
+        ax.set_aspect('equal')
+
+    def plot_psi(self, fig, ax, psi=None, normalized=True, plasma_color=None, plasma_nlevels=8, vacuum_color='darkgray',
+                 vacuum_nlevels=8, xpoint_color='k', opoint_color='k', **kwargs):
+        psi = self.get_psi(normalized) if psi is None else psi
+        colors = plasma_color if plasma_color is not None else None
+        ax.tricontour(self.r[:, 0], self.r[:, 1], self.lc, psi, max(plasma_nlevels, 1), colors=colors)
+        if opoint_color is not None and self.o_point is not None:
+            ax.plot(*self.o_point, '+', color=opoint_color)
+
+    def plot_constraints(self, fig, ax, isoflux_color='tab:red', **kwargs):
+        ax.plot(self.isoflux[:, 0], self.isoflux[:, 1], '+', color=isoflux_color)
+
+    def plot_eddy(self, fig, ax, psi=None, dpsi_dt=None, colormap='jet', symmap=False, clabel=None, **kwargs):
+        values = np.zeros(len(self.r)) if dpsi_dt is None else dpsi_dt
+        conductors = self.reg != PLASMA_REGION
+        ax.tripcolor(self.r[:, 0], self.r[:, 1], self.lc[conductors], values, shading='gouraud', cmap=colormap)
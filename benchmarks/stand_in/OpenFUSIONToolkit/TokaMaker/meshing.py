@@ -0,0 +1,123 @@
+# Stand-in for OpenFUSIONToolkit.TokaMaker.meshing
+#
+# gs_Domain triangulates the same regions as the real mesher (plasma inside
+# the vessel, the vessel annulus, rectangular coils, air around them) with
+# a Delaunay triangulation of per-region point grids, so mesh sizes follow
+# the requested resolutions.
+
+import json
+
+import h5py
+import numpy as np
+
+from tokamak.geometry import points_in_polygon
+
+# Air padding around the geometry (m)
+AIR_PADDING = 1.5
+
+
+def save_gs_mesh(pts, tris, regions, coil_dict, cond_dict, filename, use_hdf5=True):
+    with h5py.File(filename, 'w') as h5:
+        h5.create_dataset('mesh/r', data=pts, dtype='f8')
+        h5.create_dataset('mesh/lc', data=tris, dtype='i4')
+        h5.create_dataset('mesh/reg', data=regions, dtype='i4')
+        h5.create_dataset('mesh/coil_dict', data=json.dumps(coil_dict))
+        h5.create_dataset('mesh/cond_dict', data=json.dumps(cond_dict))
+
+
+def load_gs_mesh(filename, use_hdf5=True):
+    with h5py.File(filename, 'r') as h5:
+        return (np.asarray(h5['mesh/r']), np.asarray(h5['mesh/lc']), np.asarray(h5['mesh/reg']),
+                json.loads(h5['mesh/coil_dict'][()]), json.loads(h5['mesh/cond_dict'][()]))
+
+
+def _grid(rmin, rmax, zmin, zmax, dx):
+    r = np.arange(rmin, rmax + 0.5*dx, dx)
+    z = np.arange(zmin, zmax + 0.5*dx, dx)
+    return np.column_stack([g.ravel() for g in np.meshgrid(r, z)])
+
+
+def _along(polygon, dx):
+    """Points every dx along a closed polygon"""
+    start = np.asarray(polygon, dtype=np.float64)
+    end = np.roll(start, -1, axis=0)
+    points = []
+    for p0, p1 in zip(start, end):
+        n = max(int(np.ceil(np.linalg.norm(p1 - p0)/dx)), 1)
+        points.append(p0 + np.outer(np.arange(n)/n, p1 - p0))
+    return np.concatenate(points)
+
+
+class gs_Domain:
+    def __init__(self):
+        self.regions = {}
+        self.annulus = None
+        self.rectangles = []
+
+    def define_region(self, name, dx, reg_type, eta=None):
+        self.regions[name] = {"dx": dx, "type": reg_type, "eta": eta}
+
+    def add_annulus(self, inner, inner_name, outer, outer_name, parent_name=None):
+        self.annulus = (np.asarray(inner, dtype=np.float64), inner_name, np.asarray(outer, dtype=np.float64), outer_name)
+
+    def add_rectangle(self, rc, zc, w, h, name, parent_name=None):
+        self.rectangles.append((rc, zc, w, h, name))
+
+    def _region_ids(self):
+        inner_name, outer_name = self.annulus[1], self.annulus[3]
+        names = [inner_name, outer_name] + [rect[4] for rect in self.rectangles]
+        names += [name for name in self.regions if name not in names]
+        return {name: i + 1 for i, name in enumerate(names)}
+
+    def build_mesh(self):
+        inner, inner_name, outer, outer_name = self.annulus
+        air = next(name for name, region in self.regions.items() if region["type"] == "boundary")
+        corners = [outer] + [np.array([[rc - w/2, zc - h/2], [rc + w/2, zc + h/2]]) for rc, zc, w, h, _ in self.rectangles]
+        lo = np.min([c.min(axis=0) for c in corners], axis=0) - AIR_PADDING
+        hi = np.max([c.max(axis=0) for c in corners], axis=0) + AIR_PADDING
+        lo[0] = max(lo[0], 0.05)
+
+        rects = [np.array([[rc - w/2, zc - h/2], [rc + w/2, zc - h/2], [rc + w/2, zc + h/2], [rc - w/2, zc + h/2]])
+                 for rc, zc, w, h, _ in self.rectangles]
+        air_pts = _grid(lo[0], hi[0], lo[1], hi[1], self.regions[air]["dx"])
+        keep = ~points_in_polygon(air_pts, outer)
+        for rect in rects:
+            keep &= ~points_in_polygon(air_pts, rect)
+        (rmin, zmin), (rmax, zmax) = inner.min(axis=0), inner.max(axis=0)
+        plasma_pts = _grid(rmin, rmax, zmin, zmax, self.regions[inner_name]["dx"])
+        plasma_pts = plasma_pts[points_in_polygon(plasma_pts, inner)]
+        vv_dx = self.regions[outer_name]["dx"]
+        parts = [air_pts[keep], plasma_pts, _along(inner, vv_dx), _along(outer, vv_dx)]
+        for (rc, zc, w, h, name), rect in zip(self.rectangles, rects):
+            dx = min(self.regions[name]["dx"], w/2)
+            parts += [_grid(rc - w/2, rc + w/2, zc - h/2, zc + h/2, dx), _along(rect, dx)]
+        pts = np.unique(np.round(np.concatenate(parts), 9), axis=0)
+
+        from scipy.spatial import Delaunay
+        tris = Delaunay(pts).simplices
+        centroids = pts[tris].mean(axis=1)
+        ids = self._region_ids()
+        regions = np.full(len(tris), ids[air], dtype=np.int32)
+        regions[points_in_polygon(centroids, outer)] = ids[outer_name]
+        regions[points_in_polygon(centroids, inner)] = ids[inner_name]
+        for (_, _, _, _, name), rect in zip(self.rectangles, rects):
+            regions[points_in_polygon(centroids, rect)] = ids[name]
+        return pts, tris.astype(np.int32), regions
+
+    def get_coils(self):
+        ids = self._region_ids()
+        return {name: {"reg_id": ids[name], "coil_id": i, "nturns": 1}
+                for i, (_, _, _, _, name) in enumerate(self.rectangles)}
+
+    def get_conductors(self):
+        ids = self._region_ids()
+        return {name: {"reg_id": ids[name], "eta": region["eta"]}
+                for name, region in self.regions.items() if region["type"] == "conductor"}
+
+    def plot_topology(self, fig, ax):
+        inner, _, outer, _ = self.annulus
+        for polygon in (inner, outer):
+            ax.plot(*np.vstack((polygon, polygon[:1])).T, 'k')
+
+    def plot_mesh(self, fig, ax):
+        self.plot_topology(fig, ax)
@@ -0,0 +1,20 @@
+# Stand-in for OpenFUSIONToolkit.TokaMaker.util
+
+import numpy as np
+
+
+def create_isoflux(npts, r0, z0, a, kappa, delta, kappaL=None, deltaL=None):
+    """Boundary points of a shaped plasma, as OFT's create_isoflux"""
+    kappaU, deltaU = kappa, delta
+    kappaL = kappaU if kappaL is None else kappaL
+    deltaL = deltaU if deltaL is None else deltaL
+    theta = np.arange(npts)*2.0*np.pi/npts
+    delta = ((deltaU + deltaL) + (deltaU - deltaL)*np.sin(theta))/2
+    kappa = ((kappaU + kappaL) + (kappaU - kappaL)*np.sin(theta))/2
+    return np.column_stack((r0 + a*np.cos(theta + np.arcsin(delta)*np.sin(theta)), z0 + a*kappa*np.sin(theta)))
+
+
+def create_power_flux_fun(npts, alpha, gamma):
+    """Linearly interpolated profile (1 - psi^alpha)^gamma"""
+    x = np.linspace(0.0, 1.0, npts)
+    return {'type': 'linterp', 'x': x, 'y': (1.0 - x**alpha)**gamma}
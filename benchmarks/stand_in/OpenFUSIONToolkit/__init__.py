@@ -0,0 +1,13 @@
+# Stand-in for OpenFUSIONToolkit used by the benchmarks
+#
+# Only the parts of the API that tokamak/ calls are provided. The TokaMaker
+# in OpenFUSIONToolkit.TokaMaker returns synthetic equilibria, eigenmodes
+# and VDE steps, and sleeps STAND_IN_COST_ENV seconds (scaled per call, see
+# TokaMaker.COSTS) to stand in for the solver's own time.
+
+STAND_IN_COST_ENV = "TOKAMAKER_STAND_IN_COST"
+
+
+class OFT_env:
+    def __init__(self, nthreads=2):
+        self.nthreads = nthreads
@@ -1,24 +1,22 @@
 # 12.2
 
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import numpy as np
-import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
 import sys
 import os
-import json
 from datetime import datetime
-import glob
 import random
 import base64
 import shutil 
-import subprocess
+import time
+import uuid
 
 st.set_page_config(
     page_title="Custom Tokamak - Vacuum Vessel Design",
     layout="wide"
 )
+rerun_start = time.perf_counter()
 
 # Accessing OpenFUSIONToolkit 
 home_dir = os.path.expanduser("~")
@@ -28,79 +26,48 @@ tokamaker_python_path = os.getenv("OFT_ROOTPATH")
 if tokamaker_python_path is not None:
     sys.path.append(os.path.join(tokamaker_python_path, "python"))
 
-from OpenFUSIONToolkit.TokaMaker.util import create_isoflux
-
-# Local implementation of resize_polygon function (copied from AOE_tokamaker)
-def resize_polygon(points, dx):
-    new_points = np.empty(np.shape(points))
-    for i in range(np.shape(points)[0]):
-        if i==0:
-            last = points[-1,:]
-            next = points[i+1,:]
-        elif i == np.shape(points)[0]-1:
-            last = points[-2,:]
-            next = points[0,:]
-        else:
-            last = points[i-1,:]
-            next = points[i+1,:]
-        vec = next - last
-        vec_norm = np.linalg.norm(vec)
-        vec_unit = vec / vec_norm
-        vec_dx = vec_unit * dx
-        new_points[i,:] = last + vec_dx
-    return new_points
-
-# Function to check if point is inside polygon using ray casting
-def point_in_polygon(point, polygon):
-    x, y = point
-    n = len(polygon)
-    inside = False
-    p1x, p1y = polygon[0]
-    for i in range(1, n + 1):
-        p2x, p2y = polygon[i % n]
-        if y > min(p1y, p2y):
-            if y <= max(p1y, p2y):
-                if x <= max(p1x, p2x):
-                    if p1y != p2y:
-                        xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                    if p1x == p2x or x <= xinters:
-                        inside = not inside
-        p1x, p1y = p2x, p2y
-    return inside
-
-# Function to validate coil positions
-def validate_coil_positions(coil_coords, vv_coords, plasma_boundary, safety_margin=0.5):
-    validated_coords = []
-    vv_array = np.array(vv_coords)
-    
-    for coil in coil_coords:
-        r, z = coil
-        
-        # Check if coil is inside vacuum vessel
-        if point_in_polygon([r, z], vv_coords):
-            # Move coil outside vacuum vessel
-            # Find the closest point on VV boundary and move outward
-            distances = np.sqrt((vv_array[:, 0] - r)**2 + (vv_array[:, 1] - z)**2)
-            closest_idx = np.argmin(distances)
-            closest_vv_point = vv_array[closest_idx]
-            
-            # Vector from closest VV point to coil
-            direction = np.array([r - closest_vv_point[0], z - closest_vv_point[1]])
-            if np.linalg.norm(direction) > 0:
-                direction = direction / np.linalg.norm(direction)
-            else:
-                direction = np.array([1, 0])  # Default direction
-            
-            # Move coil outside VV with safety margin
-            new_r = closest_vv_point[0] + direction[0] * safety_margin
-            new_z = closest_vv_point[1] + direction[1] * safety_margin
-            validated_coords.append([new_r, new_z])
-        else:
-            validated_coords.append([r, z])
-    
-    return validated_coords
+from tokamak.geometry import find_invalid_coils
+from tokamak.greens import VacuumField
+from tokamak.pipeline import SUMMARY_FILENAME
+from tokamak.rendering import LatencyTracker, build_design_figure, isoflux_boundary, latency_caption
+from tokamak import coil_optimizer, results_view, surrogate
+from tokamak.preview import POLL_SECONDS as PREVIEW_POLL_SECONDS, LivePreview
+from tokamak.run_index import RunIndex, run_key
+from tokamak.scheduler import DEFAULT_RUNS_DIR, JobScheduler, QueueFull, new_run, new_run_id, prune_runs
+
+# Each Lock Design gets its own run folder here; Run Analysis reads the design and writes outputs there
+RUNS_DIR = DEFAULT_RUNS_DIR
+
+@st.cache_resource
+def shared_run_index():
+    """One RunIndex per server process, so reruns skip creating its table"""
+    return RunIndex()
+
+@st.cache_resource
+def shared_scheduler():
+    """One analysis queue per server process, shared fairly between sessions; old run folders are pruned on start"""
+    prune_runs(RUNS_DIR)
+    return JobScheduler()
+
+@st.cache_resource
+def shared_vacuum_field():
+    """Per-coil unit fields on the editor grid, shared by every session"""
+    return VacuumField()
+
+def current_design(major_radius, minor_radius, elongation, triangularity, advanced_settings):
+    """Design dict for the sliders and the VV/coil points as they are now"""
+    return {
+        "plasma_parameters": {"major_radius": major_radius, "minor_radius": minor_radius,
+                              "elongation": elongation, "triangularity": triangularity},
+        "advanced_settings": advanced_settings,
+        "vacuum_vessel": {"boundary_coordinates": st.session_state.vv_coords},
+        "coil_coordinates": st.session_state.coil_coords,
+    }
 
 def clear_results():
+    if 'analysis_job' in st.session_state:
+        shared_scheduler().cancel(st.session_state.analysis_job, terminate=True)
+        del st.session_state.analysis_job
     if 'analysis_completed' in st.session_state:
         del st.session_state.analysis_completed
     if 'output_folder' in st.session_state:
@@ -109,14 +76,14 @@ def clear_results():
         del st.session_state.locked_design
     if 'design_file' in st.session_state:
         del st.session_state.design_file
-
-    # Clear files
-    files = glob.glob('examples/testing_1/*')
-    for f in files:
-        if os.path.isfile(f):
-            os.remove(f)
-        elif os.path.isdir(f):
-            shutil.rmtree(f)
+    if 'stored_run' in st.session_state:
+        del st.session_state.stored_run
+
+    # Only this session's run folder is removed, other sessions keep theirs
+    run_dir = st.session_state.pop('run_dir', None)
+    st.session_state.pop('run_id', None)
+    if run_dir is not None and os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
     
     # Force a complete page reload by clearing more session state
     st.cache_data.clear()
@@ -141,6 +108,13 @@ if 'editing_point' not in st.session_state:
 if 'original_coords' not in st.session_state:
     st.session_state.original_coords = None
 
+if 'latency' not in st.session_state:
+    st.session_state.latency = LatencyTracker()
+
+# Identifies this browser session to the shared analysis queue
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 st.title("Custom Tokamak - Vacuum Vessel Design")
 col1, col2 = st.columns([1, 4])
 
@@ -237,123 +211,102 @@ with col1:
         pp_alpha = 2.15
         pp_gamma = 1.7
 
-with col2:
-    st.header("Vacuum Vessel Design")
-    
-    # Generate plasma boundary
-    boundary_pts = create_isoflux(30, major_radius, 0.0, minor_radius, elongation, triangularity)
-    
-    # Create vacuum vessel arrays
-    vv_boundary = np.array(st.session_state.vv_coords)
-    vv_outer = resize_polygon(vv_boundary, 0.04)    
-    
-    # Create Plotly figure
-    fig = go.Figure()
-    
-    # Add vacuum vessel outer boundary (filled)
-    fig.add_trace(go.Scatter(
-        x=np.append(vv_outer[:, 0], vv_outer[0, 0]),  # Close the polygon
-        y=np.append(vv_outer[:, 1], vv_outer[0, 1]),
-        fill='toself',
-        fillcolor='rgba(25,31,52,1.0)',
-        line=dict(color='black', width=2),
-        mode='lines',
-        name='VV Outer',
-        hoverinfo='skip'
-    ))
-    
-    # Add vacuum vessel inner boundary (filled white)
-    fig.add_trace(go.Scatter(
-        x=np.append(vv_boundary[:, 0], vv_boundary[0, 0]),  # Close the polygon
-        y=np.append(vv_boundary[:, 1], vv_boundary[0, 1]),
-        fill='toself',
-        fillcolor='white',
-        line=dict(color='black', width=2),
-        mode='lines',
-        name='VV Inner',
-        hoverinfo='skip'
-    ))
-    
-    # Add plasma boundary (filled blue)
-    fig.add_trace(go.Scatter(
-        x=np.append(boundary_pts[:, 0], boundary_pts[0, 0]),  # Close the polygon
-        y=np.append(boundary_pts[:, 1], boundary_pts[0, 1]),
-        fill='toself',
-        fillcolor='rgba(0,100,255,0.3)',
-        line=dict(color='blue', width=2),
-        mode='lines',
-        name='Plasma',
-        hoverinfo='skip'
-    ))
-    
-    # clickable vacuum vessel points
-    fig.add_trace(go.Scatter(
-        x=[coord[0] for coord in st.session_state.vv_coords],
-        y=[coord[1] for coord in st.session_state.vv_coords],
-        mode='markers',
-        marker=dict(
-            size=15,
-            color='orange',
-            symbol='circle',
-            line=dict(width=3, color='black')
-        ),
-        name='VV Points',
-        customdata=['vv'] * len(st.session_state.vv_coords),
-        hovertemplate='VV Point %{pointIndex}<br>R: %{x:.2f}<br>Z: %{y:.2f}<br>Click to edit<extra></extra>'
-    ))
-    
-    # clickable coil points
-    if len(st.session_state.coil_coords) > 0:
-        coil_colors = []
-        coil_names = []
-        
-        for i, (r, z) in enumerate(st.session_state.coil_coords):
-            # Check if coil is properly positioned
-            is_inside_vv = point_in_polygon([r, z], st.session_state.vv_coords)
-            is_inside_plasma = point_in_polygon([r, z], boundary_pts.tolist())
-            
-            if is_inside_vv or is_inside_plasma:
-                coil_colors.append('red')
-                coil_names.append(f'Coil {i+1} (INVALID)')
-            else:
-                coil_colors.append('darkred')
-                coil_names.append(f'Coil {i+1}')
-        
-        fig.add_trace(go.Scatter(
-            x=[coord[0] for coord in st.session_state.coil_coords],
-            y=[coord[1] for coord in st.session_state.coil_coords],
-            mode='markers',
-            marker=dict(
-                size=18,
-                color=coil_colors,
-                symbol='circle',
-                line=dict(width=3, color='black')
-            ),
-            name='Coils',
-            customdata=['coil'] * len(st.session_state.coil_coords),
-            hovertemplate='%{text}<br>R: %{x:.2f}<br>Z: %{y:.2f}<br>Click to edit<extra></extra>',
-            text=coil_names
-        ))
-    
-    # Configure layout
-    fig.update_layout(
-        width=800,
-        height=750,
-        xaxis_title="R (m)",
-        yaxis_title="Z (m)",
-        xaxis=dict(scaleanchor="y", scaleratio=1),
-        yaxis=dict(scaleanchor="x", scaleratio=1),
-        showlegend=True,
-        dragmode='pan',
-        hovermode='closest',
-        clickmode='event+select'
-    )
+    advanced_settings = {"B0": B0, "Ip_target": Ip_target, "Ip_ratio_target": Ip_ratio_target,
+                         "ffp_alpha": ffp_alpha, "ffp_gamma": ffp_gamma, "pp_alpha": pp_alpha, "pp_gamma": pp_gamma}
+
+    # Surrogate predictions; get_surrogate refits the models when new runs land in the index
+    st.subheader("Predicted Performance")
+    with st.session_state.latency.time("surrogate"):
+        model = surrogate.get_surrogate(shared_run_index())
+        predictions = None
+        if model is not None:
+            predictions = model.predict(current_design(major_radius, minor_radius, elongation, triangularity,
+                                                       advanced_settings))
+    if predictions is None:
+        st.info("Predictions appear once a few designs have been analysed.")
+    else:
+        if "growth_rate" in predictions:
+            mean, std = predictions["growth_rate"]
+            st.caption(f"Growth rate γ ≈ {mean:.3g} ± {std:.2g} 1/s")
+        if "feedback_capability_param" in predictions:
+            mean, std = predictions["feedback_capability_param"]
+            st.caption(f"Feedback capability ≈ {mean:.3g} ± {std:.2g}")
+        if "q_95" in predictions:
+            mean, std = predictions["q_95"]
+            st.caption(f"q95 ≈ {mean:.3g} ± {std:.2g}")
+        if "max_coil_current" in predictions:
+            mean, std = predictions["max_coil_current"]
+            st.caption(f"Max coil current ≈ {mean/1E6:.3g} ± {std/1E6:.2g} MA")
+            # Same limit as the coil currents figure: twice the plasma current
+            if mean > 2*Ip_target:
+                st.warning(f"Coil currents likely exceed the {2*Ip_target/1E6:.3g} MA limit")
+        st.caption(f"Surrogate of {model.nsamples} analysed designs")
+    st.caption(latency_caption(st.session_state.latency, "surrogate", "Prediction"))
+
+def rerun_fragment():
+    """Rerun only the calling fragment, or the whole app when called from a full run"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def preview_caption(preview):
+    """One-line status of the live equilibrium preview"""
+    result = preview.result
+    if result is None or not preview.current:
+        if preview.sent != preview.generation:
+            return "🔭 Preview: waiting for edits to settle"
+        return "🔭 Preview: solving..."
+    if "error" in result:
+        return f"🔭 Preview failed: {result['error']}"
+    if result["err_flag"] != 0:
+        return (f"🔭 Preview: equilibrium did not converge (err_flag={result['err_flag']}) "
+                f"on plasma_dx={result['resolution']['plasma_dx']}")
+    refining = "" if preview.finished else ", refining..."
+    first = "" if preview.first_latency is None else f", first preview {preview.first_latency:.1f} s after the last edit"
+    return (f"🔭 Preview: level {result['level'] + 1}/{result['levels']} (plasma_dx={result['resolution']['plasma_dx']}, "
+            f"{result['nodes']} nodes) solved in {result['elapsed']:.1f} s{first}{refining}")
+
+def _design_view(major_radius, minor_radius, elongation, triangularity, advanced_settings):
+    """Plot and VV/coil point editor, rerun on their own when a point is clicked or edited"""
+    preview = st.session_state.preview if st.session_state.get("live_preview") else None
+    with st.session_state.latency.time("design_view"):
+        # Generate plasma boundary (memoized on the slider values)
+        boundary_pts = isoflux_boundary(30, major_radius, 0.0, minor_radius, elongation, triangularity)
+
+        if preview is not None:
+            preview.update(current_design(major_radius, minor_radius, elongation, triangularity, advanced_settings))
+            preview.poll()
+
+        vacuum = None
+        if st.session_state.get("vacuum_field") and st.session_state.coil_coords:
+            with st.session_state.latency.time("vacuum_field"):
+                # Coil currents that best hold the target shape, as in the coil optimizer's response model
+                coils = np.asarray(st.session_state.coil_coords, dtype=np.float64)
+                model = coil_optimizer.ResponseModel(boundary_pts, advanced_settings["Ip_target"])
+                coil_currents = model.solve(coils[None])[0][0]
+                field = shared_vacuum_field()
+                psi, br, bz = field.field(coils, coil_currents)
+                vacuum = (field.r, field.z, psi, field.nulls(br, bz, coils))
+
+        # Vessel traces are cached on the VV coordinates, so plasma sliders only rebuild the plasma trace
+        invalid_coils = find_invalid_coils(st.session_state.coil_coords, st.session_state.vv_coords, boundary_pts)
+        fig = build_design_figure(st.session_state.vv_coords, boundary_pts, st.session_state.coil_coords, invalid_coils,
+                                  preview=preview.result if preview is not None else None,
+                                  preview_current=preview is not None and preview.current, vacuum=vacuum)
     
     # Display the plot and capture click events
     event = st.plotly_chart(fig, use_container_width=True, key="main_plot", on_select="rerun")
     
     # Add helpful legend instruction
     st.caption("💡 **Tip:** Click on any legend item (VV Outer, VV Inner, Plasma, VV Points, Coils) to show/hide that component")
+    st.caption(latency_caption(st.session_state.latency, "design_view", "Design view"))
+    if preview is not None:
+        st.caption(preview_caption(preview))
+    if vacuum is not None:
+        st.caption(f"🧲 Coil field for the target shape: peak coil current {np.abs(coil_currents).max()/1E6:.2f} MA, "
+                   f"{len(vacuum[3])} field nulls")
+        st.caption(latency_caption(st.session_state.latency, "vacuum_field", "Coil field"))
     
     # Handle clicking on dots
     if event and 'selection' in event:
@@ -425,7 +378,7 @@ with col2:
                     st.session_state.vv_coords[idx] = [new_r, new_z]
                     st.session_state.editing_point = None
                     st.session_state.original_coords = None
-                    st.rerun()
+                    rerun_fragment()
             with col_cancel:
                 if st.button("✗ Cancel", key=f"cancel_vv_{idx}"):
                     # Restore original coordinates
@@ -433,7 +386,7 @@ with col2:
                         st.session_state.vv_coords[idx] = st.session_state.original_coords.copy()
                     st.session_state.editing_point = None
                     st.session_state.original_coords = None
-                    st.rerun()
+                    rerun_fragment()
         
         elif point_type == 'coil':
             st.write(f"**Editing Coil {idx + 1}**")
@@ -468,10 +421,9 @@ with col2:
                 )
             
             # Show validation status for preview (using slider values)
-            is_inside_vv = point_in_polygon([new_r, new_z], st.session_state.vv_coords)
-            is_inside_plasma = point_in_polygon([new_r, new_z], boundary_pts.tolist())
+            is_invalid = find_invalid_coils([[new_r, new_z]], st.session_state.vv_coords, boundary_pts)[0]
             
-            if is_inside_vv or is_inside_plasma:
+            if is_invalid:
                 st.warning("⚠️ **Preview**: Coil would be inside vacuum vessel or plasma!")
             else:
                 st.success("✅ **Preview**: Coil would be properly positioned outside.")
@@ -484,7 +436,7 @@ with col2:
                     st.session_state.coil_coords[idx] = [new_r, new_z]
                     st.session_state.editing_point = None
                     st.session_state.original_coords = None
-                    st.rerun()
+                    rerun_fragment()
             with col_cancel:
                 if st.button("✗ Cancel", key=f"cancel_coil_{idx}"):
                     # Restore original coordinates
@@ -492,7 +444,30 @@ with col2:
                         st.session_state.coil_coords[idx] = st.session_state.original_coords.copy()
                     st.session_state.editing_point = None
                     st.session_state.original_coords = None
-                    st.rerun()
+                    rerun_fragment()
+
+# The live preview variant reruns on a timer to pick up solves finished in the background
+design_view = st.fragment(_design_view)
+design_view_live = st.fragment(run_every=PREVIEW_POLL_SECONDS)(_design_view)
+
+with col2:
+    st.header("Vacuum Vessel Design")
+    col_preview, col_field = st.columns(2)
+    with col_field:
+        st.toggle("Coil vacuum field", key="vacuum_field",
+                  help="Overlay the coils' flux contours and field nulls from analytic Green's functions")
+    with col_preview:
+        live = st.toggle("Live equilibrium preview", key="live_preview",
+                         help="Solve the design on coarse meshes in the background and overlay the LCFS and flux surfaces")
+    if live:
+        if 'preview' not in st.session_state:
+            st.session_state.preview = LivePreview()
+        design_view_live(major_radius, minor_radius, elongation, triangularity, advanced_settings)
+    else:
+        if 'preview' in st.session_state:
+            st.session_state.preview.stop()
+            del st.session_state.preview
+        design_view(major_radius, minor_radius, elongation, triangularity, advanced_settings)
     
 
 # Add reset button at the bottom
@@ -530,7 +505,109 @@ with col_reset3:
         ]
         st.session_state.editing_point = None
         st.rerun()
-    
+
+@st.fragment(run_every=1.0)
+def coil_confirmation_progress():
+    """Poll the queued TokaMaker confirmations of the coil candidates, one job per candidate"""
+    jobs = st.session_state.coil_confirmation_jobs
+    for job in jobs:
+        job.poll()
+    if all(job.finished for job in jobs):
+        st.rerun()
+    done = sum(job.finished for job in jobs)
+    running = sum(job.status in ("running", "cancelling") for job in jobs)
+    queued = [shared_scheduler().position(job) for job in jobs if job.status == "queued"]
+    text = f"TokaMaker confirmation: {done} of {len(jobs)} candidates solved, {running} solving"
+    if queued:
+        text += f", {len(queued)} queued from position {min(position or 1 for position in queued)}"
+    st.caption(f"⏳ {text} ({max(job.elapsed for job in jobs):.0f} s)")
+    if st.button("✖ Cancel Confirmation", key="cancel_coil_confirmation"):
+        for job in jobs:
+            if not job.finished:
+                shared_scheduler().cancel(job)
+        st.rerun()
+
+def cancel_coil_confirmation():
+    """Cancel the pending confirmation jobs and remove their folder"""
+    jobs = st.session_state.pop('coil_confirmation_jobs', None)
+    if jobs:
+        for job in jobs:
+            if not job.finished:
+                shared_scheduler().cancel(job, terminate=True)
+        shutil.rmtree(os.path.dirname(jobs[0].output_dir), ignore_errors=True)
+
+def confirmation_result(job):
+    """One candidate's TokaMaker result from its finished job, err_flag -1 if it did not complete"""
+    confirmations = coil_optimizer.load_confirmation(job.output_dir)
+    if job.status == "completed" and confirmations:
+        return confirmations[0]
+    error = job.latest("failed")
+    return {"err_flag": -1, "error": error["message"] if error else f"Confirmation {job.status}"}
+
+# Finished confirmations update the search result they were queued for
+jobs = st.session_state.get('coil_confirmation_jobs')
+if jobs and all(job.finished for job in jobs):
+    optimization = st.session_state.get('coil_optimization')
+    if optimization is not None and any(job.status == "cancelled" for job in jobs):
+        optimization["confirmation_error"] = "Confirmation cancelled"
+    elif optimization is not None:
+        coil_optimizer.apply_confirmation(optimization, [confirmation_result(job) for job in jobs])
+    cancel_coil_confirmation()
+
+# Coil placement search: linear-response scoring here, then TokaMaker solves of the best candidates, queued
+# in the shared scheduler like an analysis
+with st.expander("🧲 Optimize Coil Placement"):
+    st.caption("Searches coil positions outside the vessel for low peak coil current and isoflux error, "
+               "then confirms the best candidates with full equilibrium solves.")
+    confirm_count = st.number_input("Candidates confirmed with TokaMaker", min_value=0, max_value=8,
+                                    value=coil_optimizer.CONFIRM_CANDIDATES)
+    if st.button("🧲 Optimize Coils"):
+        cancel_coil_confirmation()
+        with st.spinner("Searching coil positions..."):
+            try:
+                design = current_design(major_radius, minor_radius, elongation, triangularity, advanced_settings)
+                st.session_state.coil_optimization = coil_optimizer.search_coils(
+                    design, confirm_count, progress=lambda message: None)
+                if confirm_count > 0:
+                    # One job per candidate, so free workers solve them in parallel
+                    folder = os.path.join(RUNS_DIR, f"coils_{new_run_id()}")
+                    runs = [(os.path.join(folder, f"candidate_{i}"),
+                             {"task": "coil_confirmation", "task_args": {"candidates": [entry["coil_coordinates"]]}})
+                            for i, entry in enumerate(st.session_state.coil_optimization["candidates"])]
+                    st.session_state.coil_confirmation_jobs = shared_scheduler().submit_group(
+                        design, st.session_state.session_id, runs)
+            except QueueFull as e:
+                st.warning(f"⏳ The analysis queue is full, so the candidates are not confirmed with TokaMaker: {e}")
+            except Exception as e:
+                st.error(f"Coil optimization failed: {e}")
+
+    if 'coil_optimization' in st.session_state:
+        optimization = st.session_state.coil_optimization
+        initial, best = optimization["initial"], optimization["best"]
+        st.write(f"Peak current {initial['peak_current_ratio']:.2f} → {best['peak_current_ratio']:.2f} of the 2·Ip limit, "
+                 f"isoflux error {initial['isoflux_error']:.1e} → {best['isoflux_error']:.1e} (linear model, "
+                 f"{optimization['search_time']:.1f} s)")
+        solved = best.get("confirmed")
+        if 'coil_confirmation_jobs' in st.session_state:
+            coil_confirmation_progress()
+        elif optimization.get("confirmation_error"):
+            st.warning(f"TokaMaker confirmation did not finish ({optimization['confirmation_error']}); "
+                       "showing the best linear-model result")
+        elif solved is not None and solved["err_flag"] == 0:
+            st.write(f"TokaMaker: peak coil current {solved['peak_current']/1E6:.2f} MA "
+                     f"(limit {solved['current_limit']/1E6:.2f} MA), κ={solved['kappa']:.2f}, δ={solved['delta']:.2f}")
+        elif solved is not None:
+            st.warning("None of the confirmed candidates converged in TokaMaker; showing the best linear-model result")
+        st.dataframe({"Coil": [f"PF_{i}" for i in range(1, len(optimization["coil_coordinates"]) + 1)],
+                      "R (m)": [r for r, _ in optimization["coil_coordinates"]],
+                      "Z (m)": [z for _, z in optimization["coil_coordinates"]]}, hide_index=True)
+        if st.button("✓ Apply Optimized Coils"):
+            cancel_coil_confirmation()
+            st.session_state.coil_coords = [list(point) for point in optimization["coil_coordinates"]]
+            st.session_state.editing_point = None
+            del st.session_state.coil_optimization
+            st.rerun()
+
 # Add reset button at the bottom
 st.markdown("---")
 
@@ -571,32 +648,31 @@ with col_lock:
         }
         
         # Validate coil positions
-        boundary_pts = create_isoflux(30, major_radius, 0.0, minor_radius, elongation, triangularity)
-        for i, (r, z) in enumerate(st.session_state.coil_coords):
-            is_inside_vv = point_in_polygon([r, z], st.session_state.vv_coords)
-            is_inside_plasma = point_in_polygon([r, z], boundary_pts.tolist())
-            
-            if is_inside_vv or is_inside_plasma:
+        boundary_pts = isoflux_boundary(30, major_radius, 0.0, minor_radius, elongation, triangularity)
+        invalid_coils = find_invalid_coils(st.session_state.coil_coords, st.session_state.vv_coords, boundary_pts)
+        for i, is_invalid in enumerate(invalid_coils):
+            if is_invalid:
                 design_data["validation"]["invalid_coils"].append(i)
             else:
                 design_data["validation"]["valid_coils"].append(i)
         
-        # Save to JSON file
-        examples_dir = "examples"
-        testing_dir = os.path.join(examples_dir, "testing_1")
-
-        # Create directories if they don't exist
-        os.makedirs(testing_dir, exist_ok=True)
-
-        design_file = f"design_{design_data['timestamp']}.json"
-        design_file_path = os.path.join(testing_dir, design_file)
-    
-        with open(design_file_path, 'w') as f:
-            json.dump(design_data, f, indent=2)
+        # Save to JSON file in a new run folder of its own
+        run_id, run_dir, design_file_path = new_run(design_data, RUNS_DIR)
         
         # Store in session state for status display
         st.session_state.locked_design = design_data
         st.session_state.design_file = design_file_path
+        st.session_state.run_id = run_id
+        st.session_state.run_dir = run_dir
+        
+        # An identical design analysed before is served from the run index instead of being solved again
+        run_index = shared_run_index()
+        stored_run = run_index.lookup(design_data)
+        if stored_run is not None:
+            run_index.restore(stored_run["key"], run_dir)
+            st.session_state.stored_run = stored_run
+            st.session_state.analysis_completed = True
+            st.session_state.output_folder = run_dir
         
         st.success(f"✅ Design locked and saved to: {design_file_path}")
         st.rerun()
@@ -604,50 +680,28 @@ with col_lock:
 
 with col_run:
     if 'locked_design' in st.session_state:
-        if st.button("🚀 Run Analysis", type="secondary", help="Execute AOE_tokamaker with current design"):
-            with st.spinner("Running AOE_tokamaker analysis..."):
-                try:
-                    # Get the current working directory and construct the path to tokamak_psp_2025
-                    current_dir = os.getcwd()
-                    
-                    # Check if we're already in the tokamak_psp_2025 directory
-                    if os.path.basename(current_dir) == "tokamak_psp_2025":
-                        # We're already in the tokamak directory
-                        tokamak_dir = current_dir
-                    else:
-                        # We're in the parent directory, so join with tokamak_psp_2025
-                        tokamak_dir = os.path.join(current_dir, "tokamak_psp_2025")
-                    
-                    # Verify the directory exists and contains the notebook
-                    notebook_path = os.path.join(tokamak_dir, "AOE_tokamaker.ipynb")
-                    if not os.path.exists(notebook_path):
-                        st.error(f"❌ AOE_tokamaker.ipynb not found at: {notebook_path}")
-                        st.error(f"Current working directory: {current_dir}")
-                        st.error(f"Tokamak directory: {tokamak_dir}")
-                        st.stop()
-                    
-                    # Run the AOE_tokamaker script
-                    result = subprocess.run([
-                        "jupyter", 
-                        "nbconvert",
-                        "--execute",
-                        "--to",
-                        "notebook",
-                        "--inplace",
-                        "AOE_tokamaker.ipynb",
-                    ], cwd=tokamak_dir, capture_output=True, text=True)
-                
-                    if result.returncode == 0:
-                        st.success("✅ Analysis completed successfully!")
-                        st.session_state.analysis_completed = True
-                        st.session_state.output_folder = "tokamak_psp_2025/examples/testing_1"
-                        st.rerun()
-                    else:
-                        st.error("❌ Analysis failed. Check console for errors.")
-                        st.error(result.stderr)
-                        
-                except Exception as e:
-                    st.error(f"❌ Error running analysis: {e}")
+        job = st.session_state.get('analysis_job')
+        running = job is not None and not job.finished
+        if st.button("🚀 Run Analysis", type="secondary", help="Execute AOE_tokamaker with current design", disabled=running):
+            # A design that already has results is analysed again in a new run folder
+            run_dir = st.session_state.run_dir
+            if os.path.exists(os.path.join(run_dir, SUMMARY_FILENAME)) or job is not None:
+                previous_dir = run_dir
+                run_id, run_dir, design_file_path = new_run(st.session_state.locked_design, RUNS_DIR)
+                shutil.rmtree(previous_dir, ignore_errors=True)
+                st.session_state.run_id = run_id
+                st.session_state.run_dir = run_dir
+                st.session_state.design_file = design_file_path
+            st.session_state.pop('stored_run', None)
+            # The pipeline waits for a worker in the shared queue, then runs in a background process
+            try:
+                st.session_state.analysis_job = shared_scheduler().submit(
+                    st.session_state.locked_design, run_dir, owner=st.session_state.session_id)
+                st.session_state.analysis_completed = False
+                st.session_state.output_folder = run_dir
+                st.rerun()
+            except QueueFull as e:
+                st.error(f"⏳ The analysis queue is full: {e}")
     else:
         st.info("💡 Lock design first to enable analysis")
 
@@ -655,6 +709,7 @@ with col_status:
     if 'locked_design' in st.session_state:
         design = st.session_state.locked_design
         st.write("**🔒 Current Locked Design:**")
+        st.write(f"• Run ID: `{st.session_state.run_id}`")
         st.write(f"• Timestamp: {design['timestamp']}")
         st.write(f"• Major Radius: {design['plasma_parameters']['major_radius']:.2f} m")
         st.write(f"• Minor Radius: {design['plasma_parameters']['minor_radius']:.2f} m")
@@ -669,115 +724,158 @@ with col_status:
     else:
         st.info("💡 Lock your design to save parameters and proceed with analysis")
 
+@st.fragment(run_every=1.0)
+def analysis_progress():
+    """Poll the background run, showing its progress, a Cancel button and figures as they land"""
+    job = st.session_state.analysis_job
+    job.poll()
+    if job.finished:
+        st.session_state.analysis_completed = True
+        st.rerun()
+
+    if job.status == "queued":
+        scheduler = shared_scheduler()
+        position, queue = scheduler.position(job), scheduler.status()
+        st.progress(0.0, text=f"Queued: position {position or 1} of {queue['queued']}, "
+                              f"{queue['running']}/{queue['workers']} workers busy ({job.waited:.0f} s)")
+        if st.button("✖ Cancel Analysis", key="cancel_analysis"):
+            scheduler.cancel(job)
+            st.rerun()
+        return
+
+    latest = job.latest()
+    message = latest.get("message") if latest else None
+    st.progress(job.fraction_done(), text=f"{message or 'Starting analysis...'} ({job.elapsed:.0f} s)")
+    if job.status == "cancelling":
+        st.caption("Cancelling, stopping at the next checkpoint...")
+    elif st.button("✖ Cancel Analysis", key="cancel_analysis"):
+        job.cancel()
+        rerun_fragment()
+
+    images = [f for f in job.outputs if f.lower().endswith('.png')]
+    if images:
+        cols = st.columns(4)
+        for i, filename in enumerate(images):
+            with cols[i % 4]:
+                st.image(results_view.preview(os.path.join(job.output_dir, filename), results_view.THUMBNAIL_WIDTH),
+                         caption=filename, use_container_width=True)
+
+job = st.session_state.get('analysis_job')
+if job is not None and not job.finished:
+    st.markdown("---")
+    st.header("⏳ Analysis Running")
+    analysis_progress()
+
 # Display analysis results if available
 if 'analysis_completed' in st.session_state and st.session_state.analysis_completed:
     st.markdown("---")
     st.header("📊 Analysis Results")
     
-    # Get the current working directory and construct the proper path to output folder
-    current_dir = os.getcwd()
+    output_folder = st.session_state.output_folder
     
-    # Check if we're already in the tokamak_psp_2025 directory
-    if os.path.basename(current_dir) == "tokamak_psp_2025":
-        # We're already in the tokamak directory
-        output_folder = os.path.join(current_dir, "examples", "testing_1")
-    else:
-        # We're in the parent directory, so join with tokamak_psp_2025
-        output_folder = os.path.join(current_dir, "tokamak_psp_2025", "examples", "testing_1")
+    # Stage wall times recorded by the pipeline
+    summary = results_view.load_summary(output_folder) if os.path.exists(output_folder) else None
+    if summary is not None:
+        stage_times = ", ".join(f"{stage} {seconds:.1f} s" for stage, seconds in summary["timings"].items())
+        st.caption(f"⏱️ Analysis wall time: {summary['total_time']:.1f} s ({stage_times})")
+        if summary.get("status") == "cancelled":
+            st.warning("⚠️ Analysis was cancelled, showing the figures completed before it stopped")
+        panel = st.expander("⏱️ Performance profile", key="results_profile", on_change="rerun")
+        if panel.open:
+            with panel:
+                trace = results_view.load_trace(output_folder)
+                if trace:
+                    st.plotly_chart(results_view.trace_figure(trace), use_container_width=True)
+                    st.dataframe(results_view.stage_table(summary), hide_index=True, use_container_width=True)
+                    st.caption("trace.json opens in chrome://tracing or ui.perfetto.dev")
+                else:
+                    st.caption("This run has no trace.jsonl")
+                # Earlier runs kept in the run index, leaving out this run's own entry
+                index = shared_run_index()
+                stored_run = st.session_state.get('stored_run')
+                own_key = stored_run["key"] if stored_run is not None else run_key(st.session_state.locked_design)
+                previous = [entry for entry in index.query() if entry["key"] != own_key]
+                runs = []
+                for entry in previous[-results_view.COMPARE_RUNS:]:
+                    entry_summary = results_view.load_summary(index.run_dir(entry["key"]))
+                    if entry_summary is not None:
+                        runs.append((datetime.fromtimestamp(entry["created"]).strftime("%m-%d %H:%M"), entry_summary))
+                if runs:
+                    runs.append(("this run", summary))
+                    st.plotly_chart(results_view.comparison_figure(runs), use_container_width=True)
+                else:
+                    st.caption("No earlier runs in the run index to compare with")
+    stored_run = st.session_state.get('stored_run')
+    if stored_run is not None:
+        analysed = datetime.fromtimestamp(stored_run["created"]).strftime("%Y-%m-%d %H:%M")
+        st.info(f"📦 This design was analysed on {analysed}; its results were loaded from the run index. "
+                "Run Analysis solves it again.")
+    job = st.session_state.get('analysis_job')
+    if job is not None and job.status == "failed":
+        error = job.latest("failed")
+        st.error(f"❌ Error running analysis: {error['message'] if error else 'process exited unexpectedly'}")
     
     if os.path.exists(output_folder):
-        # Look for specific numbered files in order
-        image_files = []
-        gif_files = []
-        
-        # Define the specific order for images
-        ordered_filenames = [
-            "01_vacuum_vessel_design.png",
-            "02_plasma_profiles.png", 
-            "03_initial_equilibrium.png",
-            "04_coil_currents.png",
-            "05_growth_rate_vs_beta_p.png",
-            "06_mode_structures_different_beta_p.png",
-            "07_nonlinear_plasma_evolution.png",
-            "09_vde_evolution.gif"
-        ]
+        # Outputs come from the run manifest, in the order the pipeline wrote them
+        figures, animations, data_files = results_view.classify_outputs(
+            results_view.manifest_outputs(output_folder, summary))
         
-        # Check which files exist and organize them
-        existing_images = {}
-        existing_gifs = []
-        
-        for filename in ordered_filenames:
-            file_path = os.path.join(output_folder, filename)
-            if os.path.exists(file_path):
-                if filename.lower().endswith('.gif'):
-                    existing_gifs.append(file_path)
-                else:
-                    # Extract the number prefix for organization
-                    file_number = filename.split('_')[0]
-                    existing_images[file_number] = file_path
-        
-        if existing_images or existing_gifs:            
-            # Display images in 2 columns with specific organization
-            # Column 1: 01, 03, 05
-            # Column 2: 02, 04, 06, 07
-            col1, col2 = st.columns(2)
+        if figures or animations:
+            # Each panel is only decoded when opened; previews and files are cached on path, mtime and size
+            columns = st.columns(2)
+            for i, filename in enumerate(figures):
+                file_path = os.path.join(output_folder, filename)
+                with columns[i % 2]:
+                    panel = st.expander(results_view.output_title(filename), expanded=i < 2,
+                                        key=f"results_{filename}", on_change="rerun")
+                    if panel.open:
+                        with panel:
+                            try:
+                                st.image(results_view.preview(file_path), caption=filename, use_container_width=True)
+                                st.download_button("⬇️ Full resolution", data=lambda path=file_path: results_view.file_bytes(path),
+                                                   file_name=filename, mime="image/png", key=f"download_{filename}",
+                                                   on_click="ignore")
+                            except Exception as e:
+                                st.error(f"Error loading {file_path}: {e}")
             
-            # Column 1 images (01, 03, 05)
-            column1_numbers = ["01", "03", "05"]
-            with col1:
-                for num in column1_numbers:
-                    if num in existing_images:
+            # VDE animation below the columns (09), served by URL rather than inlined into the page
+            for filename in animations:
+                file_path = os.path.join(output_folder, filename)
+                panel = st.expander(results_view.output_title(filename), key=f"results_{filename}",
+                                    on_change="rerun")
+                if panel.open:
+                    with panel:
                         try:
-                            filename = os.path.basename(existing_images[num])
-                            from PIL import Image
-                            img = Image.open(existing_images[num])
-                            st.image(img, caption=filename, use_container_width=True)
+                            mime = results_view.ANIMATION_MIME[os.path.splitext(filename)[1].lower()]
+                            if mime == "video/mp4":
+                                st.video(file_path, format=mime, loop=True, autoplay=True, muted=True)
+                            elif mime == "image/webp":
+                                # st.image would flatten an animated WebP to its first frame
+                                data_url = base64.b64encode(results_view.file_bytes(file_path)).decode("utf-8")
+                                st.markdown(
+                                    f'<img src="data:{mime};base64,{data_url}" alt="{filename}" style="width: 95%; max-width: 95%;">',
+                                    unsafe_allow_html=True,
+                                )
+                            else:
+                                # GIF and APNG bytes are passed through unchanged at this size
+                                st.image(results_view.file_bytes(file_path), use_container_width=True)
+                            st.caption(filename)
                         except Exception as e:
-                            st.error(f"Error loading {existing_images[num]}: {e}")
+                            st.error(f"Error loading {file_path}: {e}")
             
-            # Column 2 images (02, 04, 06, 07)
-            column2_numbers = ["02", "04", "06", "07"]
-            with col2:
-                for num in column2_numbers:
-                    if num in existing_images:
-                        try:
-                            filename = os.path.basename(existing_images[num])
-                            from PIL import Image
-                            img = Image.open(existing_images[num])
-                            st.image(img, caption=filename, use_container_width=True)
-                        except Exception as e:
-                            st.error(f"Error loading {existing_images[num]}: {e}")
-            
-            # Display GIF files below the columns (09)
-            if existing_gifs:
-                st.markdown("<br>", unsafe_allow_html=True)
-                
-                for gif_path in existing_gifs:
-                    try:
-                        filename = os.path.basename(gif_path)
-                        
-                        # Use base64 encoding for proper GIF display
-                        with open(gif_path, "rb") as gif_file:
-                            contents = gif_file.read()
-                            data_url = base64.b64encode(contents).decode("utf-8")
-                        
-                        # Display GIF using HTML with base64 encoding - full width
-                        st.markdown(
-                            f'<img src="data:image/gif;base64,{data_url}" alt="{filename}" style="width: 95%; max-width: 95%;">',
-                            unsafe_allow_html=True,
-                        )
-                        
-                        # Add caption below (matches st.image caption style)
-                        st.caption(filename)
-                        
-                    except Exception as e:
-                        st.error(f"Error loading {gif_path}: {e}")
+            if data_files:
+                with st.expander("Data files"):
+                    for filename in data_files:
+                        file_path = os.path.join(output_folder, filename)
+                        st.download_button(f"⬇️ {filename} ({os.path.getsize(file_path)/1E6:.1f} MB)",
+                                           data=lambda path=file_path: results_view.file_bytes(path),
+                                           file_name=filename, mime=results_view.DATA_MIME[os.path.splitext(filename)[1]],
+                                           key=f"download_{filename}", on_click="ignore")
 
         else:
             st.warning(f"No result files found in the output folder: {output_folder}")
             # Debug information
             st.write("**Debug info:**")
-            st.write(f"- Current working directory: {current_dir}")
             st.write(f"- Looking for images in: {output_folder}")
             st.write(f"- Folder exists: {os.path.exists(output_folder)}")
             if os.path.exists(output_folder):
@@ -787,11 +885,13 @@ if 'analysis_completed' in st.session_state and st.session_state.analysis_comple
         st.error(f"Output folder not found: {output_folder}")
         # Debug information
         st.write("**Debug info:**")
-        st.write(f"- Current working directory: {current_dir}")
         st.write(f"- Expected output folder: {output_folder}")
     
     # Add button to clear results
     if st.button("🗑️ Clear Results"):
         clear_results()
         st.rerun()
-    
\ No newline at end of file
+
+# Per-rerun latency against the interactive budget
+st.session_state.latency.record("full_rerun", (time.perf_counter() - rerun_start)*1e3)
+st.caption(latency_caption(st.session_state.latency, "full_rerun", "Full rerun"))
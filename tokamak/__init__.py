@@ -0,0 +1,8 @@
+# Shared helpers for the AOE_tokamaker notebook and the Streamlit designer
+
+import os
+
+# Root of the disk caches (meshes, run index, surrogate); TOKAMAK_CACHE_DIR
+# moves them, e.g. so the benchmarks' stand-in solver keeps its own
+CACHE_DIR = os.environ.get("TOKAMAK_CACHE_DIR",
+                           os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache"))
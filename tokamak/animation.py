@@ -0,0 +1,231 @@
+# Renderer for the VDE evolution animation
+#
+# FuncAnimation redrew the machine with plot_machine and rebuilt the
+# triangulation inside plot_psi for every frame. Here the machine, axes and
+# labels are drawn once in the parent and captured as a background bitmap.
+# Frames only add psi contours, drawn on one shared Triangulation of the mesh
+# with the same level choice as TokaMaker.plot_psi. Frames are rendered in
+# chunks on a pool of worker processes (no OFT needed there) and encoded once
+# at the end, as GIF, animated WebP, APNG or MP4 (MP4 needs ffmpeg on PATH).
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+
+import numpy as np
+
+FORMATS = ("gif", "webp", "apng", "mp4")
+FPS = 5
+FIGSIZE = (8, 5)
+DPI = 120
+# Palette size for GIF and APNG; eight contour colors, gray, black and the axes fit easily
+COLORS = 64
+PLASMA_LEVELS = 8
+VACUUM_LEVELS = 6
+ZLIM = (-3.2, 3.2)
+# Axes coordinates, so the time stays on screen whatever the machine's extent
+TIME_LABEL_POS = (0.03, 0.93)
+
+# Frames per task handed to a worker, and the fewest frames worth a pool for
+DEFAULT_CHUNK = 4
+MIN_PARALLEL_FRAMES = 16
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+_frame_renderer = None
+
+
+def contour_levels(psi, plasma_nlevels=PLASMA_LEVELS, vacuum_nlevels=VACUUM_LEVELS):
+    """Plasma and vacuum contour levels of normalized psi, as chosen by TokaMaker.plot_psi"""
+    plasma_levels = np.linspace(0.0, 1.0, plasma_nlevels)
+    vacuum_low = np.zeros((0,))
+    vacuum_high = np.zeros((0,))
+    if psi.min() < -0.1:
+        vacuum_low = np.linspace(psi.min(), 0.0, vacuum_nlevels, endpoint=False)
+    if psi.max() > 1.1:
+        vacuum_high = np.linspace(1.0, psi.max(), vacuum_nlevels, endpoint=False)
+    return plasma_levels, np.hstack((vacuum_low, vacuum_high))
+
+
+def draw_background(tokamaker, mesh_pts, figsize=FIGSIZE, dpi=DPI):
+    """Draw the machine once and capture it as an RGBA bitmap
+
+    Returns (background, axes position, xlim, ylim) so frames can overlay
+    their contours in exactly the same data coordinates.
+    """
+    import matplotlib.pyplot as plt
+
+    with plt.rc_context({'lines.linewidth': 3}):
+        fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+        tokamaker.plot_machine(fig, ax)
+        # Leave room for contours anywhere on the mesh, not just over the machine
+        ax.update_datalim(np.asarray(mesh_pts)[:, :2])
+        ax.autoscale_view()
+        ax.set_xlabel('R (m)', fontsize=12)
+        ax.set_ylabel('Z (m)', fontsize=12)
+        ax.set_ylim(*ZLIM)
+        fig.canvas.draw()
+        background = np.asarray(fig.canvas.buffer_rgba()).copy()
+        layout = (background, ax.get_position().bounds, ax.get_xlim(), ax.get_ylim())
+        plt.close(fig)
+    return layout
+
+
+class FrameRenderer:
+    """Draws psi frames over a fixed background on a reused Agg figure"""
+
+    def __init__(self, background, position, xlim, ylim, mesh_pts, mesh_lc, figsize=FIGSIZE, dpi=DPI):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.tri import Triangulation
+
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.fig.figimage(background, 0, 0, origin='upper', zorder=-1)
+        self.ax = self.fig.add_axes(position)
+        self.ax.set_xlim(*xlim)
+        self.ax.set_ylim(*ylim)
+        self.ax.set_axis_off()
+        self.triangulation = Triangulation(mesh_pts[:, 0], mesh_pts[:, 1], mesh_lc)
+        self.artists = []
+
+    def render(self, psi, time_ms):
+        """Return the frame for one psi snapshot as an (H, W, 3) uint8 array"""
+        for artist in self.artists:
+            artist.remove()
+        plasma_levels, vacuum_levels = contour_levels(psi)
+        self.artists = []
+        if len(vacuum_levels) > 0:
+            self.artists.append(self.ax.tricontour(self.triangulation, psi, levels=vacuum_levels,
+                                                   colors='darkgray', linewidths=1.5))
+        self.artists.append(self.ax.tricontour(self.triangulation, psi, levels=plasma_levels,
+                                               cmap='magma', linewidths=3))
+        self.artists.append(self.ax.text(*TIME_LABEL_POS, f"{time_ms:.2f}" + ' ms', color='k', fontsize=14,
+                                         transform=self.ax.transAxes))
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def _init_worker(layout, mesh_pts, mesh_lc, figsize, dpi):
+    global _frame_renderer
+    _frame_renderer = FrameRenderer(*layout, mesh_pts, mesh_lc, figsize=figsize, dpi=dpi)
+
+
+def _render_chunk(chunk):
+    return [_frame_renderer.render(psi, time_ms) for time_ms, psi in chunk]
+
+
+def render_frames(layout, mesh_pts, mesh_lc, snapshots, times_ms, workers=1, chunk=DEFAULT_CHUNK,
+                  progress=None, figsize=FIGSIZE, dpi=DPI):
+    """Render every snapshot, in parallel when workers > 1
+
+    progress, if given, is called with the number of frames done after each
+    chunk (and may raise to stop rendering).
+    """
+    nframes = len(snapshots)
+    tasks = [[(times_ms[i], np.asarray(snapshots[i])) for i in range(start, min(start + chunk, nframes))]
+             for start in range(0, nframes, chunk)]
+    frames = []
+    if workers <= 1 or nframes < MIN_PARALLEL_FRAMES:
+        renderer = FrameRenderer(*layout, mesh_pts, mesh_lc, figsize=figsize, dpi=dpi)
+        for task in tasks:
+            frames.extend(renderer.render(psi, time_ms) for time_ms, psi in task)
+            if progress is not None:
+                progress(len(frames))
+        return frames
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(min(workers, len(tasks)), initializer=_init_worker,
+                      initargs=(layout, mesh_pts, mesh_lc, figsize, dpi)) as pool:
+        for rendered in pool.imap(_render_chunk, tasks):
+            frames.extend(rendered)
+            if progress is not None:
+                progress(len(frames))
+    return frames
+
+
+def encode(frames, path, fps=FPS):
+    """Encode frames once into path; the format follows the extension"""
+    from PIL import Image
+
+    fmt = animation_format(path)
+    if fmt == "mp4":
+        _encode_mp4(frames, path, fps)
+        return
+    images = [Image.fromarray(frame) for frame in frames]
+    duration = int(round(1000/fps))
+    if fmt == "webp":
+        images[0].save(path, format="WEBP", save_all=True, append_images=images[1:], duration=duration, loop=0,
+                       quality=80, method=4)
+        return
+    images = [image.quantize(COLORS) for image in images]
+    images[0].save(path, format="GIF" if fmt == "gif" else "PNG", save_all=True, append_images=images[1:],
+                   duration=duration, loop=0)
+
+
+def _encode_mp4(frames, path, fps):
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("MP4 output needs ffmpeg on PATH; use gif, webp or apng instead")
+    height, width = frames[0].shape[:2]
+    # yuv420p needs even dimensions
+    height, width = height - height % 2, width - width % 2
+    command = [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+               "-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart", path]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    for frame in frames:
+        process.stdin.write(np.ascontiguousarray(frame[:height, :width]).tobytes())
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed writing {path}")
+
+
+def animation_format(path):
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    check_format(fmt)
+    return fmt
+
+
+def check_format(fmt):
+    """Raise ValueError for formats that are unknown or cannot be written here"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported animation format {fmt!r}, expected one of {FORMATS}")
+    if fmt == "mp4" and shutil.which("ffmpeg") is None:
+        raise ValueError("MP4 output needs ffmpeg on PATH; use gif, webp or apng instead")
+
+
+def animation_filename(stem, fmt):
+    return f"{stem}.{fmt}"
+
+
+def write_animation(path, layout, mesh_pts, mesh_lc, snapshots, times_ms, workers=1, fps=FPS, progress=None):
+    """Render and encode the animation, returning frame count, timings, frames/s and bytes
+
+    The file is written under a temporary name and moved into place only
+    once encoding succeeds. Raises ValueError when there are no snapshots.
+    """
+    if len(snapshots) == 0:
+        raise ValueError(f"No snapshots to animate into {path}")
+    start = time.perf_counter()
+    frames = render_frames(layout, mesh_pts, mesh_lc, snapshots, times_ms, workers=workers, progress=progress)
+    rendered = time.perf_counter()
+
+    stem, ext = os.path.splitext(path)
+    partial_path = stem + ".partial" + ext
+    try:
+        encode(frames, partial_path, fps=fps)
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    done = time.perf_counter()
+    return {
+        "frames": len(frames),
+        "workers": workers,
+        "render_time": rendered - start,
+        "encode_time": done - rendered,
+        "frames_per_second": len(frames)/(done - start) if done > start else None,
+        "bytes": os.path.getsize(path),
+    }
@@ -0,0 +1,355 @@
+# Automatic coil placement
+#
+# The notebook's advice is to move coils and re-solve until the coil
+# currents fall below 2*Ip and the isoflux points line up. optimize_coils()
+# searches the coil (R, Z) positions instead, scoring thousands of
+# candidates cheaply with a linear response model:
+#
+#   - the target plasma (create_isoflux shape) is a uniform current density
+#     carrying Ip_target, represented by filaments on a grid inside it
+#   - the flux of every coil at every isoflux point comes from the filament
+#     Green's function (tokamak/greens.py)
+#   - coil currents and the boundary flux psi0 solve a regularized least
+#     squares problem mirroring set_shape_targets and
+#     set_coil_regularization: weight 5 on psi - psi0 at every isoflux
+#     point, weight 0.1 on every coil current (scaled by Ip_target)
+#
+# A candidate's score is its peak coil current as a fraction of the 2*Ip
+# limit plus a weighted RMS isoflux error. The search is an elitist
+# evolution strategy over all coil positions; every candidate is moved back
+# outside the vessel with validate_coil_positions and rejected if coils
+# overlap or leave the editor's slider ranges. The best distinct candidates
+# are then confirmed with full TokaMaker equilibrium solves on a process pool.
+# The app runs only the search itself; it queues one confirm_job per
+# candidate in the shared tokamak.scheduler (as one group), so the solves
+# run in parallel on free worker slots with the same fair share and limits
+# as analyses.
+#
+#   python -m tokamak.coil_optimizer examples/negative_triangulation/design_20250630_171055.json -o optimized.json
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from tokamak import oft
+from tokamak.geometry import points_in_polygon, validate_coil_positions
+from tokamak.greens import filament_psi
+from tokamak.mesh_cache import COIL_SIZE
+
+ISOFLUX_WEIGHT = 5.0
+COIL_REG_WEIGHT = 0.1
+# Score = peak current/(2*Ip) + ISOFLUX_PENALTY*(RMS isoflux error/plasma flux)
+ISOFLUX_PENALTY = 10.0
+CURRENT_LIMIT_RATIO = 2.0
+
+# Coil centres stay within the ranges of the design view's coil editor sliders
+COIL_R_RANGE = (1.0, 8.0)
+COIL_Z_RANGE = (-4.0, 4.0)
+
+PLASMA_GRID = 15
+POPULATION = 256
+ELITES = 16
+GENERATIONS = 40
+SIGMA_RANGE = (0.5, 0.02)
+CONFIRM_CANDIDATES = 4
+CONFIRMATION_FILENAME = "coil_confirmation.json"
+DEFAULT_WORKERS = min(CONFIRM_CANDIDATES, os.cpu_count() or 1)
+
+
+def plasma_filaments(boundary_pts, npts=PLASMA_GRID):
+    """(R, Z) of filaments on a grid inside the plasma boundary"""
+    boundary_pts = np.asarray(boundary_pts, dtype=np.float64)
+    lo, hi = boundary_pts.min(0), boundary_pts.max(0)
+    r, z = np.meshgrid(np.linspace(lo[0], hi[0], npts + 2)[1:-1], np.linspace(lo[1], hi[1], npts + 2)[1:-1])
+    grid = np.column_stack((r.ravel(), z.ravel()))
+    return grid[points_in_polygon(grid, boundary_pts)]
+
+
+class ResponseModel:
+    """Linear coil-to-isoflux response for one plasma target
+
+    Scores candidate coil sets, an array of shape (ncandidates, ncoils, 2),
+    all at once.
+    """
+
+    def __init__(self, boundary_pts, Ip):
+        self.boundary_pts = np.asarray(boundary_pts, dtype=np.float64)
+        self.Ip = Ip
+        filaments = plasma_filaments(self.boundary_pts)
+        r, z = self.boundary_pts[:, 0], self.boundary_pts[:, 1]
+        self.psi_plasma = Ip/len(filaments)*filament_psi(r[:, None], z[:, None], filaments[:, 0], filaments[:, 1]).sum(1)
+        # Flux the plasma closes on itself, from its centre to its boundary
+        centre = filaments.mean(0)
+        psi_centre = Ip/len(filaments)*filament_psi(centre[0], centre[1], filaments[:, 0], filaments[:, 1]).sum()
+        self.psi_scale = abs(psi_centre - self.psi_plasma.mean())
+
+    def response(self, coils):
+        """Flux at every isoflux point per unit current in every coil, shape (ncandidates, npoints, ncoils)"""
+        r, z = self.boundary_pts[:, 0], self.boundary_pts[:, 1]
+        return filament_psi(r[None, :, None], z[None, :, None], coils[:, None, :, 0], coils[:, None, :, 1])
+
+    def solve(self, coils):
+        """Regularized least-squares coil currents, shape (ncandidates, ncoils), and isoflux RMS errors"""
+        G = self.response(coils)
+        ncand, npts, ncoils = G.shape
+        # Unknowns are the coil currents and the boundary flux psi0
+        A = np.zeros((ncand, npts + ncoils, ncoils + 1))
+        A[:, :npts, :ncoils] = ISOFLUX_WEIGHT*G/self.psi_scale
+        A[:, :npts, ncoils] = -ISOFLUX_WEIGHT/self.psi_scale
+        A[:, npts:, :ncoils] = COIL_REG_WEIGHT/self.Ip*np.eye(ncoils)
+        b = np.zeros((ncand, npts + ncoils))
+        b[:, :npts] = -ISOFLUX_WEIGHT*self.psi_plasma/self.psi_scale
+        At = A.transpose(0, 2, 1)
+        x = np.linalg.solve(At @ A, (At @ b[:, :, None]))[:, :, 0]
+        currents, psi0 = x[:, :ncoils], x[:, ncoils]
+        residual = np.einsum("cpk,ck->cp", G, currents) + self.psi_plasma - psi0[:, None]
+        return currents, np.sqrt(np.mean(residual**2, axis=1))/self.psi_scale
+
+    def score(self, coils):
+        """(score, peak current/(2*Ip), relative isoflux error, currents) of every candidate"""
+        currents, isoflux_error = self.solve(coils)
+        peak = np.abs(currents).max(1)/(CURRENT_LIMIT_RATIO*self.Ip)
+        return peak + ISOFLUX_PENALTY*isoflux_error, peak, isoflux_error, currents
+
+
+def feasible(coils):
+    """Candidates whose coils stay in the editor ranges and do not overlap"""
+    r, z = coils[..., 0], coils[..., 1]
+    inside = ((r >= COIL_R_RANGE[0]) & (r <= COIL_R_RANGE[1]) & (z >= COIL_Z_RANGE[0]) & (z <= COIL_Z_RANGE[1])).all(1)
+    gaps = np.linalg.norm(coils[:, :, None, :] - coils[:, None, :, :], axis=3)
+    gaps[:, np.arange(coils.shape[1]), np.arange(coils.shape[1])] = np.inf
+    return inside & (gaps.min((1, 2)) >= COIL_SIZE)
+
+
+def repair(coils, vv_coords, boundary_pts):
+    """Move coils inside the vessel or plasma back outside, for every candidate at once"""
+    ncand, ncoils, _ = coils.shape
+    flat = validate_coil_positions(coils.reshape(-1, 2), vv_coords, boundary_pts)
+    return np.asarray(flat, dtype=np.float64).reshape(ncand, ncoils, 2)
+
+
+def search(model, start_coils, vv_coords, population=POPULATION, elites=ELITES, generations=GENERATIONS,
+           sigma_range=SIGMA_RANGE, seed=0):
+    """Evolve coil positions from start_coils, returning every elite as (score, coils) best first"""
+    rng = np.random.default_rng(seed)
+    start = np.asarray(start_coils, dtype=np.float64)[None]
+    parents = repair(start, vv_coords, model.boundary_pts)
+    scores = model.score(parents)[0]
+    scores[~feasible(parents)] = np.inf
+    for sigma in np.geomspace(*sigma_range, generations):
+        picks = rng.integers(len(parents), size=population)
+        children = parents[picks] + sigma*rng.standard_normal((population,) + start.shape[1:])
+        children[..., 0] = children[..., 0].clip(*COIL_R_RANGE)
+        children[..., 1] = children[..., 1].clip(*COIL_Z_RANGE)
+        children = repair(children, vv_coords, model.boundary_pts)
+        child_scores = model.score(children)[0]
+        child_scores[~feasible(children)] = np.inf
+        pool = np.concatenate((parents, children))
+        pool_scores = np.concatenate((scores, child_scores))
+        keep = np.argsort(pool_scores)[:elites]
+        parents, scores = pool[keep], pool_scores[keep]
+    return [(float(s), c) for s, c in zip(scores, parents) if np.isfinite(s)]
+
+
+def distinct(candidates, count, tolerance=0.05):
+    """First count candidates whose coils differ from every earlier pick by more than tolerance (m)"""
+    picked = []
+    for score, coils in candidates:
+        if all(np.abs(coils - other).max() > tolerance for _, other in picked):
+            picked.append((score, coils))
+        if len(picked) == count:
+            break
+    return picked
+
+
+def _confirm_task(design, nthreads):
+    """Full TokaMaker equilibrium for one candidate design"""
+    from tokamak import pipeline
+
+    oft.ensure_oft_path()
+    start = time.perf_counter()
+    output_dir = tempfile.mkdtemp(prefix="tokamak_coils_")
+    try:
+        run = pipeline.AnalysisRun(design, output_dir, nthreads=nthreads, scan_workers=1, export_workers=0)
+        pipeline.prepare_geometry(run)
+        pipeline.build_mesh(run)
+        pipeline.setup_tokamaker(run)
+        pipeline.solve_equilibrium(run)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    currents = np.array(list(run.coil_currents.values()), dtype=np.float64)
+    return {
+        "err_flag": int(run.err_flag),
+        "peak_current": float(np.abs(currents).max()),
+        "current_limit": float(CURRENT_LIMIT_RATIO*run.eq_stats["Ip"]),
+        "kappa": float(run.eq_stats["kappa"]),
+        "delta": float(run.eq_stats["delta"]),
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+def confirm(design, candidates, workers=DEFAULT_WORKERS, nthreads=1):
+    """Solve every candidate with TokaMaker on workers processes, returning one result dict each"""
+    designs = [{**design, "coil_coordinates": coils.tolist()} for _, coils in candidates]
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(max(1, min(workers, len(designs)))) as pool:
+        pending = [pool.apply_async(_confirm_task, (d, nthreads)) for d in designs]
+        results = []
+        for result in pending:
+            try:
+                results.append(result.get())
+            except Exception as e:
+                results.append({"err_flag": -1, "error": str(e)})
+    return results
+
+
+def confirm_job(design, candidates, output_dir, nthreads=1, reporter=None, cancel_event=None):
+    """Solve the candidate coil sets one after another in this process, as a tokamak.jobs job
+
+    candidates are coil_coordinates lists. Progress events go to reporter;
+    the results are written to output_dir/CONFIRMATION_FILENAME, and a set
+    cancel_event stops before the next candidate.
+    """
+    def report(stage, message, **extra):
+        if reporter is not None:
+            reporter({"time": time.time(), "stage": stage, "message": message, **extra})
+
+    results = []
+    for i, coils in enumerate(candidates):
+        if cancel_event is not None and cancel_event.is_set():
+            report("cancelled", "Confirmation cancelled")
+            return None
+        report("confirm", f"Solving candidate {i + 1} of {len(candidates)} with TokaMaker", step=i,
+               total=len(candidates))
+        try:
+            results.append(_confirm_task({**design, "coil_coordinates": coils}, nthreads))
+        except Exception as e:
+            results.append({"err_flag": -1, "error": str(e)})
+    with open(os.path.join(output_dir, CONFIRMATION_FILENAME), "w") as f:
+        json.dump(results, f, indent=2)
+    report("completed", "Confirmation completed")
+    return results
+
+
+def load_confirmation(output_dir):
+    """Results written by confirm_job() to output_dir, or None if it did not finish"""
+    path = os.path.join(output_dir, CONFIRMATION_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def search_coils(design, candidates=CONFIRM_CANDIDATES, seed=0, progress=print):
+    """Linear-model search of coil positions for design, without TokaMaker solves
+
+    Returns a dict with the best coil_coordinates, the best `candidates`
+    distinct entries (best first) and the score of the starting coils;
+    apply_confirmation() adds TokaMaker results to it.
+    """
+    from tokamak.pipeline import ISOFLUX_POINTS, load_design
+    from tokamak.rendering import isoflux_boundary
+
+    design = load_design(design)
+    plasma = design["plasma_parameters"]
+    boundary_pts = isoflux_boundary(ISOFLUX_POINTS, plasma["major_radius"], 0.0, plasma["minor_radius"],
+                                    plasma["elongation"], plasma["triangularity"])
+    vv_coords = design["vacuum_vessel"]["boundary_coordinates"]
+    model = ResponseModel(boundary_pts, design["advanced_settings"]["Ip_target"])
+
+    start = time.perf_counter()
+    initial = np.asarray(design["coil_coordinates"], dtype=np.float64)[None]
+    _, initial_peak, initial_error, _ = model.score(initial)
+    found = search(model, design["coil_coordinates"], vv_coords, seed=seed)
+    if not found:
+        raise ValueError("No feasible coil placement found; check the vessel and coil count")
+    picked = distinct(found, max(candidates, 1))
+    _, peaks, errors, currents = model.score(np.array([coils for _, coils in picked]))
+    search_time = time.perf_counter() - start
+    progress(f"Scored {POPULATION*GENERATIONS} candidates in {search_time:.1f} s")
+
+    entries = [{"coil_coordinates": coils.tolist(), "score": score, "peak_current_ratio": float(peak),
+                "isoflux_error": float(error), "currents": current.tolist()}
+               for (score, coils), peak, error, current in zip(picked, peaks, errors, currents)]
+    return {
+        "coil_coordinates": entries[0]["coil_coordinates"],
+        "best": entries[0],
+        "candidates": entries,
+        "initial": {"peak_current_ratio": float(initial_peak[0]), "isoflux_error": float(initial_error[0])},
+        "search_time": search_time,
+        "total_time": search_time,
+    }
+
+
+def apply_confirmation(result, confirmations):
+    """Attach one TokaMaker result per candidate to a search_coils() result and re-pick the best"""
+    entries = result["candidates"]
+    for entry, solved in zip(entries, confirmations):
+        entry["confirmed"] = solved
+    # Converged solves first, then those within the current limit, then the lowest peak current
+    solved = [e for e in entries if e.get("confirmed", {}).get("err_flag") == 0]
+    best = entries[0]
+    if solved:
+        best = min(solved, key=lambda e: (e["confirmed"]["peak_current"] > e["confirmed"]["current_limit"],
+                                          e["confirmed"]["peak_current"]))
+    result.update(best=best, coil_coordinates=best["coil_coordinates"])
+    return result
+
+
+def optimize_coils(design, confirm_candidates=CONFIRM_CANDIDATES, workers=DEFAULT_WORKERS, nthreads=1, seed=0,
+                   progress=print):
+    """Search coil positions for design, returning a dict with the best coil_coordinates
+
+    The result also holds the cheap score of the starting coils and of each
+    confirmed candidate, and the TokaMaker results when confirm_candidates > 0.
+    """
+    from tokamak.pipeline import load_design
+
+    design = load_design(design)
+    start = time.perf_counter()
+    result = search_coils(design, confirm_candidates, seed, progress)
+    if confirm_candidates > 0:
+        progress(f"Confirming {len(result['candidates'])} candidates with TokaMaker")
+        picked = [(entry["score"], np.array(entry["coil_coordinates"])) for entry in result["candidates"]]
+        apply_confirmation(result, confirm(design, picked, workers, nthreads))
+    result["total_time"] = time.perf_counter() - start
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search coil positions for low coil currents and isoflux error")
+    parser.add_argument("design", help="Lock Design JSON")
+    parser.add_argument("-o", "--output", help="Write the design with the optimized coils here")
+    parser.add_argument("--confirm", type=int, default=CONFIRM_CANDIDATES,
+                        help="Candidates confirmed with TokaMaker (0 skips the full solves)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Processes for the confirmation solves")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with open(args.design) as f:
+        design = json.load(f)
+    result = optimize_coils(design, confirm_candidates=args.confirm, workers=args.workers, seed=args.seed)
+    initial, best = result["initial"], result["best"]
+    print(f"Peak current {initial['peak_current_ratio']:.2f} -> {best['peak_current_ratio']:.2f} of the 2*Ip limit, "
+          f"isoflux error {initial['isoflux_error']:.2e} -> {best['isoflux_error']:.2e} (linear model)")
+    if "confirmed" in best and best["confirmed"]["err_flag"] == 0:
+        solved = best["confirmed"]
+        print(f"TokaMaker: err_flag {solved['err_flag']}, peak current {solved['peak_current']/1E6:.2f} MA "
+              f"(limit {solved['current_limit']/1E6:.2f} MA)")
+    for i, (r, z) in enumerate(result["coil_coordinates"], 1):
+        print(f"  PF_{i}: R={r:.3f} Z={z:.3f}")
+    if args.output:
+        design["coil_coordinates"] = result["coil_coordinates"]
+        design.pop("validation", None)
+        with open(args.output, "w") as f:
+            json.dump(design, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# Mesh-resolution convergence study for a design
+#
+# The equilibrium and linear stability stages are run on a ladder of
+# meshes, every resolution (plasma_dx, coil_dx, vv_dx, vac_dx) being the
+# default times a scale that shrinks by RATIO per level, the levels spread
+# over worker processes as in a sweep (see tokamak.layout). For the growth
+# rate, q95 and beta_pol, Richardson extrapolation over the three finest
+# levels gives an estimate of the mesh-converged value and the observed
+# order of convergence; when the differences are not monotone the nominal
+# NOMINAL_ORDER is assumed. Each level's error is its relative distance
+# from the extrapolated values.
+#
+# The coarsest level whose every error is within the tolerance is chosen
+# and written into the design JSON as its "mesh_resolution", with the study
+# under "mesh_convergence", so later runs of that design (app, pipeline,
+# notebook) mesh at the chosen resolution. Every level's mesh size, mesh and
+# solve times, values and errors go to convergence.json:
+#
+#   python -m tokamak.convergence examples/negative_triangulation -o examples/testing_1 --tolerance 0.01
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from tokamak import layout, oft
+
+CONVERGENCE_FILENAME = "convergence.json"
+QUANTITIES = ("growth_rate", "q_95", "beta_pol")
+DEFAULT_TOLERANCE = 0.01
+COARSEST_SCALE = 2.0
+RATIO = math.sqrt(2.0)
+LEVELS = 5
+NOMINAL_ORDER = 2.0
+# Observed orders outside this range are taken as noise
+ORDER_RANGE = (0.5, 6.0)
+
+
+def level_scales(levels=LEVELS, coarsest=COARSEST_SCALE, ratio=RATIO):
+    """Resolution scale factors, coarsest first"""
+    return [coarsest/ratio**k for k in range(levels)]
+
+
+def scaled_resolution(scale):
+    from tokamak.pipeline import DEFAULT_RESOLUTION
+
+    return {name: round(dx*scale, 6) for name, dx in DEFAULT_RESOLUTION.items()}
+
+
+def evaluate_level(design, scale, nthreads=1):
+    """Mesh size, stage times and QUANTITIES of design meshed at scale times the default resolution"""
+    from tokamak import pipeline
+
+    oft.ensure_oft_path()
+    output_dir = tempfile.mkdtemp(prefix="tokamak_convergence_")
+    try:
+        run = pipeline.AnalysisRun({**design, "mesh_resolution": scaled_resolution(scale)}, output_dir,
+                                   nthreads=nthreads, scan_workers=1, export_workers=0)
+        pipeline.prepare_geometry(run)
+        pipeline.build_mesh(run)
+        pipeline.setup_tokamaker(run)
+        pipeline.solve_equilibrium(run)
+        pipeline.run_stability(run)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        "scale": scale,
+        "resolution": run.resolution,
+        "nodes": len(run.mesh_pts),
+        "cells": len(run.mesh_lc),
+        "mesh_cached": run.mesh_cached,
+        "mesh_time": run.timings["mesh"],
+        "solve_time": run.timings["setup"] + run.timings["equilibrium"] + run.timings["stability"],
+        "err_flag": int(run.err_flag),
+        "values": {"growth_rate": float(run.growth_rate), "q_95": float(run.eq_stats["q_95"]),
+                   "beta_pol": float(run.eq_stats["beta_pol"])},
+    }
+
+
+def _evaluate_level(args):
+    return evaluate_level(*args)
+
+
+def richardson(values, ratio=RATIO):
+    """Extrapolated value and order of convergence from values on levels refined by ratio, coarsest first
+
+    Uses the three finest levels; with fewer, or differences that are not
+    monotone, the order is NOMINAL_ORDER. Returns (value, order, observed).
+    """
+    values = [float(v) for v in values]
+    if len(values) < 2:
+        return values[-1], NOMINAL_ORDER, False
+    fine, medium = values[-1], values[-2]
+    if fine == medium:
+        return fine, NOMINAL_ORDER, False
+    order, observed = NOMINAL_ORDER, False
+    if len(values) >= 3:
+        coarse = values[-3]
+        change = (coarse - medium)/(medium - fine)
+        if change > 0.0:
+            p = math.log(change)/math.log(ratio)
+            if ORDER_RANGE[0] <= p <= ORDER_RANGE[1]:
+                order, observed = p, True
+    return fine + (fine - medium)/(ratio**order - 1.0), order, observed
+
+
+def analyse(levels, tolerance=DEFAULT_TOLERANCE, ratio=RATIO):
+    """Add relative errors to each level (coarsest first) and pick the coarsest within tolerance
+
+    Returns (extrapolated, chosen level index). Levels whose solve failed
+    are left out of the extrapolation and never chosen; if no level is
+    within tolerance the finest successful one is.
+    """
+    good = [level for level in levels if level["err_flag"] == 0]
+    if not good:
+        raise RuntimeError("No level of the convergence study solved without error")
+    extrapolated = {}
+    for quantity in QUANTITIES:
+        value, order, observed = richardson([level["values"][quantity] for level in good], ratio)
+        extrapolated[quantity] = {"value": value, "order": order, "observed_order": observed}
+    for level in levels:
+        level["errors"] = {quantity: abs(level["values"][quantity] - extrapolated[quantity]["value"])
+                           / max(abs(extrapolated[quantity]["value"]), 1E-30) for quantity in QUANTITIES}
+        level["max_error"] = max(level["errors"].values())
+    within = [i for i, level in enumerate(levels) if level["err_flag"] == 0 and level["max_error"] <= tolerance]
+    chosen = within[0] if within else levels.index(good[-1])
+    return extrapolated, chosen
+
+
+def run_study(design, scales=None, tolerance=DEFAULT_TOLERANCE, workers=None, nthreads=None, ratio=RATIO,
+              progress=print):
+    """Evaluate design at every scale (default level_scales()) in parallel and analyse the ladder
+
+    Returns the study as a dict: tolerance, levels (coarsest first, with
+    errors), extrapolated values and the chosen level and resolution.
+    """
+    from tokamak.pipeline import load_design
+
+    design = load_design(design)
+    scales = level_scales(ratio=ratio) if scales is None else sorted(scales, reverse=True)
+    planned = layout.plan("sweep")
+    workers = min(planned["workers"] if workers is None else workers, len(scales))
+    nthreads = planned["nthreads"] if nthreads is None else nthreads
+
+    start = time.perf_counter()
+    levels = {}
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers) as pool:
+        for level in pool.imap_unordered(_evaluate_level, [(design, scale, nthreads) for scale in scales]):
+            levels[level["scale"]] = level
+            progress(f"[{len(levels)}/{len(scales)}] scale {level['scale']:.3f}: {level['nodes']} nodes, "
+                     f"solved in {level['solve_time']:.2f} s")
+    levels = [levels[scale] for scale in scales]
+    extrapolated, chosen = analyse(levels, tolerance, ratio)
+    return {
+        "created": time.time(),
+        "tolerance": tolerance,
+        "ratio": ratio,
+        "workers": workers,
+        "nthreads": nthreads,
+        "elapsed": time.perf_counter() - start,
+        "levels": levels,
+        "extrapolated": extrapolated,
+        "chosen": chosen,
+        "mesh_resolution": levels[chosen]["resolution"],
+    }
+
+
+def save_choice(design_path, study):
+    """Write the chosen mesh_resolution and a summary of the study into the design JSON"""
+    with open(design_path) as f:
+        design = json.load(f)
+    chosen = study["levels"][study["chosen"]]
+    design["mesh_resolution"] = study["mesh_resolution"]
+    design["mesh_convergence"] = {
+        "created": study["created"],
+        "tolerance": study["tolerance"],
+        "scale": chosen["scale"],
+        "nodes": chosen["nodes"],
+        "errors": chosen["errors"],
+        "extrapolated": {quantity: entry["value"] for quantity, entry in study["extrapolated"].items()},
+    }
+    with open(design_path, "w") as f:
+        json.dump(design, f, indent=2)
+
+
+def format_study(study):
+    lines = [f"{'scale':>6s} {'nodes':>7s} {'mesh [s]':>9s} {'solve [s]':>9s} "
+             + " ".join(f"{q:>11s} {'err':>8s}" for q in QUANTITIES)]
+    for i, level in enumerate(study["levels"]):
+        row = f"{level['scale']:6.3f} {level['nodes']:7d} {level['mesh_time']:9.2f} {level['solve_time']:9.2f} "
+        row += " ".join(f"{level['values'][q]:11.5g} {level['errors'][q]:8.2%}" for q in QUANTITIES)
+        if level["err_flag"] != 0:
+            row += f"  err_flag {level['err_flag']}"
+        lines.append(row + ("  <- chosen" if i == study["chosen"] else ""))
+    extrapolated = study["extrapolated"]
+    lines.append(f"{'extrapolated':>34s} " + " ".join(
+        f"{extrapolated[q]['value']:11.5g} {'p=' + format(extrapolated[q]['order'], '.2f'):>8s}" for q in QUANTITIES))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    from tokamak.pipeline import latest_design_file
+
+    parser = argparse.ArgumentParser(description="Mesh-resolution convergence study and resolution choice for a design")
+    parser.add_argument("design", help="Design JSON, or a folder to take the newest design from")
+    parser.add_argument("-o", "--output", help="Folder for convergence.json (defaults to the design's folder)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Largest relative error of growth rate, q95 and beta_pol to accept")
+    parser.add_argument("--levels", type=int, default=LEVELS, help="Number of resolutions")
+    parser.add_argument("--coarsest", type=float, default=COARSEST_SCALE,
+                        help="Coarsest resolution, as a multiple of the default")
+    parser.add_argument("--ratio", type=float, default=RATIO, help="Refinement ratio between levels")
+    parser.add_argument("--workers", type=int, help="Levels solved at once (default: the planned layout)")
+    parser.add_argument("--nthreads", type=int, help="OFT threads per level (default: the planned layout)")
+    parser.add_argument("--no-save", action="store_true", help="Do not write the chosen resolution into the design")
+    args = parser.parse_args(argv)
+
+    design_path = latest_design_file(args.design) if os.path.isdir(args.design) else args.design
+    output_dir = args.output or os.path.dirname(os.path.abspath(design_path))
+    study = run_study(design_path, level_scales(args.levels, args.coarsest, args.ratio), args.tolerance,
+                      args.workers, args.nthreads, args.ratio)
+    study["design"] = design_path
+    print(format_study(study))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, CONVERGENCE_FILENAME), "w") as f:
+        json.dump(study, f, indent=2)
+    chosen = study["levels"][study["chosen"]]
+    print(f"Chosen: {study['mesh_resolution']} ({chosen['nodes']} nodes, max error {chosen['max_error']:.2%}, "
+          f"tolerance {study['tolerance']:.2%})")
+    if not args.no_save:
+        save_choice(design_path, study)
+        print(f"Saved to {design_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Background figure export for the pipeline
+#
+# Saving a figure at 300 dpi with bbox_inches='tight' rasterizes it twice and
+# takes seconds for the mode-structure and VDE overlay plots. FigureExporter
+# writes a low-dpi preview to the final filename straight away, so the app
+# and notebook have something to show, then pickles the figure to a pool of
+# spawned processes that write the full-resolution PNG (and optionally a
+# vector copy) and move it over the preview. The pipeline carries on with the
+# next stage meanwhile and only waits for the pool before writing its summary.
+
+import multiprocessing
+import os
+import pickle
+import time
+
+PREVIEW_DPI = 60
+DPI = 300
+VECTOR_FORMATS = ("pdf", "svg")
+# Keep a core free for the solver; a single-core machine exports in-line
+DEFAULT_WORKERS = min(2, max((os.cpu_count() or 1) - 1, 0))
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _savefig(fig, path, dpi):
+    """Save through a temporary name so readers never see a half-written file"""
+    stem, ext = os.path.splitext(path)
+    partial_path = stem + ".partial" + ext
+    try:
+        fig.savefig(partial_path, dpi=dpi, bbox_inches='tight', format=ext.lstrip("."))
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def _export_task(fig_bytes, paths, dpi):
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    fig = pickle.loads(fig_bytes)
+    for path in paths:
+        _savefig(fig, path, dpi)
+    plt.close(fig)
+    return start, time.perf_counter()
+
+
+class FigureExporter:
+    """Writes figures for one output folder, full resolution on a process pool
+
+    workers=0 saves every figure at full resolution on the calling thread.
+    timings maps each filename to its preview, queue and full-resolution
+    export seconds and final size in bytes. The pool is started on the
+    first submit and shut down by wait().
+    """
+
+    def __init__(self, output_dir, workers=DEFAULT_WORKERS, dpi=DPI, preview_dpi=PREVIEW_DPI, vector_format=None):
+        if vector_format is not None and vector_format not in VECTOR_FORMATS:
+            raise ValueError(f"vector_format must be one of {VECTOR_FORMATS}, got {vector_format!r}")
+        self.output_dir = output_dir
+        self.workers = workers
+        self.dpi = dpi
+        self.preview_dpi = preview_dpi
+        self.vector_format = vector_format
+        self.timings = {}
+        self.pool = None
+        self.pending = []
+        self.finished = []
+
+    def vector_filename(self, filename):
+        return None if self.vector_format is None else os.path.splitext(filename)[0] + "." + self.vector_format
+
+    def submit(self, fig, filename):
+        """Write filename now (a preview when exporting in the background), the rest later
+
+        The caller may close fig as soon as this returns.
+        """
+        path = os.path.join(self.output_dir, filename)
+        paths = [path]
+        if self.vector_format is not None:
+            paths.append(os.path.join(self.output_dir, self.vector_filename(filename)))
+
+        start = time.perf_counter()
+        fig_bytes = None
+        if self.workers > 0:
+            try:
+                fig_bytes = pickle.dumps(fig)
+            except Exception as e:
+                # Artists that cannot be pickled are rare; save those figures in-line
+                print(f"Exporting {filename} in-line, figure cannot be pickled: {e}")
+        if fig_bytes is None:
+            for p in paths:
+                _savefig(fig, p, self.dpi)
+            self.timings[filename] = {"preview": None, "queued": 0.0, "full": time.perf_counter() - start,
+                                      "bytes": os.path.getsize(path)}
+            self.finished.append(filename)
+            return
+
+        _savefig(fig, path, self.preview_dpi)
+        submitted = time.perf_counter()
+        self.timings[filename] = {"preview": submitted - start}
+        if self.pool is None:
+            context = multiprocessing.get_context("spawn")
+            self.pool = context.Pool(self.workers, initializer=_init_worker)
+        self.pending.append((filename, submitted, self.pool.apply_async(_export_task, (fig_bytes, paths, self.dpi))))
+
+    def wait(self):
+        """Block until every submitted figure is written at full resolution
+
+        Returns the filenames finished since the previous call; an export
+        that failed re-raises its error here.
+        """
+        finished, self.finished = self.finished, []
+        try:
+            for filename, submitted, result in self.pending:
+                started, done = result.get()
+                # perf_counter is system-wide on Linux, so worker and parent times compare
+                self.timings[filename].update(queued=max(started - submitted, 0.0), full=done - started,
+                                              bytes=os.path.getsize(os.path.join(self.output_dir, filename)))
+                finished.append(filename)
+        finally:
+            self.pending = []
+            self.close()
+        return finished
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
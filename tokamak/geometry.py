@@ -0,0 +1,162 @@
+# Vectorized polygon helpers shared by streamlit_app.py and AOE_tokamaker.ipynb
+#
+# Every function accepts plain lists of [R, Z] pairs (as stored in
+# st.session_state and the design JSON) or numpy arrays, and works on all
+# points at once instead of looping over coils/vertices in Python.
+# isoflux_points is OFT's create_isoflux in numpy, so the designer and the
+# geometry stage need no OFT install.
+
+import numpy as np
+
+
+def _as_points(points):
+    """Return points as a float (N, 2) array"""
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+
+def _edges(polygon):
+    """Return the start and end vertex of every (closed) polygon edge"""
+    start = _as_points(polygon)
+    end = np.roll(start, -1, axis=0)
+    return start, end
+
+
+def resize_polygon(points, dx):
+    """Offset a closed polygon by dx using the miter construction from AOE_tokamaker
+
+    Positive dx grows a counter-clockwise polygon outward. This is the same
+    formula as the original per-vertex loop, evaluated for all vertices at once.
+    """
+    points = _as_points(points)
+    last = np.roll(points, 1, axis=0)
+    next = np.roll(points, -1, axis=0)
+
+    par = points - last
+    par /= np.linalg.norm(par, axis=1)[:, None]
+    perp = np.column_stack((par[:, 1], -par[:, 0]))
+    par_2 = next - points
+    par_2 /= np.linalg.norm(par_2, axis=1)[:, None]
+    perp_2 = np.column_stack((par_2[:, 1], -par_2[:, 0]))
+
+    dot_perp2_par = np.einsum('ij,ij->i', perp_2, par)
+    dot_par2_perp = np.einsum('ij,ij->i', par_2, perp)
+    dot_par2_par = np.einsum('ij,ij->i', par_2, par)
+
+    temp = points + perp*dx
+    return temp + (dx/dot_perp2_par)[:, None]*par + par*(dx/dot_par2_perp*dot_par2_par)[:, None]
+
+
+def isoflux_points(npts, r0, z0, a, kappa, delta, kappaL=None, deltaL=None):
+    """npts plasma boundary points, as OpenFUSIONToolkit.TokaMaker.util.create_isoflux
+
+    kappaL and deltaL give the lower half its own elongation and
+    triangularity. The formula and its order of operations are the same as
+    the original per-point loop, so the points match it to the last bit.
+    """
+    kappaU, deltaU = kappa, delta
+    kappaL = kappaU if kappaL is None else kappaL
+    deltaL = deltaU if deltaL is None else deltaL
+    theta = np.arange(npts)*2.0*np.pi/npts
+    sin_theta = np.sin(theta)
+    delta = ((deltaU + deltaL) + (deltaU - deltaL)*sin_theta)/2
+    kappa = ((kappaU + kappaL) + (kappaU - kappaL)*sin_theta)/2
+    return np.column_stack((r0 + a*np.cos(theta + np.arcsin(delta)*sin_theta), z0 + a*(kappa*sin_theta)))
+
+
+def points_in_polygons(points, polygons):
+    """Ray-casting test of N points against M polygons in a single pass
+
+    polygons is a list of vertex lists (they may have different lengths).
+    Returns a bool array of shape (N, M), True where a point is inside.
+    The crossing rule matches the original point_in_polygon loop.
+    """
+    points = _as_points(points)
+    polygons = [_as_points(poly) for poly in polygons]
+    if len(points) == 0 or len(polygons) == 0:
+        return np.zeros((len(points), len(polygons)), dtype=bool)
+
+    starts, ends = zip(*(_edges(poly) for poly in polygons))
+    p1 = np.concatenate(starts)
+    p2 = np.concatenate(ends)
+    offsets = np.cumsum([0] + [len(poly) for poly in polygons[:-1]])
+
+    x = points[:, 0:1]
+    y = points[:, 1:2]
+    p1x, p1y = p1[:, 0], p1[:, 1]
+    p2x, p2y = p2[:, 0], p2[:, 1]
+
+    # An edge is crossed when it straddles y and the crossing lies at or right of x
+    straddles = (p1y < y) != (p2y < y)
+    dy = np.where(p2y == p1y, 1.0, p2y - p1y)
+    xinters = (y - p1y)*(p2x - p1x)/dy + p1x
+    crossings = straddles & (x <= xinters)
+
+    counts = np.add.reduceat(crossings.astype(np.int64), offsets, axis=1)
+    return (counts % 2) == 1
+
+
+def points_in_polygon(points, polygon):
+    """Ray-casting test of N points against one polygon, returns a bool array of shape (N,)"""
+    return points_in_polygons(points, [polygon])[:, 0]
+
+
+def point_in_polygon(point, polygon):
+    """Check if a single point is inside a polygon"""
+    return bool(points_in_polygon([point], polygon)[0])
+
+
+def signed_area(polygon):
+    """Shoelace area of a polygon, positive for counter-clockwise vertex order"""
+    start, end = _edges(polygon)
+    return 0.5*np.sum(start[:, 0]*end[:, 1] - end[:, 0]*start[:, 1])
+
+
+def nearest_edge_projection(points, polygon):
+    """Project every point onto the closest edge of a closed polygon
+
+    Returns (projected, edge_index, distance, outward_normal) where each
+    entry has one row per input point.
+    """
+    points = _as_points(points)
+    start, end = _edges(polygon)
+    seg = end - start
+    seg_len2 = np.einsum('ij,ij->i', seg, seg)
+    seg_len2 = np.where(seg_len2 > 0.0, seg_len2, 1.0)
+
+    # (N, E) parameter of the projection along every edge, clipped to the segment
+    rel = points[:, None, :] - start[None, :, :]
+    t = np.clip(np.einsum('nej,ej->ne', rel, seg)/seg_len2, 0.0, 1.0)
+    proj = start[None, :, :] + t[:, :, None]*seg[None, :, :]
+    dist = np.linalg.norm(points[:, None, :] - proj, axis=2)
+
+    edge_index = np.argmin(dist, axis=1)
+    rows = np.arange(len(points))
+    projected = proj[rows, edge_index]
+
+    # Right-hand normal is outward for counter-clockwise polygons
+    normals = np.column_stack((seg[:, 1], -seg[:, 0]))
+    normals /= np.sqrt(seg_len2)[:, None]
+    if signed_area(polygon) < 0.0:
+        normals = -normals
+    return projected, edge_index, dist[rows, edge_index], normals[edge_index]
+
+
+def find_invalid_coils(coil_coords, vv_coords, plasma_boundary):
+    """Return a bool mask of coils that sit inside the vacuum vessel or the plasma"""
+    inside = points_in_polygons(coil_coords, [vv_coords, plasma_boundary])
+    return inside.any(axis=1)
+
+
+def validate_coil_positions(coil_coords, vv_coords, plasma_boundary, safety_margin=0.5):
+    """Move invalid coils just outside the vacuum vessel
+
+    Coils inside the vessel (or plasma) are projected onto the nearest vessel
+    edge and pushed outward along that edge's normal by safety_margin.
+    """
+    coils = _as_points(coil_coords)
+    validated = coils.copy()
+    invalid = find_invalid_coils(coils, vv_coords, plasma_boundary)
+    if invalid.any():
+        projected, _, _, normals = nearest_edge_projection(coils[invalid], vv_coords)
+        validated[invalid] = projected + normals*safety_margin
+    return validated.tolist()
@@ -0,0 +1,140 @@
+# Axisymmetric Green's functions for coil flux and field
+#
+# The poloidal flux per radian (the psi TokaMaker reports) of a circular
+# filament carrying current I at (Rc, Zc) is
+#
+#   psi(R, Z) = mu0*I/(pi*k) * sqrt(R*Rc) * ((1 - k^2/2)*K(k^2) - E(k^2)),
+#   k^2 = 4*R*Rc/((R + Rc)^2 + (Z - Zc)^2)
+#
+# with K and E the complete elliptic integrals, and B_R = -dpsi/dZ/R,
+# B_Z = dpsi/dR/R. Everything here broadcasts, so the field of many coils
+# at many points is one array expression. A rectangular coil is the
+# average of a grid of filaments across its cross-section.
+#
+# VacuumField holds the unit-current field of every coil on a fixed R, Z
+# grid, so moving one coil only recomputes that coil's contribution.
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+MU0 = 4E-7*np.pi
+# Keep k^2 off 1, where K diverges (a point on the filament itself)
+MAX_K2 = 1.0 - 1E-12
+# Squared distance (m^2) below which a point counts as on the filament
+MIN_DISTANCE2 = 1E-8
+
+# Filaments per side used for a rectangular coil cross-section
+COIL_SUBDIVISIONS = 3
+
+# Grid of the design view's coil editor ranges
+FIELD_R_RANGE = (1.0, 8.0)
+FIELD_Z_RANGE = (-4.0, 4.0)
+FIELD_POINTS = 200
+FIELD_CACHE_SIZE = 64
+
+# A null is a local minimum of |B_p| below this fraction of its 95th percentile
+NULL_FRACTION = 0.02
+MAX_NULLS = 4
+
+
+def filament_psi(r, z, rc, zc):
+    """Flux per radian at (r, z) from a unit-current filament at (rc, zc), broadcast over all inputs"""
+    from scipy.special import ellipe, ellipk
+
+    r, z, rc, zc = (np.asarray(v, dtype=np.float64) for v in (r, z, rc, zc))
+    k2 = np.minimum(4.0*r*rc/((r + rc)**2 + (z - zc)**2), MAX_K2)
+    k = np.sqrt(k2)
+    return MU0/(np.pi*k)*np.sqrt(r*rc)*((1.0 - 0.5*k2)*ellipk(k2) - ellipe(k2))
+
+
+def filament_field(r, z, rc, zc):
+    """(psi, B_R, B_Z) at (r, z) from a unit-current filament at (rc, zc), broadcast over all inputs"""
+    from scipy.special import ellipe, ellipk
+
+    r, z, rc, zc = (np.asarray(v, dtype=np.float64) for v in (r, z, rc, zc))
+    dz = z - zc
+    far2 = (r + rc)**2 + dz**2
+    near2 = np.maximum((r - rc)**2 + dz**2, MIN_DISTANCE2)
+    k2 = np.minimum(4.0*r*rc/far2, MAX_K2)
+    K, E = ellipk(k2), ellipe(k2)
+    k = np.sqrt(k2)
+    psi = MU0/(np.pi*k)*np.sqrt(r*rc)*((1.0 - 0.5*k2)*K - E)
+    scale = MU0/(2.0*np.pi*np.sqrt(far2))
+    br = scale*dz/r*((rc**2 + r**2 + dz**2)/near2*E - K)
+    bz = scale*(K + (rc**2 - r**2 - dz**2)/near2*E)
+    return psi, br, bz
+
+
+def coil_field(r, z, rc, zc, width, height, subdivisions=COIL_SUBDIVISIONS):
+    """(psi, B_R, B_Z) per unit total current of a rectangular coil, as the mean of its filaments"""
+    offsets = (np.arange(subdivisions) + 0.5)/subdivisions - 0.5
+    total = None
+    for dr in offsets*width:
+        for dz in offsets*height:
+            field = filament_field(r, z, np.asarray(rc) + dr, np.asarray(zc) + dz)
+            total = field if total is None else tuple(t + f for t, f in zip(total, field))
+    return tuple(t/subdivisions**2 for t in total)
+
+
+class VacuumField:
+    """psi, B_R and B_Z of a set of coils on a fixed R, Z grid
+
+    The unit-current field of each coil is cached on its position, so an
+    edit that moves one coil computes one coil's field; coils missing from
+    the cache are computed together.
+    """
+
+    def __init__(self, r_range=FIELD_R_RANGE, z_range=FIELD_Z_RANGE, nr=FIELD_POINTS, nz=FIELD_POINTS,
+                 coil_size=None, max_coils=FIELD_CACHE_SIZE):
+        from tokamak.mesh_cache import COIL_SIZE
+
+        self.r = np.linspace(*r_range, nr)
+        self.z = np.linspace(*z_range, nz)
+        self.R, self.Z = np.meshgrid(self.r, self.z)
+        self.coil_size = COIL_SIZE if coil_size is None else coil_size
+        self.max_coils = max_coils
+        self._unit = OrderedDict()
+        self._lock = threading.Lock()
+        self.computed = 0
+
+    def unit_fields(self, coils):
+        """Array (ncoils, 3, nz, nr) of each coil's psi, B_R, B_Z per ampere"""
+        # Round away float noise from the editor so equal positions share a cache entry
+        keys = [(round(float(r), 9), round(float(z), 9)) for r, z in coils]
+        with self._lock:
+            missing = list(dict.fromkeys(key for key in keys if key not in self._unit))
+            if missing:
+                rc = np.array([r for r, _ in missing])[:, None, None]
+                zc = np.array([z for _, z in missing])[:, None, None]
+                fields = np.stack(coil_field(self.R[None], self.Z[None], rc, zc, self.coil_size, self.coil_size), axis=1)
+                for key, field in zip(missing, fields):
+                    field.setflags(write=False)
+                    self._unit[key] = field
+                self.computed += len(missing)
+            for key in keys:
+                self._unit.move_to_end(key)
+            while len(self._unit) > max(self.max_coils, len(keys)):
+                self._unit.popitem(last=False)
+            return np.stack([self._unit[key] for key in keys])
+
+    def field(self, coils, currents):
+        """(psi, B_R, B_Z) on the grid with coils carrying currents (A)"""
+        if len(coils) == 0:
+            return tuple(np.zeros_like(self.R) for _ in range(3))
+        return tuple(np.einsum("c,cij->ij", np.asarray(currents, dtype=np.float64), unit)
+                     for unit in self.unit_fields(coils).transpose(1, 0, 2, 3))
+
+    def nulls(self, br, bz, coils=(), max_nulls=MAX_NULLS):
+        """(R, Z) of poloidal field nulls: grid minima of |B_p| away from the coils and grid edges"""
+        from scipy.ndimage import minimum_filter
+
+        bp = np.hypot(br, bz)
+        candidates = (bp == minimum_filter(bp, size=5, mode="nearest")) & (bp < NULL_FRACTION*np.percentile(bp, 95))
+        candidates[[0, -1], :] = candidates[:, [0, -1]] = False
+        for rc, zc in coils:
+            candidates &= (np.abs(self.R - rc) > self.coil_size) | (np.abs(self.Z - zc) > self.coil_size)
+        rows, cols = np.nonzero(candidates)
+        order = np.argsort(bp[rows, cols])[:max_nulls]
+        return np.column_stack((self.r[cols[order]], self.z[rows[order]]))
@@ -0,0 +1,290 @@
+# Background analysis runs for the Streamlit app
+#
+# Each run executes tokamak.pipeline.run_pipeline in its own process so the
+# Streamlit script never blocks and OFT's global state stays out of the
+# server. The child appends progress events to progress.jsonl in the output
+# folder; the app polls that file incrementally. Cancellation is cooperative
+# (checked at every beta_p point, step_td step and GIF frame) with a hard
+# terminate if the child does not stop within CANCEL_GRACE_SECONDS.
+# Completed runs are added to the run index (tokamak/run_index.py). A job
+# can instead run the coil optimizer's TokaMaker confirmation of candidate
+# coil sets (task "coil_confirmation", see tokamak.coil_optimizer.confirm_job)
+# so those solves share the queue and limits too.
+#
+# A job is created queued and started later by tokamak.scheduler, which
+# passes the cores the run may use. The child pins itself to them and
+# applies the job's memory and CPU time limits (setrlimit) before importing
+# OFT, so its scan and export workers inherit both.
+
+import json
+import multiprocessing
+import os
+import resource
+import signal
+import time
+import traceback
+
+from tokamak import oft
+
+PROGRESS_FILENAME = "progress.jsonl"
+CANCEL_GRACE_SECONDS = 15.0
+
+TERMINAL_STAGES = ("completed", "cancelled", "failed")
+TASKS = ("analysis", "coil_confirmation")
+
+# Share of the run spent in each stage, used for the progress bar
+STAGE_WEIGHTS = [
+    ("mesh", 0.05),
+    ("setup", 0.02),
+    ("equilibrium", 0.05),
+    ("stability", 0.05),
+    ("beta_scan", 0.75),
+    ("gif", 0.08),
+]
+
+
+class ProgressLog:
+    """Append-only JSON-lines file of progress events
+
+    Calling the log writes an event; read_new() returns only the events
+    written since the previous call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def __call__(self, event):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(event) + "\n")
+            f.flush()
+
+    def read_new(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        # Only consume complete lines, a partially written event is read next time
+        end = chunk.rfind("\n") + 1
+        self.offset += len(chunk[:end].encode("utf-8"))
+        return [json.loads(line) for line in chunk[:end].splitlines() if line.strip()]
+
+
+def apply_limits(cpus=None, memory_mb=None, cpu_seconds=None):
+    """Pin this process to cpus and cap its data size and CPU time; unsupported limits are skipped
+
+    The memory cap is RLIMIT_DATA (heap and private mappings) rather than
+    RLIMIT_AS, which the threads' reserved address space would exhaust.
+    Past cpu_seconds the process gets SIGXCPU, then SIGKILL 5 s later.
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    if memory_mb:
+        limit = int(memory_mb*1024**2)
+        resource.setrlimit(getattr(resource, "RLIMIT_DATA", resource.RLIMIT_AS), (limit, limit))
+    if cpu_seconds:
+        resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_seconds), int(cpu_seconds) + 5))
+
+
+def _job_main(design, output_dir, nthreads, scan_workers, worker_threads, cancel_event, limits, task, task_args):
+    log = ProgressLog(os.path.join(output_dir, PROGRESS_FILENAME))
+    try:
+        apply_limits(**limits)
+        if task == "coil_confirmation":
+            from tokamak.coil_optimizer import confirm_job
+
+            confirm_job(design, output_dir=output_dir, nthreads=nthreads, reporter=log, cancel_event=cancel_event,
+                        **task_args)
+            return
+        from tokamak.pipeline import run_pipeline
+        from tokamak.run_index import RunIndex
+
+        run_pipeline(design, output_dir, nthreads=nthreads, reporter=log, cancel_event=cancel_event,
+                     scan_workers=scan_workers, worker_threads=worker_threads, run_index=RunIndex())
+    except MemoryError:
+        limit = limits.get("memory_mb")
+        message = f"Run exceeded its memory limit of {limit:.0f} MB" if limit else "Run ran out of memory"
+        log({"time": time.time(), "stage": "failed", "message": message, "traceback": traceback.format_exc()})
+        raise SystemExit(1)
+    except Exception as e:
+        log({"time": time.time(), "stage": "failed", "message": str(e), "traceback": traceback.format_exc()})
+        raise SystemExit(1)
+
+
+class AnalysisJob:
+    """One pipeline run in a background process, polled from the Streamlit script
+
+    owner is the session that submitted it (tokamak.scheduler shares the
+    workers fairly between owners); memory_mb and cpu_seconds are the
+    limits applied in the child, None for none. task is one of TASKS, with
+    task_args its keyword arguments besides the design. group identifies
+    the jobs tokamak.scheduler queued together (see submit_group).
+    """
+
+    def __init__(self, design, output_dir, nthreads=oft.DEFAULT_NTHREADS, scan_workers=1, worker_threads=None,
+                 owner=None, memory_mb=None, cpu_seconds=None, task="analysis", task_args=None):
+        if task not in TASKS:
+            raise ValueError(f"task must be one of {TASKS}, got {task!r}")
+        self.task = task
+        self.task_args = task_args or {}
+        self.design = design
+        self.output_dir = output_dir
+        self.nthreads = nthreads
+        self.scan_workers = scan_workers
+        self.worker_threads = worker_threads
+        self.owner = owner
+        self.group = None
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        os.makedirs(output_dir, exist_ok=True)
+        progress_path = os.path.join(output_dir, PROGRESS_FILENAME)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        self.log = ProgressLog(progress_path)
+        self.events = []
+        self.outputs = []
+
+        # spawn keeps the child free of the server's threads and imported state
+        self.context = multiprocessing.get_context("spawn")
+        self.cancel_event = self.context.Event()
+        self.process = None
+        self.cpus = None
+        self.submitted = time.time()
+        self.started = None
+        self.cancel_requested = None
+        self._status = None
+
+    def start(self, cpus=None):
+        """Start the run, pinned to the cores in cpus (None: any)"""
+        self.cpus = cpus
+        limits = {"cpus": cpus, "memory_mb": self.memory_mb, "cpu_seconds": self.cpu_seconds}
+        self.process = self.context.Process(target=_job_main, args=(
+            self.design, self.output_dir, self.nthreads, self.scan_workers, self.worker_threads, self.cancel_event,
+            limits, self.task, self.task_args))
+        self.started = time.time()
+        self.process.start()
+        return self
+
+    @property
+    def exitcode(self):
+        return None if self.process is None else self.process.exitcode
+
+    def _finish(self, stage, message):
+        event = {"time": time.time(), "stage": stage, "message": message}
+        self.log(event)
+        self.events.append(event)
+        self._status = stage
+
+    def cancel(self):
+        """Ask the run to stop at its next progress point; a queued run is cancelled at once"""
+        if self.cancel_requested is None:
+            self.cancel_requested = time.time()
+            self.cancel_event.set()
+            if self.process is None:
+                self._finish("cancelled", "Run cancelled before it started")
+
+    def terminate(self):
+        """Stop the run immediately, without waiting for a checkpoint"""
+        self.cancel()
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+
+    def poll(self):
+        """Read new progress events, returning them, and enforce the cancel deadline"""
+        if self.process is None:
+            return []
+        new_events = self.log.read_new()
+        self.events.extend(new_events)
+        for event in new_events:
+            if event.get("stage") == "output":
+                self.outputs.append(event["file"])
+            if event.get("stage") in TERMINAL_STAGES:
+                self._status = event["stage"]
+
+        if (self.cancel_requested is not None and self.process.is_alive()
+                and time.time() - self.cancel_requested > CANCEL_GRACE_SECONDS):
+            # The child is stuck inside a solver call, stop it outright
+            self.process.terminate()
+            self.process.join(timeout=5)
+            self._finish("cancelled", "Run terminated")
+
+        exitcode = self.process.exitcode
+        if self._status is None and exitcode is not None:
+            if exitcode == 0:
+                self._status = "completed"
+            elif exitcode in (-signal.SIGXCPU, -signal.SIGKILL) and self.cpu_seconds:
+                self._finish("failed", f"Run exceeded its CPU time limit of {self.cpu_seconds:.0f} s")
+            else:
+                self._status = "failed"
+        return new_events
+
+    @property
+    def status(self):
+        """queued, running, cancelling, completed, cancelled or failed"""
+        if self._status is not None:
+            return self._status
+        if self.process is None:
+            return "queued"
+        return "cancelling" if self.cancel_requested is not None else "running"
+
+    @property
+    def finished(self):
+        return self.status in TERMINAL_STAGES
+
+    @property
+    def elapsed(self):
+        end = self.events[-1]["time"] if self.finished and self.events else time.time()
+        return end - (self.started or end)
+
+    @property
+    def waited(self):
+        """Seconds between submission and start (so far, while queued)"""
+        return (self.started or time.time()) - self.submitted
+
+    def latest(self, stage=None):
+        """Most recent event, optionally restricted to one stage"""
+        for event in reversed(self.events):
+            if stage is None or event.get("stage") == stage:
+                return event
+        return None
+
+    def fraction_done(self):
+        """Estimated fraction of the run completed, from the stage weights"""
+        return estimate_progress(self.events)
+
+
+def estimate_progress(events):
+    """Map a list of progress events onto 0..1 using STAGE_WEIGHTS"""
+    if any(event.get("stage") == "completed" for event in events):
+        return 1.0
+    stage_names = [name for name, _ in STAGE_WEIGHTS]
+    reached = -1
+    fraction_in_stage = 0.0
+    scan_point = None
+    for event in events:
+        stage = event.get("stage")
+        if stage == "step_td":
+            stage = "beta_scan"
+        if stage not in stage_names:
+            continue
+        index = stage_names.index(stage)
+        if index < reached:
+            continue
+        reached = index
+        step, total = event.get("step"), event.get("total")
+        if event.get("stage") == "beta_scan" and total:
+            scan_point = (step, total)
+            fraction_in_stage = step/total
+        elif event.get("stage") == "step_td" and total and scan_point is not None:
+            point, npoints = scan_point
+            fraction_in_stage = (point + (step + 1)/total)/npoints
+        elif total:
+            fraction_in_stage = (step + 1)/total
+        else:
+            fraction_in_stage = 0.0
+    if reached < 0:
+        return 0.0
+    done = sum(weight for _, weight in STAGE_WEIGHTS[:reached])
+    return min(1.0, done + STAGE_WEIGHTS[reached][1]*fraction_in_stage)
@@ -0,0 +1,242 @@
+# Thread/process layout of the OFT solvers
+#
+# OFT_env fixes its thread count when it is created, and TokaMaker on the
+# meshes used here stops speeding up after a few threads, so how the cores
+# are best split depends on the work:
+#
+#   equilibrium  one solver (a single run, the notebook): the thread count
+#                with the fastest solve
+#   scan         the beta_p scan: as many worker processes as fit with the
+#                thread count that needs the fewest core-seconds per solve,
+#                one process with the fastest thread count if only one fits
+#   sweep        independent designs (sweeps, the app's analysis queue):
+#                as many workers as fit, each with the fewest-core-seconds
+#                thread count
+#
+# available_cores() is the smaller of the process's affinity mask and its
+# cgroup CPU quota (cgroup v2 cpu.max or v1 cpu.cfs_quota_us), so a
+# container limited to 2 CPUs on a 64-core host plans for 2.
+#
+# Calibration times a cold equilibrium solve on a design's mesh at 1, 2,
+# 4, ... threads, each thread count in a fresh process (OFT_env can only be
+# created once per process), and stores the timings and both best thread
+# counts per machine in .cache/layout.json:
+#
+#   python -m tokamak.layout calibrate examples/negative_triangulation
+#   python -m tokamak.layout show
+#
+# Without a calibration plan() assumes oft.DEFAULT_NTHREADS threads for a
+# single solver and one thread per worker process.
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from tokamak import CACHE_DIR, oft
+
+LAYOUT_PATH = os.path.join(CACHE_DIR, "layout.json")
+WORKLOADS = ("equilibrium", "scan", "sweep")
+CALIBRATION_REPEAT = 3
+# The beta_p scan has this many points, more scan workers would sit idle
+SCAN_POINTS = 10
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """CPUs allowed by the cgroup CPU quota, None when there is no quota"""
+    cpu_max = _read(CGROUP_V2_CPU_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota)/int(period)
+        return None
+    quota, period = _read(CGROUP_V1_QUOTA), _read(CGROUP_V1_PERIOD)
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota)/int(period)
+    return None
+
+
+def available_cores():
+    """Cores this process can use: its affinity mask, capped by the cgroup quota (at least 1)"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cores = min(cores, math.floor(quota))
+    return max(1, cores)
+
+
+def machine_key(cores=None):
+    """Calibrations are stored per host and core count, a resized container is a new machine"""
+    return f"{platform.node()}:{available_cores() if cores is None else cores}"
+
+
+def load_layout(path=LAYOUT_PATH, cores=None):
+    """This machine's stored calibration, or None"""
+    text = _read(path)
+    if text is None:
+        return None
+    try:
+        return json.loads(text).get(machine_key(cores))
+    except ValueError:
+        return None
+
+
+def save_layout(entry, path=LAYOUT_PATH, cores=None):
+    text = _read(path)
+    layouts = {}
+    if text is not None:
+        try:
+            layouts = json.loads(text)
+        except ValueError:
+            pass
+    layouts[machine_key(cores)] = entry
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(layouts, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def plan(workload, cores=None, layout=None):
+    """Threads per solver and worker processes for a workload (see WORKLOADS)
+
+    Returns a dict with "cores" and, for equilibrium, "nthreads"; for scan,
+    "nthreads" (the main process), "scan_workers" and "worker_threads"; for
+    sweep, "workers" and "nthreads" per worker. layout defaults to this
+    machine's stored calibration.
+    """
+    if workload not in WORKLOADS:
+        raise ValueError(f"workload must be one of {WORKLOADS}, got {workload!r}")
+    cores = available_cores() if cores is None else cores
+    layout = load_layout(cores=cores) if layout is None else layout
+    latency_threads = min(layout["latency_threads"] if layout else oft.DEFAULT_NTHREADS, cores)
+    throughput_threads = min(layout["throughput_threads"] if layout else 1, cores)
+
+    if workload == "equilibrium":
+        return {"cores": cores, "nthreads": latency_threads}
+    if workload == "scan":
+        workers = min(cores//throughput_threads, SCAN_POINTS)
+        if workers < 2:
+            return {"cores": cores, "nthreads": latency_threads, "scan_workers": 1, "worker_threads": latency_threads}
+        return {"cores": cores, "nthreads": latency_threads, "scan_workers": workers,
+                "worker_threads": throughput_threads}
+    return {"cores": cores, "workers": max(1, cores//throughput_threads), "nthreads": throughput_threads}
+
+
+def thread_counts(cores):
+    """1, 2, 4, ... up to cores, plus cores itself"""
+    counts = [2**i for i in range(int(math.log2(cores)) + 1)]
+    return counts if counts[-1] == cores else counts + [cores]
+
+
+def _time_solve(design, nthreads, repeat):
+    """Seconds per cold equilibrium solve with nthreads OFT threads (run in a fresh process)"""
+    from tokamak import pipeline
+
+    oft.ensure_oft_path()
+    output_dir = tempfile.mkdtemp(prefix="tokamak_layout_")
+    try:
+        run = pipeline.AnalysisRun(design, output_dir, nthreads=nthreads, scan_workers=1, export_workers=0)
+        pipeline.prepare_geometry(run)
+        pipeline.build_mesh(run)
+        pipeline.setup_tokamaker(run)
+        pipeline.solve_equilibrium(run)
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            pipeline.solve_equilibrium(run)
+            seconds.append(time.perf_counter() - start)
+        return float(np.median(seconds))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def calibrate(design, counts=None, repeat=CALIBRATION_REPEAT, path=LAYOUT_PATH, log=print):
+    """Time a cold equilibrium solve of design at each thread count and store the best layout
+
+    Returns the stored entry: the timings and latency_threads (fastest
+    solve) and throughput_threads (fewest core-seconds per solve).
+    """
+    from tokamak.pipeline import load_design
+
+    design = load_design(design)
+    cores = available_cores()
+    counts = thread_counts(cores) if counts is None else sorted(n for n in counts if n <= cores)
+    context = multiprocessing.get_context("spawn")
+    timings = {}
+    for nthreads in counts:
+        with context.Pool(1) as pool:
+            timings[nthreads] = pool.apply(_time_solve, (design, nthreads, repeat))
+        log(f"  {nthreads:3d} threads: {timings[nthreads]*1E3:9.1f} ms per solve")
+    entry = {
+        "cores": cores,
+        "calibrated": time.time(),
+        "mesh_resolution": design.get("mesh_resolution"),
+        "seconds": {str(n): s for n, s in timings.items()},
+        "latency_threads": min(timings, key=timings.get),
+        "throughput_threads": min(timings, key=lambda n: timings[n]*n),
+    }
+    save_layout(entry, path, cores)
+    return entry
+
+
+def format_plans(cores=None, layout=None):
+    lines = []
+    for workload in WORKLOADS:
+        planned = plan(workload, cores, layout)
+        lines.append(f"  {workload:12s} " + ", ".join(f"{k} {v}" for k, v in planned.items() if k != "cores"))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    from tokamak.pipeline import latest_design_file
+
+    parser = argparse.ArgumentParser(description="Plan and calibrate OFT threads and worker processes")
+    parser.add_argument("--layout", default=LAYOUT_PATH, help="JSON file of calibrations per machine")
+    commands = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = commands.add_parser("calibrate", help="Time a solve at several thread counts and store the best")
+    calibrate_parser.add_argument("design", help="Design JSON, or a folder to take the newest design from")
+    calibrate_parser.add_argument("--threads", type=int, nargs="+", help="Thread counts to time (default 1, 2, 4, ...)")
+    calibrate_parser.add_argument("--repeat", type=int, default=CALIBRATION_REPEAT, help="Timed solves per thread count")
+    commands.add_parser("show", help="Print the cores, the stored calibration and the planned layouts")
+    args = parser.parse_args(argv)
+
+    cores = available_cores()
+    quota = cgroup_cpu_limit()
+    print(f"{machine_key(cores)}: {cores} cores" + (f" (cgroup quota {quota:g} CPUs)" if quota is not None else ""))
+    if args.command == "calibrate":
+        design_path = latest_design_file(args.design) if os.path.isdir(args.design) else args.design
+        layout = calibrate(design_path, args.threads, args.repeat, args.layout)
+    else:
+        layout = load_layout(args.layout, cores)
+    if layout is None:
+        print("Not calibrated, using the default layout")
+    else:
+        print(f"Calibrated {time.strftime('%Y-%m-%d %H:%M', time.localtime(layout['calibrated']))}: fastest solve "
+              f"with {layout['latency_threads']} threads, fewest core-seconds with {layout['throughput_threads']}")
+    print(format_plans(cores, layout))
+
+
+if __name__ == "__main__":
+    main()
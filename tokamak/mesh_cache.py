@@ -0,0 +1,200 @@
+# Content-addressed cache of TokaMaker meshes
+#
+# A mesh only depends on the vessel boundary, its offset outer wall, the coil
+# rectangles and the region resolutions. Those are hashed into a key and the
+# mesh is stored as <key>.h5 in the save_gs_mesh format (the same layout as
+# inspiration_code/CUTE_mesh.h5), so runs that only change B0, Ip or the
+# profile exponents reuse the mesh instead of calling build_mesh() again.
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from tokamak import CACHE_DIR
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(CACHE_DIR, "meshes")
+DEFAULT_MAX_BYTES = 500*1024**2
+
+# Geometry constants used by AOE_tokamaker when defining regions
+COIL_SIZE = 0.3
+VV_ETA = 6.9E-7
+
+
+def canonical(value):
+    """Convert arrays and floats into a JSON-stable form for hashing"""
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, np.ndarray):
+        return canonical(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, (float, np.floating)):
+        return format(float(value), ".9g")
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def mesh_key(vv_boundary, vv_outer, coil_rects, resolutions, vv_eta=VV_ETA):
+    """Hash the inputs that determine a mesh
+
+    coil_rects is a list of (R, Z, width, height) and resolutions a dict with
+    plasma_dx, coil_dx, vv_dx and vac_dx.
+    """
+    payload = {
+        "version": CACHE_VERSION,
+        "vv_boundary": canonical(np.asarray(vv_boundary, dtype=np.float64)),
+        "vv_outer": canonical(np.asarray(vv_outer, dtype=np.float64)),
+        "coil_rects": canonical(np.asarray(coil_rects, dtype=np.float64)),
+        "resolutions": canonical(dict(resolutions)),
+        "vv_eta": canonical(vv_eta),
+    }
+    blob = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def mesh_digest(mesh_pts, mesh_lc, mesh_reg, coil_dict, cond_dict):
+    """Checksum of mesh contents, used to detect truncated or corrupted cache files"""
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(mesh_pts, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(mesh_lc, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(mesh_reg, dtype=np.int64).tobytes())
+    h.update(json.dumps(canonical(coil_dict), sort_keys=True).encode("utf-8"))
+    h.update(json.dumps(canonical(cond_dict), sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+class MeshCache:
+    """Size-bounded, least-recently-used store of meshes keyed by mesh_key()
+
+    Each entry is one HDF5 file written by save_gs_mesh with the content
+    digest stored as a file attribute. File mtimes track recency.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.h5")
+
+    def get(self, key):
+        """Return (mesh_pts, mesh_lc, mesh_reg, coil_dict, cond_dict) or None on a miss
+
+        Entries that fail the integrity check are deleted and reported as a miss.
+        """
+        import h5py
+        from OpenFUSIONToolkit.TokaMaker.meshing import load_gs_mesh
+
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with h5py.File(path, "r") as f:
+                expected = f.attrs.get("digest")
+            mesh = load_gs_mesh(path)
+        except Exception:
+            self._discard(path)
+            return None
+        if expected is None or mesh_digest(*mesh) != expected:
+            self._discard(path)
+            return None
+        os.utime(path)
+        return mesh
+
+    def put(self, key, mesh_pts, mesh_lc, mesh_reg, coil_dict, cond_dict):
+        """Store a mesh under key, then evict old entries beyond max_bytes"""
+        import h5py
+        from OpenFUSIONToolkit.TokaMaker.meshing import load_gs_mesh, save_gs_mesh
+
+        # Write to a temporary name so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(suffix=".h5", dir=self.cache_dir)
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            save_gs_mesh(mesh_pts, mesh_lc, mesh_reg, coil_dict, cond_dict, tmp_path)
+            # Digest what load_gs_mesh returns so get() compares like with like
+            digest = mesh_digest(*load_gs_mesh(tmp_path))
+            with h5py.File(tmp_path, "a") as f:
+                f.attrs["digest"] = digest
+                f.attrs["key"] = key
+            os.replace(tmp_path, self.path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def entries(self):
+        """List (path, size, mtime) for every cached mesh, oldest first"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".h5"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        """Delete least-recently-used meshes until the cache fits in max_bytes"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            self._discard(path)
+            total -= size
+
+    def _discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def build_mesh(vv_boundary, vv_outer, coil_locs, plasma_dx, coil_dx, vv_dx, vac_dx):
+    """Define and mesh the AOE_tokamaker geometry, returning the gs_Domain and mesh arrays"""
+    from OpenFUSIONToolkit.TokaMaker.meshing import gs_Domain
+
+    mesh = gs_Domain()
+    mesh.define_region('air', vac_dx, 'boundary')
+    mesh.define_region('vv', vv_dx, 'conductor', eta=VV_ETA)
+    mesh.define_region('plasma', plasma_dx, 'plasma')
+    for i in range(1, len(coil_locs) + 1):
+        mesh.define_region('PF_' + str(i), coil_dx, 'coil')
+
+    mesh.add_annulus(vv_boundary, 'plasma', vv_outer, 'vv', parent_name='air')
+    for i in range(1, len(coil_locs) + 1):
+        mesh.add_rectangle(coil_locs[i-1, 0], coil_locs[i-1, 1], COIL_SIZE, COIL_SIZE, 'PF_' + str(i), parent_name='air')
+
+    mesh_pts, mesh_lc, mesh_reg = mesh.build_mesh()
+    return mesh, (mesh_pts, mesh_lc, mesh_reg, mesh.get_coils(), mesh.get_conductors())
+
+
+def get_mesh(vv_boundary, vv_outer, coil_locs, plasma_dx, coil_dx, vv_dx, vac_dx, cache=None):
+    """Load the mesh for this geometry from the cache, building and storing it on a miss
+
+    Returns (mesh_arrays, gs_domain, key); gs_domain is None on a cache hit
+    because no domain was constructed.
+    """
+    cache = MeshCache() if cache is None else cache
+    coil_locs = np.asarray(coil_locs, dtype=np.float64)
+    coil_rects = [(r, z, COIL_SIZE, COIL_SIZE) for r, z in coil_locs]
+    resolutions = {"plasma_dx": plasma_dx, "coil_dx": coil_dx, "vv_dx": vv_dx, "vac_dx": vac_dx}
+    key = mesh_key(vv_boundary, vv_outer, coil_rects, resolutions)
+
+    mesh_arrays = cache.get(key)
+    if mesh_arrays is not None:
+        return mesh_arrays, None, key
+
+    domain, mesh_arrays = build_mesh(vv_boundary, vv_outer, coil_locs, plasma_dx, coil_dx, vv_dx, vac_dx)
+    cache.put(key, *mesh_arrays)
+    return mesh_arrays, domain, key
@@ -0,0 +1,56 @@
+# Access to the OpenFUSIONToolkit install used by the notebook and the app
+#
+# OFT keeps global Fortran state, so one OFT_env and one TokaMaker object are
+# shared per process. TokaMaker.reset() is called before each new mesh.
+# OFT's thread count is fixed when the OFT_env is created, so asking for a
+# different one later only warns.
+
+import os
+import sys
+import warnings
+
+DEFAULT_NTHREADS = 2
+
+_oft_env = None
+_oft_env_nthreads = None
+_tokamaker = None
+_tokamaker_used = False
+
+
+def ensure_oft_path():
+    """Point OFT_ROOTPATH at ~/OpenFUSIONToolkit/install_release and make its python package importable"""
+    home_dir = os.path.expanduser("~")
+    oft_root_path = os.environ.setdefault("OFT_ROOTPATH", os.path.join(home_dir, "OpenFUSIONToolkit/install_release"))
+    python_path = os.path.join(oft_root_path, "python")
+    if python_path not in sys.path:
+        sys.path.append(python_path)
+
+
+def get_oft_env(nthreads=DEFAULT_NTHREADS):
+    """Create the process-wide OFT_env on first use
+
+    Later calls return the same OFT_env and warn if nthreads differs from
+    the thread count it was created with.
+    """
+    global _oft_env, _oft_env_nthreads
+    if _oft_env is None:
+        ensure_oft_path()
+        from OpenFUSIONToolkit import OFT_env
+        _oft_env = OFT_env(nthreads=nthreads)
+        _oft_env_nthreads = nthreads
+    elif nthreads != _oft_env_nthreads:
+        warnings.warn(f"OFT_env already created with {_oft_env_nthreads} threads in this process, "
+                      f"ignoring nthreads={nthreads}", RuntimeWarning, stacklevel=2)
+    return _oft_env
+
+
+def get_tokamaker(nthreads=DEFAULT_NTHREADS):
+    """Return the process-wide TokaMaker, reset so a new mesh can be loaded"""
+    global _tokamaker, _tokamaker_used
+    if _tokamaker is None:
+        from OpenFUSIONToolkit.TokaMaker import TokaMaker
+        _tokamaker = TokaMaker(get_oft_env(nthreads))
+    elif _tokamaker_used:
+        _tokamaker.reset()
+    _tokamaker_used = True
+    return _tokamaker
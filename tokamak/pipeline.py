@@ -0,0 +1,1127 @@
+# In-process version of the AOE_tokamaker analysis
+#
+# The notebook stages are plain functions that read and update an AnalysisRun:
+#
+#   run = AnalysisRun(load_design("design.json"), "examples/testing_1")
+#   prepare_geometry(run)
+#   build_mesh(run)
+#   setup_tokamaker(run)
+#   solve_equilibrium(run)
+#   run_stability(run)
+#   run_beta_scan(run)
+#   render_outputs(run)
+#
+# run_pipeline() chains them for the Streamlit app and the command line, and
+# AOE_tokamaker.ipynb calls the same stages one cell at a time.
+#
+# Command line:
+#   python -m tokamak.pipeline examples/negative_triangulation/design_20250630_171055.json -o examples/testing_1
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from tokamak import oft, stability
+from tokamak.export import FigureExporter
+from tokamak.geometry import find_invalid_coils, isoflux_points, resize_polygon
+from tokamak.mesh_cache import get_mesh
+from tokamak.profiling import CHROME_TRACE_FILENAME, TRACE_FILENAME, Tracer
+from tokamak.run_store import STORE_FILENAME, RunStore
+
+# Mesh resolution used unless the design carries its own "mesh_resolution"
+DEFAULT_RESOLUTION = {
+    "plasma_dx": 0.15,
+    "coil_dx": 0.15,
+    "vv_dx": 0.15,
+    "vac_dx": 0.25,
+}
+
+DEFAULT_ADVANCED_SETTINGS = {
+    "B0": 11.0,
+    "Ip_target": 8E6,
+    "Ip_ratio_target": 0.333,
+    "ffp_alpha": 2.15,
+    "ffp_gamma": 1.7,
+    "pp_alpha": 2.15,
+    "pp_gamma": 1.7,
+}
+
+ISOFLUX_POINTS = 30
+# Finite element order of the TokaMaker solve
+FE_ORDER = 2
+VV_WALL_THICKNESS = 0.04
+BETA_SCAN = np.linspace(0.01, 0.5, 10)
+
+# beta_p targeting: "continuation" warm-starts each point from the previous
+# converged psi and stops on tolerance, "fixed" repeats the notebook's four
+# corrections from init_psi
+BETA_SOLVERS = ("continuation", "fixed")
+BETA_TOL = 1.E-3
+BETA_MAX_SOLVES = 8
+VDE_STEPS = 30
+
+# Nonlinear VDE time stepping: "adaptive" sizes dt from the O-point motion and
+# solver effort and stops on events, "fixed" takes VDE_STEPS steps of
+# 0.2/gamma. Times below are in growth times 1/gamma of the unstable mode.
+VDE_STEPPERS = ("adaptive", "fixed")
+VDE_DT = 0.2
+VDE_DT_RANGE = (0.05, 0.5)  # implicit steps much past 0.5 distort the growth
+VDE_MAX_TIME = 12.0         # the fixed schedule covers 6
+VDE_MAX_STEPS = 60
+VDE_DZ_TARGET = 0.02        # O-point motion per step, fraction of the vessel half-height
+VDE_WALL_FRACTION = 0.5     # |dZ| that counts as reaching the wall, same units
+VDE_SATURATION = 0.1        # Z velocity, as a fraction of its peak, that counts as saturated
+VDE_SATURATION_STEPS = 3
+
+STAGES = ["geometry", "mesh", "setup", "equilibrium", "stability", "beta_scan", "render", "export"]
+
+PLOT_STYLE = {
+    'figure.figsize': (6, 6),
+    'font.weight': 'bold',
+    'axes.labelweight': 'bold',
+    'lines.linewidth': 2,
+    'lines.markeredgewidth': 2,
+}
+
+SUMMARY_FILENAME = "run_summary.json"
+
+# OFT holds global solver state, so only one run may use it at a time per process
+_solver_lock = threading.Lock()
+
+
+class RunCancelled(Exception):
+    """Raised at the next progress point after a run has been asked to stop"""
+
+
+def load_design(source):
+    """Return a design dict from a dict or a path to a Lock Design JSON file
+
+    Missing advanced settings and mesh resolutions are filled with the defaults.
+    """
+    if isinstance(source, dict):
+        design = json.loads(json.dumps(source))
+    else:
+        with open(source, 'r') as f:
+            design = json.load(f)
+    for key in ("plasma_parameters", "vacuum_vessel", "coil_coordinates"):
+        if key not in design:
+            raise ValueError(f"Design is missing '{key}'")
+    design["advanced_settings"] = {**DEFAULT_ADVANCED_SETTINGS, **design.get("advanced_settings", {})}
+    design["mesh_resolution"] = {**DEFAULT_RESOLUTION, **design.get("mesh_resolution", {})}
+    return design
+
+
+def latest_design_file(folder):
+    """Newest design_*.json in folder (the file names carry a sortable timestamp)"""
+    json_files = sorted(
+        (f for f in os.listdir(folder) if f.startswith("design_") and f.endswith(".json")),
+        reverse=True
+    )
+    if not json_files:
+        raise FileNotFoundError(f"No design JSON files found in {folder}")
+    return os.path.join(folder, json_files[0])
+
+
+class AnalysisRun:
+    """State shared by the pipeline stages for one design
+
+    Stages fill in attributes as they go; timings maps stage name to wall
+    seconds, tracer records the stages and the solver calls inside them
+    (see tokamak.profiling) and outputs lists the files written to
+    output_dir.
+
+    reporter, if given, is called with a dict for every progress event, and
+    cancel_event (anything with is_set()) stops the run at the next progress
+    point by raising RunCancelled. scan_workers > 1 runs the beta_p scan in
+    that many processes with worker_threads OFT threads each (default
+    nthreads). nthreads and scan_workers left as None come from the
+    machine's planned layout (see tokamak.layout). beta_solver picks how
+    each scan point hits its beta_p target (see BETA_SOLVERS) and
+    vde_stepper how its VDE is integrated (see VDE_STEPPERS). The VDE
+    animation is written as animation_format using animation_workers
+    processes. Figures are written at full resolution on export_workers
+    processes (see tokamak.export), with a vector copy if vector_format is
+    "pdf" or "svg".
+    """
+
+    def __init__(self, design, output_dir, nthreads=None, show=False,
+                 reporter=None, cancel_event=None, scan_workers=None, worker_threads=None,
+                 beta_solver="continuation", vde_stepper="adaptive", animation_format="gif",
+                 animation_workers=None, export_workers=None, vector_format=None):
+        from tokamak import animation, layout
+
+        if beta_solver not in BETA_SOLVERS:
+            raise ValueError(f"beta_solver must be one of {BETA_SOLVERS}, got {beta_solver!r}")
+        if vde_stepper not in VDE_STEPPERS:
+            raise ValueError(f"vde_stepper must be one of {VDE_STEPPERS}, got {vde_stepper!r}")
+        animation.check_format(animation_format)
+        if nthreads is None or scan_workers is None:
+            planned = layout.plan("scan")
+            if scan_workers is None:
+                scan_workers = planned["scan_workers"]
+                if scan_workers > 1 and worker_threads is None:
+                    worker_threads = planned["worker_threads"]
+            nthreads = planned["nthreads"] if nthreads is None else nthreads
+        self.design = load_design(design)
+        self.output_dir = output_dir
+        self.nthreads = nthreads
+        self.show = show
+        self.reporter = reporter
+        self.cancel_event = cancel_event
+        self.scan_workers = scan_workers
+        self.worker_threads = nthreads if worker_threads is None else worker_threads
+        self.beta_solver = beta_solver
+        self.vde_stepper = vde_stepper
+        self.animation_format = animation_format
+        self.animation_workers = animation.DEFAULT_WORKERS if animation_workers is None else animation_workers
+        self.status = "running"
+        os.makedirs(output_dir, exist_ok=True)
+
+        plasma = self.design["plasma_parameters"]
+        self.major_radius = plasma["major_radius"]
+        self.minor_radius = plasma["minor_radius"]
+        self.elongation = plasma["elongation"]
+        self.triangularity = plasma["triangularity"]
+
+        self.timings = {}
+        self.eig_solves = []
+        self.tracer = Tracer()
+        self.outputs = []
+        self.rendered = set()
+        self.exporter = FigureExporter(output_dir, vector_format=vector_format,
+                                       **({} if export_workers is None else {"workers": export_workers}))
+        self.store = None
+        self.tokamaker = None
+        self.mesh = None
+
+    @property
+    def result_options(self):
+        """Options besides the design that change this run's results or artifacts (see tokamak.run_index)"""
+        return {
+            "beta_solver": self.beta_solver,
+            "vde_stepper": self.vde_stepper,
+            "float32": self.store.float32 if self.store is not None else False,
+            "animation_format": self.animation_format,
+            "vector_format": self.exporter.vector_format,
+        }
+
+    @property
+    def settings(self):
+        return self.design["advanced_settings"]
+
+    @property
+    def resolution(self):
+        return self.design["mesh_resolution"]
+
+    def timed(self, stage):
+        """Context manager adding the wall time of its body to self.timings[stage] and tracing it"""
+        return _StageTimer(self, stage)
+
+    def span(self, name, **args):
+        """Context manager tracing a sub-step; its value is the args dict, for counts known at the end"""
+        return self.tracer.span(name, **args)
+
+    def progress(self, stage, step=None, total=None, message=None, **extra):
+        """Report a progress event and stop here if cancellation was requested"""
+        if self.cancelled:
+            raise RunCancelled(f"Cancelled during {stage}")
+        if self.reporter is not None:
+            event = {"time": time.time(), "stage": stage, "step": step, "total": total, "message": message}
+            event.update(extra)
+            self.reporter(event)
+
+    def save_figure(self, fig, filename):
+        """Save figure to the output folder
+
+        The full-resolution file may still be being written when this
+        returns; wait_for_exports() waits for it.
+        """
+        import matplotlib.pyplot as plt
+        filepath = os.path.join(self.output_dir, filename)
+        self.exporter.submit(fig, filename)
+        print(f"Saved: {filepath}")
+        self.record_output(filename)
+        if self.show:
+            plt.show()
+        else:
+            plt.close(fig)
+
+    def wait_for_exports(self):
+        """Wait for figures still being written at full resolution"""
+        if self.exporter.pending:
+            self.progress("export", message=f"Writing {len(self.exporter.pending)} figures at full resolution")
+            with self.timed("export"):
+                finished = self.exporter.wait()
+        else:
+            finished = self.exporter.wait()
+        if self.exporter.vector_format is not None:
+            for filename in finished:
+                self.record_output(self.exporter.vector_filename(filename))
+
+    def open_store(self, float32=False):
+        """Start results.h5 in output_dir (see tokamak.run_store); later stages write their results to it"""
+        self.store = RunStore(os.path.join(self.output_dir, STORE_FILENAME), float32=float32)
+        return self.store
+
+    def close_store(self):
+        """Finish results.h5 and add it to the outputs; its psi histories stay readable"""
+        self.store.close()
+        self.record_output(STORE_FILENAME)
+
+    def record_output(self, filename):
+        """Add a file in output_dir to outputs and report it"""
+        self.outputs.append(filename)
+        if self.reporter is not None:
+            self.reporter({"time": time.time(), "stage": "output", "file": filename, "message": f"Saved {filename}"})
+
+    @property
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def scalar_results(self):
+        """JSON-friendly summary of the scalar outputs computed so far"""
+        results = {}
+        for name in ("err_flag", "growth_rate", "wall_time", "feedback_capability_param", "mesh_key"):
+            value = getattr(self, name, None)
+            if value is not None:
+                results[name] = value.item() if isinstance(value, np.generic) else value
+        if getattr(self, "eq_stats", None) is not None:
+            results["equilibrium"] = {k: float(v) for k, v in self.eq_stats.items() if np.isscalar(v)}
+        if getattr(self, "coil_currents", None) is not None:
+            results["coil_currents"] = {k: float(v) for k, v in self.coil_currents.items()}
+        if self.eig_solves:
+            results["eig_solves"] = self.eig_solves
+        if getattr(self, "beta_p", None):
+            results["beta_p"] = [float(b) for b in self.beta_p]
+            results["growth"] = [float(g) for g in self.growth]
+            results["beta_solver"] = self.beta_solver
+            results["beta_solves"] = self.scan_solves
+            results["beta_eig_solves"] = self.scan_eig_solves
+            results["vde_steps"] = self.vde_steps
+        if getattr(self, "animation_stats", None) is not None:
+            results["animation"] = self.animation_stats
+        return results
+
+    def write_summary(self):
+        """Write run_summary.json with the design, scalar results, stage and export timings and outputs
+
+        The trace files (see tokamak.profiling) are written alongside and
+        the per-span totals go in the summary's "profile".
+        """
+        self.wait_for_exports()
+        for filename in self.tracer.write(self.output_dir):
+            if filename not in self.outputs:
+                self.record_output(filename)
+        summary = {
+            "timestamp": self.design.get("timestamp"),
+            "status": self.status,
+            "design": self.design,
+            "results": self.scalar_results(),
+            "timings": self.timings,
+            "total_time": getattr(self, "elapsed", sum(self.timings.values())),
+            "layout": {"nthreads": self.nthreads, "scan_workers": self.scan_workers,
+                       "worker_threads": self.worker_threads},
+            "outputs": self.outputs,
+            "exports": self.exporter.timings,
+            "profile": self.tracer.profile(),
+        }
+        path = os.path.join(self.output_dir, SUMMARY_FILENAME)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return path
+
+
+class _StageTimer:
+    def __init__(self, run, stage):
+        self.run = run
+        self.stage = stage
+        self.span = run.tracer.span(stage, cat="stage")
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.span.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.span.__exit__(*exc)
+        elapsed = time.perf_counter() - self.start
+        self.run.timings[self.stage] = self.run.timings.get(self.stage, 0.0) + elapsed
+        return False
+
+
+def prepare_geometry(run):
+    """Plasma target boundary, vacuum vessel walls and coil locations from the design"""
+    with run.timed("geometry"):
+        run.boundary_pts = isoflux_points(ISOFLUX_POINTS, run.major_radius, 0.0, run.minor_radius,
+                                          run.elongation, run.triangularity)
+        run.vv_boundary = np.array(run.design['vacuum_vessel']['boundary_coordinates'], dtype=np.float64)
+        run.vv_outer = resize_polygon(run.vv_boundary, VV_WALL_THICKNESS)
+        run.coil_locs = np.array(run.design["coil_coordinates"], dtype=np.float64)
+        run.invalid_coils = np.flatnonzero(find_invalid_coils(run.coil_locs, run.vv_boundary, run.boundary_pts))
+    if len(run.invalid_coils) > 0:
+        print(f"WARNING: coils {(run.invalid_coils + 1).tolist()} are inside the vacuum vessel or plasma")
+
+
+def build_mesh(run):
+    """Mesh the geometry, reusing the mesh cache when the geometry has been meshed before"""
+    run.progress("mesh", message="Building mesh")
+    with run.timed("mesh"):
+        res = run.resolution
+        with run.span("get_mesh") as span:
+            mesh_arrays, run.mesh, run.mesh_key = get_mesh(
+                run.vv_boundary, run.vv_outer, run.coil_locs,
+                res["plasma_dx"], res["coil_dx"], res["vv_dx"], res["vac_dx"])
+            span.update(cached=run.mesh is None, nodes=len(mesh_arrays[0]))
+        run.mesh_pts, run.mesh_lc, run.mesh_reg, run.coil_dict, run.cond_dict = mesh_arrays
+    run.mesh_cached = run.mesh is None
+    if run.store is not None:
+        run.store.write_mesh(run.mesh_pts, run.mesh_lc, run.mesh_reg)
+
+
+def init_tokamaker(run):
+    """Load the mesh and region definitions into the process-wide TokaMaker"""
+    tokamaker = oft.get_tokamaker(run.nthreads)
+    tokamaker.setup_mesh(run.mesh_pts, run.mesh_lc, run.mesh_reg)
+    tokamaker.setup_regions(cond_dict=run.cond_dict, coil_dict=run.coil_dict)
+    run.tokamaker = tokamaker
+
+
+def set_field(run):
+    """Toroidal field from B0 and the major radius"""
+    run.tokamaker.setup(order=FE_ORDER, F0=run.settings["B0"]*run.major_radius)
+
+
+def set_current_targets(run):
+    run.tokamaker.set_targets(Ip=run.settings["Ip_target"], Ip_ratio=run.settings["Ip_ratio_target"])
+
+
+def set_profiles(run):
+    """Power-law F*F' and P' profiles from the design's alpha/gamma exponents"""
+    from OpenFUSIONToolkit.TokaMaker.util import create_power_flux_fun
+    run.ffp_prof = create_power_flux_fun(40, run.settings["ffp_alpha"], run.settings["ffp_gamma"])
+    run.pp_prof = create_power_flux_fun(40, run.settings["pp_alpha"], run.settings["pp_gamma"])
+    run.tokamaker.set_profiles(ffp_prof=run.ffp_prof, pp_prof=run.pp_prof)
+
+
+def set_shape_targets(run):
+    run.tokamaker.set_isoflux(run.boundary_pts, weights=5*np.ones(len(run.boundary_pts)))
+
+
+def set_coil_regularization(run):
+    """Regularization that keeps the coil currents small"""
+    tokamaker = run.tokamaker
+    coil_regmat = np.eye(tokamaker.ncoils+1, dtype=np.float64)
+    targets = np.zeros(tokamaker.ncoils+1)
+    weights = 0.1*np.ones(tokamaker.ncoils+1)
+    tokamaker.set_coil_reg(coil_regmat, targets, weights)
+
+
+def solve(run, **args):
+    """tokamaker.solve(), traced as a "solve" span with its err_flag and any args given"""
+    with run.span("solve", **args) as span:
+        err_flag = run.tokamaker.solve()
+        span["err_flag"] = int(err_flag)
+    return err_flag
+
+
+def setup_tokamaker(run):
+    """Load the mesh into TokaMaker and set field, targets, profiles, shape and coil regularization"""
+    run.progress("setup", message="Setting up TokaMaker")
+    with run.timed("setup"):
+        init_tokamaker(run)
+        set_field(run)
+        set_current_targets(run)
+        set_profiles(run)
+        set_shape_targets(run)
+        set_coil_regularization(run)
+
+
+def solve_equilibrium(run, psi0=None):
+    """Solve the initial Grad-Shafranov equilibrium and collect its statistics
+
+    psi0, if given, is the starting flux on the current mesh instead of
+    init_psi; a solve from it that fails is retried from init_psi.
+    """
+    tokamaker = run.tokamaker
+    run.progress("equilibrium", message="Solving equilibrium")
+    with run.timed("equilibrium"):
+        run.err_flag = None
+        if psi0 is not None:
+            tokamaker.set_psi(psi0)
+            run.err_flag = solve(run, warm=True)
+        if run.err_flag != 0:
+            tokamaker.init_psi(run.major_radius, 0.0, run.minor_radius, run.elongation, run.triangularity)
+            run.err_flag = solve(run, warm=False)
+        run.eq_stats = tokamaker.get_stats()
+        run.coil_currents, _ = tokamaker.get_coil_currents()
+    if run.store is not None:
+        run.store.write_equilibrium(tokamaker.get_psi(False), run.eq_stats)
+    if run.err_flag != 0:
+        print(f"WARNING: equilibrium solve returned err_flag={run.err_flag}")
+
+
+def run_stability(run):
+    """Vertical stability of the initial equilibrium and the feedback capability parameter"""
+    run.progress("stability", message="Computing eig_td and eig_wall")
+    with run.timed("stability"):
+        eig_vals, eig_vecs = stability.plasma_modes(run, stability.BASELINE_OMEGA, solves=run.eig_solves)
+        run.growth_rate = -eig_vals[0, 0]
+
+        # The wall modes only depend on the mesh, so they come from disk after the first run on it
+        eigval_wall, eigvec_wall = stability.wall_modes(run, FE_ORDER, solves=run.eig_solves)
+        run.wall_time = 1/eigval_wall[1, 0]
+
+        run.feedback_capability_param = run.growth_rate*run.wall_time
+    print('Feedback capability parameter: ' + str(run.feedback_capability_param))
+
+
+def solve_beta_point(run, beta_target, beta_scale):
+    """Re-solve the equilibrium at a target beta_p with the notebook's four fixed corrections
+
+    Returns the updated beta_scale.
+    """
+    tokamaker = run.tokamaker
+    tokamaker.init_psi(run.major_radius, 0.0, run.minor_radius, run.elongation, run.triangularity)
+    beta_approx = beta_target*beta_scale
+    for i in range(4):
+        tokamaker.set_targets(Ip=run.settings["Ip_target"], Ip_ratio=(1.0/beta_approx - 1.0))
+        solve(run, beta_target=beta_target)
+        beta_approx *= beta_target/tokamaker.get_stats()['beta_pol']*100.0
+    return beta_approx/beta_target
+
+
+def solve_beta_continuation(run, beta_target, seed):
+    """Re-solve the equilibrium at a target beta_p starting from a neighbouring point
+
+    The solve starts from seed["psi"], the previous converged flux, instead
+    of init_psi. The unknown is u = 1/(1 + Ip_ratio). Each correction is a
+    secant step through the last two (u, beta_pol) pairs, the first one
+    using the previous point's converged pair (on the first point it scales
+    u by target/beta_pol like the fixed iteration). Solving stops once
+    beta_pol is within BETA_TOL of the target or after BETA_MAX_SOLVES.
+
+    Returns (seed for the next point, number of solves, converged).
+    """
+    tokamaker = run.tokamaker
+    target = beta_target*100.0
+    warm = seed.get("psi") is not None
+    if warm:
+        tokamaker.set_psi(seed["psi"])
+    else:
+        tokamaker.init_psi(run.major_radius, 0.0, run.minor_radius, run.elongation, run.triangularity)
+
+    u = beta_target*seed.get("scale", 1.0)
+    # The previous converged point gives the first secant step a slope
+    history = [seed["converged"]] if seed.get("converged") else []
+    solves = 0
+    converged = False
+    while solves < BETA_MAX_SOLVES:
+        tokamaker.set_targets(Ip=run.settings["Ip_target"], Ip_ratio=(1.0/u - 1.0))
+        err_flag = solve(run, beta_target=beta_target, warm=warm)
+        solves += 1
+        if err_flag != 0:
+            if not warm:
+                break
+            # The warm start was too far off, retry this point from the analytic guess
+            warm = False
+            tokamaker.init_psi(run.major_radius, 0.0, run.minor_radius, run.elongation, run.triangularity)
+            continue
+        beta = tokamaker.get_stats()['beta_pol']
+        history.append((u, beta))
+        if abs(beta - target) <= BETA_TOL*target:
+            converged = True
+            break
+        if len(history) > 1 and history[-1][1] != history[-2][1]:
+            (u0, beta0), (u1, beta1) = history[-2:]
+            u_next = u1 + (target - beta1)*(u1 - u0)/(beta1 - beta0)
+        else:
+            u_next = u*target/beta
+        # Limit each step to a factor of two so a poor secant cannot overshoot
+        u = min(max(u_next, 0.5*u), 2.0*u)
+
+    if converged:
+        seed = {"psi": tokamaker.get_psi(False), "scale": u/beta_target, "converged": history[-1]}
+    else:
+        seed = {"psi": seed.get("psi"), "scale": u/beta_target}
+    return seed, solves, converged
+
+
+def linear_stability(run, previous=None, solves=None):
+    """Most unstable mode of the current equilibrium, returned as (eig_vals, eig_vecs, eig_sign)
+
+    previous is the dominant eigenvalue of a neighbouring equilibrium, used
+    to shift eig_td (see tokamak.stability); each eigen-solve is appended
+    to solves.
+    """
+    tokamaker = run.tokamaker
+    eig_vals, eig_vecs = stability.dominant_mode(run, previous, solves=solves)
+    upper = tokamaker.r[:, 1] > 0.0
+    eig_sign = eig_vecs[0, upper][abs(eig_vecs[0, upper]).argmax()]
+    return eig_vals, eig_vecs, eig_sign
+
+
+def perturb_unstable_mode(run, psi0, eig_vals, eig_vecs, eig_sign):
+    """Load psi0 kicked by the most unstable mode and set up the time-dependent solver
+
+    Returns the fixed-schedule time step 0.2/gamma.
+    """
+    tokamaker = run.tokamaker
+    psi_ic = psi0-0.01*eig_vecs[0, :]*(tokamaker.psi_bounds[1]-tokamaker.psi_bounds[0])/eig_sign
+    tokamaker.set_psi(psi_ic)
+    dt = VDE_DT/abs(eig_vals[0, 0])
+    with run.span("setup_td"):
+        tokamaker.setup_td(dt, 1.E-13, 1.E-11)
+    return dt
+
+
+def run_vde_evolution(run, psi0, eig_vals, eig_vecs, eig_sign, nsteps=VDE_STEPS, snapshots=None):
+    """Nonlinear evolution of the equilibrium perturbed by the most unstable mode
+
+    Takes nsteps fixed steps of 0.2/gamma, or hands over to
+    run_vde_adaptive() when run.vde_stepper is "adaptive". Each psi snapshot
+    is appended to snapshots as it is taken (a new list if None). Returns (z
+    history as [[time, Z_opoint], ...], psi snapshots, final time, stepping
+    info dict).
+    """
+    if run.vde_stepper == "adaptive":
+        return run_vde_adaptive(run, psi0, eig_vals, eig_vecs, eig_sign, snapshots=snapshots)
+    tokamaker = run.tokamaker
+    dt = perturb_unstable_mode(run, psi0, eig_vals, eig_vecs, eig_sign)
+    sim_time = 0.0
+    results = [] if snapshots is None else snapshots
+    z0 = [[sim_time, tokamaker.o_point[1]], ]
+    for i in range(nsteps):
+        run.progress("step_td", step=i, total=nsteps)
+        with run.span("step_td", step=i, dt=dt) as span:
+            sim_time, _, nl_its, lin_its, nretry = tokamaker.step_td(sim_time, dt)
+            span.update(nl_its=int(nl_its), lin_its=int(lin_its), nretry=int(nretry))
+        assert nretry >= 0
+        z0.append([sim_time, tokamaker.o_point[1]])
+        results.append(tokamaker.get_psi())
+    info = {"stepper": "fixed", "steps": nsteps, "event": "steps", "sim_time": sim_time,
+            "fixed_steps": nsteps, "steps_saved": 0}
+    return z0, results, sim_time, info
+
+
+def _opoint_lost(o_point):
+    return o_point is None or not np.all(np.isfinite(o_point)) or o_point[0] <= 0.0
+
+
+def run_vde_adaptive(run, psi0, eig_vals, eig_vecs, eig_sign, snapshots=None):
+    """Nonlinear VDE evolution with adaptive dt and event-based termination
+
+    dt starts at 0.2/gamma and is rescaled after every step so the O-point
+    moves about VDE_DZ_TARGET of the vessel half-height per step, within
+    VDE_DT_RANGE. A step that needed retries, or more nonlinear or linear
+    iterations than the first step, halves dt. The preconditioner built by
+    setup_td is kept; the iteration counts show when dt has drifted too far
+    from it. The evolution stops when the O-point is lost, when |dZ| passes
+    VDE_WALL_FRACTION of the half-height, when the vertical motion has
+    saturated, or at VDE_MAX_TIME growth times or VDE_MAX_STEPS steps.
+
+    Returns the same tuple as run_vde_evolution().
+    """
+    tokamaker = run.tokamaker
+    tau = 1.0/abs(eig_vals[0, 0])
+    dt0 = perturb_unstable_mode(run, psi0, eig_vals, eig_vecs, eig_sign)
+    dt_min, dt_max = VDE_DT_RANGE[0]*tau, VDE_DT_RANGE[1]*tau
+    max_time = VDE_MAX_TIME*tau
+    half_height = 0.5*(run.vv_boundary[:, 1].max() - run.vv_boundary[:, 1].min())
+    dz_target = VDE_DZ_TARGET*half_height
+
+    dt = dt0
+    sim_time = 0.0
+    results = [] if snapshots is None else snapshots
+    z_start = tokamaker.o_point[1]
+    z0 = [[sim_time, z_start], ]
+    its_ref = None
+    peak_speed = 0.0
+    slow_steps = 0
+    event = "max_steps"
+    for i in range(VDE_MAX_STEPS):
+        run.progress("step_td", step=i, total=VDE_MAX_STEPS)
+        dt = min(dt, max_time - sim_time)
+        with run.span("step_td", step=i, dt=dt) as span:
+            new_time, _, nl_its, lin_its, nretry = tokamaker.step_td(sim_time, dt)
+            span.update(nl_its=int(nl_its), lin_its=int(lin_its), nretry=int(nretry))
+        assert nretry >= 0
+        o_point = tokamaker.o_point
+        if _opoint_lost(o_point):
+            event = "opoint_lost"
+            break
+        dz = abs(o_point[1] - z0[-1][1])
+        step_dt = new_time - sim_time
+        sim_time = new_time
+        z0.append([sim_time, o_point[1]])
+        results.append(tokamaker.get_psi())
+
+        if abs(o_point[1] - z_start) > VDE_WALL_FRACTION*half_height:
+            event = "wall"
+            break
+        speed = dz/step_dt if step_dt > 0 else 0.0
+        peak_speed = max(peak_speed, speed)
+        slow_steps = slow_steps + 1 if speed < VDE_SATURATION*peak_speed else 0
+        if slow_steps >= VDE_SATURATION_STEPS:
+            event = "saturated"
+            break
+        if sim_time >= max_time*(1.0 - 1.E-9):
+            event = "max_time"
+            break
+
+        if its_ref is None:
+            its_ref = (nl_its, lin_its)
+        factor = min(2.0, np.sqrt(dz_target/dz)) if dz > 0 else 2.0
+        if nretry > 0 or nl_its > its_ref[0] + 2 or lin_its > 2*max(its_ref[1], 1):
+            factor = min(factor, 0.5)
+        dt = min(max(dt*max(factor, 0.5), dt_min), dt_max)
+
+    steps = len(results)
+    fixed_steps = int(np.ceil(sim_time/dt0 - 1.E-9))
+    info = {"stepper": "adaptive", "steps": steps, "event": event, "sim_time": sim_time,
+            "fixed_steps": fixed_steps, "steps_saved": fixed_steps - steps}
+    print('  VDE: {0} steps to {1:.3f} ms ({2}), {3} fewer than fixed 0.2/gamma steps'.format(
+        steps, sim_time*1.E3, event, fixed_steps - steps))
+    return z0, results, sim_time, info
+
+
+def scan_point(run, beta_target, seed=None, snapshots=None):
+    """Equilibrium, linear stability and VDE evolution at one beta_p target
+
+    seed carries the state passed between neighbouring points (Ip_ratio
+    scale, converged psi, (u, beta_pol) and the dominant eigenvalue; None for the first point). Returns (point,
+    seed) where point is a dict with beta_p, get_stats(), growth, mode, zhist, results (psi snapshots),
+    sim_time, the equilibrium solve count and time, the eigen-solve timings and the VDE stepping info.
+    snapshots, if given, receives the psi snapshots as they are taken (see run_vde_evolution()).
+    """
+    with run.span("beta_point", beta_target=float(beta_target)) as span:
+        tokamaker = run.tokamaker
+        seed = {"scale": 1.0, "psi": None} if seed is None else seed
+        previous_eig = seed.get("eig")
+        start = time.perf_counter()
+        if run.beta_solver == "continuation":
+            seed, solves, converged = solve_beta_continuation(run, beta_target, seed)
+        else:
+            seed = {"scale": solve_beta_point(run, beta_target, seed["scale"]), "psi": None}
+            solves, converged = 4, None
+        solve_time = time.perf_counter() - start
+        stats = tokamaker.get_stats()
+        beta_p = stats['beta_pol']
+        print('  Actual Beta_p = {0:.2f} ({1} solves, {2:.2f} s)'.format(beta_p, solves, solve_time))
+        psi0 = tokamaker.get_psi(False)
+
+        eig_solves = []
+        eig_vals, eig_vecs, eig_sign = linear_stability(run, previous_eig, eig_solves)
+        seed["eig"] = float(eig_vals[0, 0])
+        z0, results, sim_time, vde = run_vde_evolution(run, psi0, eig_vals, eig_vecs, eig_sign,
+                                                       snapshots=snapshots)
+        point = {
+            "beta_p": beta_p,
+            "stats": stats,
+            "growth": eig_vals[0, 0],
+            "mode": eig_vecs[0, :]*eig_sign,
+            "zhist": z0,
+            "results": results,
+            "sim_time": sim_time,
+            "solves": solves,
+            "solve_time": solve_time,
+            "converged": converged,
+            "eig_solves": eig_solves,
+            "vde": vde,
+        }
+        span.update(beta_p=float(beta_p), solves=solves, steps=vde["steps"])
+    return point, seed
+
+
+def start_beta_scan(run):
+    """Switch off plasma-mode output and clear the scan results"""
+    run.tokamaker.settings.pm = False
+    run.tokamaker.update_settings()
+    run.growth = []
+    run.beta_p = []
+    run.modes = []
+    run.zhist = []
+    run.psi_history = []
+    run.scan_solves = []
+    run.scan_eig_solves = []
+    run.vde_steps = []
+
+
+def store_scan_point(run, index, beta_target, point):
+    """Write a finished point to run.store, swapping its psi snapshots for a lazy reader"""
+    if run.store is not None:
+        point["results"] = run.store.write_point(index, beta_target, point)
+
+
+def add_scan_point(run, point):
+    """Append one scan_point() result; the last point's psi history drives the VDE figures
+
+    Every point's psi history is kept in run.psi_history only when run.store
+    holds it on disk, so a run without a store keeps just the last one.
+    """
+    run.beta_p.append(point["beta_p"])
+    run.growth.append(point["growth"])
+    run.modes.append(point["mode"])
+    run.zhist.append(point["zhist"])
+    if run.store is not None:
+        run.psi_history.append(point["results"])
+    run.scan_solves.append({k: point[k] for k in ("solves", "solve_time", "converged")})
+    run.scan_eig_solves.append(point["eig_solves"])
+    run.vde_steps.append(point["vde"])
+    run.results = point["results"]
+    run.sim_time = point["sim_time"]
+    run.result_times = np.array([t for t, _ in point["zhist"][1:len(point["results"]) + 1]])
+
+
+def run_beta_scan(run, beta_targets=BETA_SCAN):
+    """Linear stability and nonlinear VDE evolution across a scan of beta_p
+
+    With run.scan_workers > 1 the points are spread over a process pool
+    (see tokamak.scan), otherwise they run here one after another. Either
+    way the results are stored in scan order and the psi history of the
+    last point is kept in run.results for the VDE figures and animation.
+    Here each psi snapshot goes to run.store as it is taken; the pool's
+    workers have no store, so their points are written whole on arrival.
+    """
+    if run.scan_workers > 1:
+        from tokamak.scan import parallel_beta_scan
+        with run.timed("beta_scan"):
+            parallel_beta_scan(run, beta_targets)
+        return
+
+    start_beta_scan(run)
+    seed = None
+    with run.timed("beta_scan"):
+        for index, beta_target in enumerate(beta_targets):
+            run.progress("beta_scan", step=index, total=len(beta_targets),
+                         message='Computing Beta_approx [%] {0:.2f}'.format(beta_target*100.0))
+            print('Computing Beta_approx [%] {0:.2f}'.format(beta_target*100.0))
+            # Snapshots go straight to results.h5 as the VDE takes them
+            snapshots = None if run.store is None else run.store.point_snapshots(index, len(run.mesh_pts))
+            point, seed = scan_point(run, beta_target, seed, snapshots=snapshots)
+            store_scan_point(run, index, beta_target, point)
+            add_scan_point(run, point)
+
+
+def plot_vessel_design(run):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    ax.fill(run.vv_outer[:, 0], run.vv_outer[:, 1], color='k')
+    ax.fill(run.vv_boundary[:, 0], run.vv_boundary[:, 1], color='w')
+    ax.scatter(run.boundary_pts[:, 0], run.boundary_pts[:, 1], color='b')
+    ax.scatter(run.coil_locs[:, 0], run.coil_locs[:, 1], color='r')
+    ax.set_aspect(aspect=1)
+    ax.set_xlabel('R (m)')
+    ax.set_ylabel('Z (m)')
+    run.save_figure(fig, "01_vacuum_vessel_design.png")
+
+
+def plot_profiles(run):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(2, 1, sharex=True)
+    ax[0].plot(run.ffp_prof['x'], run.ffp_prof['y'])
+    ax[0].set_ylabel("FF'")
+    ax[1].plot(run.pp_prof['x'], run.pp_prof['y'])
+    ax[1].set_ylabel("P'")
+    ax[-1].set_xlabel(r"$\hat{\psi}$")
+    run.save_figure(fig, "02_plasma_profiles.png")
+
+
+def plot_equilibrium(run):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    run.tokamaker.plot_machine(fig, ax)
+    run.tokamaker.plot_psi(fig, ax)
+    run.tokamaker.plot_constraints(fig, ax)
+    ax.set_xlabel('R (m)')
+    ax.set_ylabel('Z (m)')
+    run.save_figure(fig, "03_initial_equilibrium.png")
+
+
+def plot_coil_currents(run):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for key in run.coil_dict.keys():
+        ax.scatter(key, np.abs(run.coil_currents[key] / 1E6), color='tab:blue')
+    coil_current_limit = run.eq_stats['Ip']*2
+    ax.hlines(coil_current_limit/1E6, xmin=0, xmax=len(run.coil_dict.keys()), color='r', linestyle='--')
+    ax.set_xlabel('Coil name')
+    ax.set_ylabel('Coil current (MA)')
+    run.save_figure(fig, "04_coil_currents.png")
+
+
+def _beta_colormap(run):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    norm = mpl.colors.Normalize(vmin=run.beta_p[0], vmax=run.beta_p[-1])
+    return mpl.cm.ScalarMappable(norm=norm, cmap=plt.cm.viridis)
+
+
+def plot_growth_rate(run):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(1, 1)
+    ax.plot(run.beta_p, run.growth)
+    ax.set_ylim(top=0.0)
+    ax.grid(True)
+    ax.set_ylabel(r'$\gamma$ [1/s]')
+    ax.set_xlabel(r'$\beta_p$ [%]')
+    run.save_figure(fig, "05_growth_rate_vs_beta_p.png")
+
+
+def plot_mode_structures(run, indices=(0, 3, 6, 9)):
+    import matplotlib.pyplot as plt
+    scalarMap = _beta_colormap(run)
+    indices = [i for i in indices if i < len(run.modes)]
+    fig, ax = plt.subplots(1, len(indices), sharey=True, constrained_layout=True, figsize=(8, 4), squeeze=False)
+    ax = ax[0]
+    for ax_tmp in ax:
+        run.tokamaker.plot_machine(fig, ax_tmp, limiter_color=None)
+    for j, i in enumerate(indices):
+        colorVal = scalarMap.to_rgba(run.beta_p[i])
+        run.tokamaker.plot_psi(fig, ax[j], psi=run.modes[i], plasma_nlevels=6, normalized=False, plasma_color=[colorVal],
+                               opoint_color=None, xpoint_color=None, vacuum_nlevels=0)
+        run.tokamaker.plot_eddy(fig, ax[j], dpsi_dt=run.modes[i]*abs(run.growth[i]), colormap='seismic', symmap=True, clabel=None)
+    for ax_tmp in ax:
+        ax_tmp.set_xlabel(r'R [m]')
+    ax[0].set_ylabel(r'Z [m]')
+    fig.colorbar(scalarMap, ax=ax[:], label=r'$\beta_p$ [%]')
+    run.save_figure(fig, "06_mode_structures_different_beta_p.png")
+
+
+def plot_nonlinear_evolution(run):
+    import matplotlib.pyplot as plt
+    scalarMap = _beta_colormap(run)
+    fig, ax = plt.subplots(1, 1)
+    for i, z0 in enumerate(run.zhist):
+        z_hist = np.asarray(z0)
+        # A point whose O-point was lost on the first step has only its t = 0 row, nothing to draw
+        if len(z_hist) < 2:
+            continue
+        z_hist = z_hist[1:, :] - [z_hist[1, 0], z_hist[0, 1]]
+        ax.semilogy(z_hist[:, 0]*1.E3, abs(z_hist[:, 1]), color=scalarMap.to_rgba(run.beta_p[i]))
+    ax.grid(True)
+    ax.set_ylabel(r'$|\Delta Z_0|$ [m]')
+    ax.set_xlabel(r'Time [ms]')
+    fig.colorbar(scalarMap, ax=ax, label=r'$\beta_p$ [%]')
+    run.save_figure(fig, "07_nonlinear_plasma_evolution.png")
+
+
+def _no_vde_snapshots(run, output):
+    """True (after saying so) when the VDE stopped before its first snapshot, e.g. the O-point was lost at once"""
+    if len(run.results) > 0:
+        return False
+    print(f"Skipping {output}: the VDE evolution stopped before its first step ({run.vde_steps[-1]['event']})")
+    return True
+
+
+def plot_vde_evolution(run):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    if _no_vde_snapshots(run, "08_vde_evolution.png"):
+        return
+    fig, ax = plt.subplots(constrained_layout=True, figsize=(8, 5))
+    run.tokamaker.plot_machine(fig, ax)
+    # Adaptive steps are unevenly spaced, so color each snapshot by its time
+    colors = plt.cm.jet(run.result_times/run.sim_time)
+    for i, result in enumerate(run.results):
+        run.tokamaker.plot_psi(fig, ax, psi=result, plasma_nlevels=1, plasma_color=[colors[i]], vacuum_nlevels=0,
+                               xpoint_color=None, opoint_color=None)
+    norm = mpl.colors.Normalize(vmin=0.0, vmax=run.sim_time*1.E3)
+    fig.colorbar(mpl.cm.ScalarMappable(norm=norm, cmap=plt.cm.jet), ax=ax, label='Time [ms]')
+    run.save_figure(fig, "08_vde_evolution.png")
+
+
+def animate_vde(run, filename=None):
+    """Write the VDE animation of the last scan point (see tokamak.animation)"""
+    from tokamak import animation
+
+    filename = filename or animation.animation_filename("09_vde_evolution", run.animation_format)
+    if _no_vde_snapshots(run, filename):
+        return
+    path = os.path.join(run.output_dir, filename)
+    nframes = len(run.results)
+
+    def progress(done):
+        run.progress("gif", step=done - 1, total=nframes)
+
+    with run.span("animation", format=run.animation_format, workers=run.animation_workers) as span:
+        layout = animation.draw_background(run.tokamaker, run.mesh_pts)
+        run.animation_stats = animation.write_animation(path, layout, run.mesh_pts, run.mesh_lc, run.results,
+                                                        run.result_times*1000, workers=run.animation_workers,
+                                                        progress=progress)
+        span.update(frames=run.animation_stats["frames"], bytes=run.animation_stats["bytes"])
+    stats = run.animation_stats
+    print(f"Saved VDE animation: {path} ({stats['frames']} frames, {stats['frames_per_second']:.1f} frames/s, "
+          f"{stats['bytes']/1E6:.2f} MB)")
+    run.record_output(filename)
+    if run.show and animation.animation_format(path) in ("gif", "webp", "apng"):
+        from IPython.display import Image, display
+        display(Image(filename=path))
+
+
+def render_outputs(run):
+    """Write every figure and the VDE animation to the output folder"""
+    _render(run, plot_vessel_design, plot_profiles, plot_equilibrium, plot_coil_currents, plot_growth_rate,
+            plot_mode_structures, plot_nonlinear_evolution, plot_vde_evolution, animate_vde)
+
+
+def _render(run, *plots):
+    import matplotlib.pyplot as plt
+    with run.timed("render"), plt.rc_context(PLOT_STYLE):
+        for plot in plots:
+            plot(run)
+            run.rendered.add(plot.__name__)
+
+
+def _render_partial(run):
+    """Figures that can still be drawn from whatever a cancelled scan finished"""
+    plots = []
+    if getattr(run, "beta_p", None) and len(run.growth) == len(run.beta_p):
+        plots += [plot_growth_rate, plot_mode_structures]
+        if run.zhist:
+            plots.append(plot_nonlinear_evolution)
+        if getattr(run, "results", None):
+            plots.append(plot_vde_evolution)
+    _render(run, *[plot for plot in plots if plot.__name__ not in run.rendered])
+
+
+def run_pipeline(design, output_dir, nthreads=None, reporter=None, cancel_event=None,
+                 scan_workers=None, worker_threads=None, beta_solver="continuation", vde_stepper="adaptive",
+                 store_float32=False, animation_format="gif", animation_workers=None, export_workers=None,
+                 vector_format=None, run_index=None):
+    """Run every stage for a design dict (or design JSON path) and write outputs to output_dir
+
+    Figures are written as soon as the stage they depend on finishes. If
+    cancel_event is set the run stops at the next progress point, renders
+    the figures the finished part of the scan supports and returns with
+    status "cancelled". Returns the AnalysisRun. run_summary.json in
+    output_dir records the status, scalar results, per-stage wall times and
+    the list of files written; results.h5 holds the mesh, equilibrium and
+    every scan point's psi history, eigenmode and statistics (see
+    tokamak.run_store), in float32 if store_float32 is set. Figures are
+    exported at full resolution in the background while later stages run
+    (see tokamak.export) and waited for before the summary is written. A
+    completed run is added to run_index (a tokamak.run_index.RunIndex) if
+    one is given.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    oft.ensure_oft_path()
+
+    run = AnalysisRun(design, output_dir, nthreads=nthreads, reporter=reporter, cancel_event=cancel_event,
+                      scan_workers=scan_workers, worker_threads=worker_threads, beta_solver=beta_solver,
+                      vde_stepper=vde_stepper, animation_format=animation_format,
+                      animation_workers=animation_workers, export_workers=export_workers,
+                      vector_format=vector_format)
+    run.open_store(float32=store_float32)
+    with _solver_lock:
+        start = time.perf_counter()
+        try:
+            prepare_geometry(run)
+            _render(run, plot_vessel_design)
+            build_mesh(run)
+            setup_tokamaker(run)
+            _render(run, plot_profiles)
+            solve_equilibrium(run)
+            _render(run, plot_equilibrium, plot_coil_currents)
+            run_stability(run)
+            run_beta_scan(run)
+            _render(run, plot_growth_rate, plot_mode_structures, plot_nonlinear_evolution, plot_vde_evolution,
+                    animate_vde)
+            run.wait_for_exports()
+            run.status = "completed"
+        except RunCancelled:
+            run.status = "cancelled"
+            run.cancel_event = None
+            _render_partial(run)
+            run.wait_for_exports()
+        except Exception:
+            run.status = "failed"
+            raise
+        finally:
+            run.close_store()
+            run.elapsed = time.perf_counter() - start
+            run.write_summary()
+            if run_index is not None and run.status == "completed":
+                try:
+                    run_index.add(run)
+                except Exception as e:
+                    # The run itself succeeded, losing it from the index only costs a re-solve
+                    print(f"WARNING: could not add the run to the run index: {e}")
+            if reporter is not None:
+                reporter({"time": time.time(), "stage": run.status, "message": f"Run {run.status}"})
+    return run
+
+
+def format_timings(run):
+    """Table of stage wall and CPU times and peak RSS for printing"""
+    profile = run.tracer.profile()
+    lines = [f"  {'stage':<12s} {'wall':>11s} {'cpu':>11s} {'peak RSS':>11s}"]
+    for stage in STAGES:
+        if stage in run.timings:
+            entry = profile.get(stage, {})
+            cpu = f"{entry['cpu']:9.2f} s" if "cpu" in entry else ""
+            rss = f"{entry['peak_rss_mb']:8.0f} MB" if entry.get("peak_rss_mb") is not None else ""
+            lines.append(f"  {stage:<12s} {run.timings[stage]:9.2f} s {cpu:>11s} {rss:>11s}")
+    total = getattr(run, "elapsed", sum(run.timings.values()))
+    lines.append(f"  {'total':<12s} {total:9.2f} s")
+    return "\n".join(lines)
+
+
+def format_eig_solves(run):
+    """Table of eigen-solve times, the stability stage's calls then the scan points', for printing"""
+    lines = []
+    points = [("stability", run.eig_solves)]
+    points += [(f"beta_p {beta:.2f}%", solves) for beta, solves in zip(getattr(run, "beta_p", []),
+                                                                     getattr(run, "scan_eig_solves", []))]
+    for label, solves in points:
+        for solve in solves:
+            detail = "cached" if solve.get("cached") else (f"omega {solve['omega']:.3g}" if "omega" in solve else "")
+            lines.append(f"  {label:<16s} {solve['call']:<9s} {solve['seconds']:9.3f} s  "
+                         f"neigs {solve['neigs']:<3d} {detail}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    from tokamak.run_index import RunIndex
+
+    parser = argparse.ArgumentParser(description="Run the AOE_tokamaker analysis for a locked design")
+    parser.add_argument("design", help="Design JSON written by Lock Design, or a folder to take the newest design from")
+    parser.add_argument("-o", "--output", help="Output folder (defaults to the design's folder)")
+    parser.add_argument("--nthreads", type=int, help="OFT solver threads (default: the planned layout, see tokamak.layout)")
+    parser.add_argument("--scan-workers", type=int, help="Processes for the beta_p scan (default: the planned layout)")
+    parser.add_argument("--worker-threads", type=int, help="OFT threads per scan worker (defaults to --nthreads)")
+    parser.add_argument("--beta-solver", choices=BETA_SOLVERS, default="continuation",
+                        help="How scan points reach their beta_p target")
+    parser.add_argument("--vde-stepper", choices=VDE_STEPPERS, default="adaptive",
+                        help="Time stepping for the nonlinear VDE evolution")
+    parser.add_argument("--float32", action="store_true", help="Store psi histories and modes in results.h5 as float32")
+    parser.add_argument("--animation-format", choices=("gif", "webp", "apng", "mp4"), default="gif",
+                        help="Format of the VDE animation (mp4 needs ffmpeg)")
+    parser.add_argument("--animation-workers", type=int, help="Processes rendering animation frames")
+    parser.add_argument("--export-workers", type=int,
+                        help="Processes writing full-resolution figures (0 saves them in-line)")
+    parser.add_argument("--vector-figures", choices=("pdf", "svg"), help="Also write each figure in this vector format")
+    parser.add_argument("--index", action="store_true", help="Add the completed run to the run index (tokamak/run_index.py)")
+    args = parser.parse_args(argv)
+
+    design_path = latest_design_file(args.design) if os.path.isdir(args.design) else args.design
+    output_dir = args.output or os.path.dirname(os.path.abspath(design_path))
+    run = run_pipeline(design_path, output_dir, nthreads=args.nthreads,
+                       scan_workers=args.scan_workers, worker_threads=args.worker_threads,
+                       beta_solver=args.beta_solver, vde_stepper=args.vde_stepper, store_float32=args.float32,
+                       animation_format=args.animation_format, animation_workers=args.animation_workers,
+                       export_workers=args.export_workers, vector_format=args.vector_figures,
+                       run_index=RunIndex() if args.index else None)
+    print("Stage wall times:")
+    print(format_timings(run))
+    print("Eigen-solves:")
+    print(format_eig_solves(run))
+    print(f"Trace: {os.path.join(output_dir, TRACE_FILENAME)} (Chrome format: {CHROME_TRACE_FILENAME})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# Live low-fidelity equilibrium preview for the design view
+#
+# The design view only draws the create_isoflux target shape. With the live
+# preview on, LivePreview sends the design to a spawned worker once the
+# sliders and VV/coil points have been still for DEBOUNCE_SECONDS. The
+# worker keeps its own OFT_env and TokaMaker and solves the design on a
+# ladder of meshes (PREVIEW_LEVELS, then the design's own resolution), each
+# one through the mesh cache and warm-started from the last psi solved on
+# that mesh or interpolated from the previous level. After every level it
+# sends back the LCFS and a few flux contours for the design view to overlay.
+#
+# A newer design replaces the one being solved at the next level boundary.
+# If the worker is stuck in a stale solve for more than STALE_SECONDS, it is
+# killed and a new one is started. An idle worker exits after
+# IDLE_SECONDS and is started again on the next edit. Each worker's scratch
+# folder is removed when it returns, and by stop() when it was killed.
+
+import hashlib
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+import traceback
+
+import numpy as np
+
+from tokamak import oft
+from tokamak.mesh_cache import canonical
+
+DEBOUNCE_SECONDS = 0.6
+POLL_SECONDS = 0.5
+STALE_SECONDS = 3.0
+IDLE_SECONDS = 600.0
+
+# Coarse meshes solved before the design's own resolution, coarsest first
+PREVIEW_LEVELS = (
+    {"plasma_dx": 0.4, "coil_dx": 0.3, "vv_dx": 0.3, "vac_dx": 0.8},
+    {"plasma_dx": 0.25, "coil_dx": 0.2, "vv_dx": 0.2, "vac_dx": 0.5},
+)
+
+# Flux contours as fractions of the way from the magnetic axis (0) to the LCFS (1)
+PLASMA_LEVELS = (0.2, 0.4, 0.6, 0.8)
+VACUUM_LEVELS = (1.1, 1.25, 1.5)
+# TokaMaker numbers the plasma region 1; contours are drawn inside the vessel only
+PLASMA_REGION = 1
+
+
+def design_key(design):
+    """Hash of a design dict, used to notice edits"""
+    blob = json.dumps(canonical(design), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def preview_levels(design):
+    """Mesh resolutions to solve design on, coarsest first, ending with its own"""
+    from tokamak.pipeline import load_design
+
+    final = load_design(design)["mesh_resolution"]
+    levels = [level for level in PREVIEW_LEVELS if level["plasma_dx"] > final["plasma_dx"]]
+    return levels + [final]
+
+
+def transfer_psi(old_pts, old_psi, new_pts):
+    """Interpolate psi from one mesh's nodes onto another's, for a warm start"""
+    from scipy.interpolate import griddata
+
+    psi = griddata(old_pts, old_psi, new_pts, method="linear")
+    outside = np.isnan(psi)
+    if outside.any():
+        psi[outside] = griddata(old_pts, old_psi, new_pts[outside], method="nearest")
+    return psi
+
+
+def flux_contours(mesh_pts, mesh_lc, mesh_reg, psi, psi_bounds):
+    """(LCFS segments, other flux contour segments) inside the plasma region
+
+    Each segment is an (n, 2) array of R, Z.
+    """
+    import matplotlib.tri as mtri
+    from matplotlib.figure import Figure
+
+    psi_lim, psi_max = psi_bounds
+    levels = sorted(psi_max + s*(psi_lim - psi_max) for s in PLASMA_LEVELS + (1.0,) + VACUUM_LEVELS)
+    triangulation = mtri.Triangulation(mesh_pts[:, 0], mesh_pts[:, 1], mesh_lc,
+                                       mask=np.asarray(mesh_reg) != PLASMA_REGION)
+    ax = Figure().add_subplot()
+    contours = ax.tricontour(triangulation, psi, levels=levels)
+    lcfs, other = [], []
+    for level, path in zip(contours.levels, contours.get_paths()):
+        segments = [np.asarray(segment) for segment in path.to_polygons(closed_only=False) if len(segment) > 1]
+        (lcfs if np.isclose(level, psi_lim) else other).extend(segments)
+    return lcfs, other
+
+
+def solve_level(design, resolution, output_dir, seeds, nthreads):
+    """Solve design on one mesh resolution, returning the preview result
+
+    seeds maps mesh keys to (mesh_pts, psi) of earlier solves and gains this one.
+    """
+    from tokamak import pipeline
+
+    start = time.perf_counter()
+    run = pipeline.AnalysisRun({**design, "mesh_resolution": resolution}, output_dir,
+                               nthreads=nthreads, scan_workers=1)
+    pipeline.prepare_geometry(run)
+    pipeline.build_mesh(run)
+    pipeline.setup_tokamaker(run)
+
+    psi0 = None
+    if run.mesh_key in seeds:
+        psi0 = seeds[run.mesh_key][1]
+    elif seeds.get("latest") is not None:
+        psi0 = transfer_psi(*seeds["latest"], run.mesh_pts)
+    pipeline.solve_equilibrium(run, psi0=psi0)
+
+    tokamaker = run.tokamaker
+    psi = tokamaker.get_psi(False)
+    result = {
+        "resolution": resolution,
+        "err_flag": int(run.err_flag),
+        "warm_start": psi0 is not None,
+        "mesh_cached": run.mesh_cached,
+        "nodes": len(run.mesh_pts),
+        "lcfs": [],
+        "contours": [],
+    }
+    if run.err_flag == 0:
+        seeds[run.mesh_key] = seeds["latest"] = (run.mesh_pts, psi)
+        result["lcfs"], result["contours"] = flux_contours(run.mesh_pts, run.mesh_lc, run.mesh_reg, psi,
+                                                           tokamaker.psi_bounds)
+    result["timings"] = run.timings
+    result["elapsed"] = time.perf_counter() - start
+    return result
+
+
+def _latest(conn):
+    """Most recent request waiting on conn, dropping older ones"""
+    request = conn.recv()
+    while conn.poll():
+        request = conn.recv()
+    return request
+
+
+def _worker_main(conn, nthreads, output_dir):
+    """Preview worker process: serve designs from conn, then remove its scratch folder"""
+    oft.ensure_oft_path()
+    try:
+        _serve(conn, nthreads, output_dir)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def _serve(conn, nthreads, output_dir):
+    """Solve designs sent over conn, coarse to fine, until it is closed or idle"""
+    seeds = {}
+    request = None
+    while True:
+        try:
+            if request is None:
+                if not conn.poll(IDLE_SECONDS):
+                    return
+                request = _latest(conn)
+            generation, design = request
+            request = None
+            conn.send(("start", generation, None))
+            levels = preview_levels(design)
+            for level, resolution in enumerate(levels):
+                try:
+                    result = solve_level(design, resolution, output_dir, seeds, nthreads)
+                except Exception as e:
+                    result = {"resolution": resolution, "error": str(e), "traceback": traceback.format_exc()}
+                result.update(level=level, levels=len(levels))
+                conn.send(("level", generation, result))
+                if "error" in result or result["err_flag"] != 0:
+                    break
+                # A newer design makes the finer levels of this one stale
+                if conn.poll():
+                    request = _latest(conn)
+                    break
+        except (EOFError, OSError):
+            return
+
+
+class LivePreview:
+    """Debounced background preview solves for one Streamlit session
+
+    update() is called with the current design on every rerun and poll()
+    from a fragment that reruns every POLL_SECONDS; result is the most
+    recent level solved, for whichever design was current when it was sent.
+    """
+
+    def __init__(self, nthreads=oft.DEFAULT_NTHREADS, debounce=DEBOUNCE_SECONDS):
+        self.nthreads = nthreads
+        self.debounce = debounce
+        self.generation = 0
+        self.key = None
+        self.design = None
+        self.changed = None
+        self.sent = None
+        self.sent_at = None
+        self.started = None
+        self.result = None
+        self.result_generation = None
+        self.first_latency = None
+        self.conn = None
+        self.process = None
+        self.output_dir = None
+
+    def update(self, design):
+        """Note the design being edited; it is solved once it has been still for debounce seconds"""
+        key = design_key(design)
+        if key != self.key:
+            self.key = key
+            self.design = json.loads(json.dumps(design))
+            self.generation += 1
+            self.changed = time.time()
+
+    def _start_worker(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.output_dir = tempfile.mkdtemp(prefix="tokamak_preview_")
+        self.process = context.Process(target=_worker_main, args=(child_conn, self.nthreads, self.output_dir),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        if self.conn is not None:
+            self.conn.close()
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5)
+        if self.output_dir is not None:
+            shutil.rmtree(self.output_dir, ignore_errors=True)
+        self.conn = self.process = self.output_dir = None
+
+    def _send(self, now):
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self._start_worker()
+        self.conn.send((self.generation, self.design))
+        self.sent, self.sent_at, self.started = self.generation, now, None
+
+    def poll(self):
+        """Collect finished levels and send the design once it has settled"""
+        now = time.time()
+        try:
+            while self.conn is not None and self.conn.poll():
+                kind, generation, result = self.conn.recv()
+                if kind == "start":
+                    self.started = generation
+                    continue
+                if generation == self.generation and result["level"] == 0:
+                    self.first_latency = now - self.changed
+                self.result, self.result_generation = result, generation
+        except (EOFError, OSError):
+            # The worker died, e.g. inside OFT; report it and start a new one on the next edit
+            if self.sent == self.generation and self.result_generation != self.generation:
+                self.result = {"error": f"Preview worker exited with code {self.process.exitcode}"}
+                self.result_generation = self.generation
+            self.stop()
+
+        if self.design is None:
+            return
+        if self.sent != self.generation and now - self.changed >= self.debounce:
+            self._send(now)
+        elif self.sent == self.generation and self.started != self.generation and now - self.sent_at > STALE_SECONDS:
+            # Still inside a solve of an older design, which OFT cannot interrupt
+            self.stop()
+            self._send(now)
+
+    @property
+    def current(self):
+        """True when result describes the design as it is now"""
+        return self.result is not None and self.result_generation == self.generation
+
+    @property
+    def finished(self):
+        """True when the current design has been solved at every level (or failed)"""
+        return self.current and ("error" in self.result or self.result["err_flag"] != 0
+                                 or self.result["level"] == self.result["levels"] - 1)
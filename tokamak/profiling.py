@@ -0,0 +1,179 @@
+# Per-stage profiling of an analysis run
+#
+# Every AnalysisRun carries a Tracer that records spans: the pipeline stages
+# (run.timed) and the solver calls inside them (run.span), i.e. each
+# tokamaker.solve(), eig_td, eig_wall, setup_td and step_td, each beta_p
+# point, the mesh lookup and the animation. A span holds its wall time, the
+# CPU time the process used meanwhile (OFT's threads included, so cpu/wall
+# above 1 means they were busy), the process's peak RSS when it ended and
+# whatever counts the caller attached (a solve's err_flag, a step_td's
+# nl_its, lin_its and nretry, ...).
+#
+# write() puts the spans next to the outputs as trace.jsonl, one JSON object
+# per span, and as trace.json in Chrome trace format (chrome://tracing or
+# https://ui.perfetto.dev). Scan points solved in worker processes carry
+# their spans back with the point, so each worker shows up as its own track.
+
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_FILENAME = "trace.jsonl"
+CHROME_TRACE_FILENAME = "trace.json"
+
+# Span arguments summed over calls in profile()
+COUNT_ARGS = ("nl_its", "lin_its", "nretry", "solves")
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where getrusage is missing"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak/1024.0**2 if sys.platform == "darwin" else peak/1024.0
+
+
+class _Span:
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.depth = self.tracer._enter()
+        self.start = time.time()
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        return self.args
+
+    def __exit__(self, exc_type, *exc):
+        wall = time.perf_counter() - self.wall0
+        cpu = time.process_time() - self.cpu0
+        self.tracer._exit()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer._record({
+            "name": self.name,
+            "cat": self.cat,
+            "start": self.start,
+            "wall": wall,
+            "cpu": cpu,
+            "peak_rss_mb": peak_rss_mb(),
+            "pid": os.getpid(),
+            "tid": threading.current_thread().name,
+            "depth": self.depth,
+            "args": self.args,
+        })
+        return False
+
+
+class Tracer:
+    """Spans recorded for one run, in the order they finished
+
+    span(name, **args) is a context manager whose value is the args dict,
+    so counts known only at the end can be added to it.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def span(self, name, cat="step", **args):
+        return _Span(self, name, cat, args)
+
+    def _enter(self):
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        return depth
+
+    def _exit(self):
+        self._local.depth -= 1
+
+    def _record(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def take(self):
+        """Spans recorded since the last take(), for sending back from a worker"""
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def extend(self, events):
+        """Add spans recorded in another process"""
+        with self._lock:
+            self.events.extend(events)
+
+    def profile(self):
+        """{span name: calls, wall, cpu, peak RSS, errors and summed COUNT_ARGS} over all spans"""
+        profile = {}
+        for event in self.events:
+            entry = profile.setdefault(event["name"], {"cat": event["cat"], "calls": 0, "wall": 0.0, "cpu": 0.0,
+                                                       "peak_rss_mb": None, "errors": 0})
+            entry["calls"] += 1
+            entry["wall"] += event["wall"]
+            entry["cpu"] += event["cpu"]
+            if event["peak_rss_mb"] is not None:
+                entry["peak_rss_mb"] = max(entry["peak_rss_mb"] or 0.0, event["peak_rss_mb"])
+            args = event["args"]
+            if args.get("err_flag") or "error" in args:
+                entry["errors"] += 1
+            for name in COUNT_ARGS:
+                if args.get(name) is not None:
+                    entry[name] = entry.get(name, 0) + args[name]
+        return profile
+
+    def write(self, output_dir):
+        """Write trace.jsonl and trace.json to output_dir, returning their filenames"""
+        events = sorted(self.events, key=lambda event: event["start"])
+        with open(os.path.join(output_dir, TRACE_FILENAME), "w") as f:
+            for event in events:
+                f.write(json.dumps(event, default=_json_default) + "\n")
+        with open(os.path.join(output_dir, CHROME_TRACE_FILENAME), "w") as f:
+            json.dump(chrome_trace(events), f, default=_json_default)
+        return [TRACE_FILENAME, CHROME_TRACE_FILENAME]
+
+
+def _json_default(value):
+    # numpy scalars from the solver
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def process_names(events):
+    """{pid: name} of the processes in a list of spans; the first span's process is the pipeline"""
+    main_pid = events[0]["pid"]
+    workers = dict.fromkeys(event["pid"] for event in events if event["pid"] != main_pid)
+    return {main_pid: "pipeline", **{pid: f"worker {i}" for i, pid in enumerate(workers, 1)}}
+
+
+def chrome_trace(events):
+    """Chrome trace format ("X" complete events, times in microseconds) of a list of spans"""
+    if not events:
+        return {"traceEvents": [], "displayTimeUnit": "ms"}
+    origin = min(event["start"] for event in events)
+    tids = {}
+    trace = []
+    for pid, name in process_names(events).items():
+        trace.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}})
+    for event in events:
+        tid = tids.setdefault((event["pid"], event["tid"]), len(tids))
+        trace.append({
+            "name": event["name"],
+            "cat": event["cat"],
+            "ph": "X",
+            "ts": (event["start"] - origin)*1E6,
+            "dur": event["wall"]*1E6,
+            "pid": event["pid"],
+            "tid": tid,
+            "args": {"cpu_s": event["cpu"], "peak_rss_mb": event["peak_rss_mb"], **event["args"]},
+        })
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
@@ -0,0 +1,305 @@
+# Latency-focused building blocks for the Streamlit design view
+#
+# Every slider tick reruns streamlit_app.py, so anything that only depends on
+# a subset of the inputs is memoized here: the isoflux boundary is cached on
+# quantized plasma parameters and the vessel traces are cached on the VV
+# coordinates, so moving a plasma slider only rebuilds the plasma trace.
+
+import time
+from collections import deque
+from functools import lru_cache
+
+import numpy as np
+import plotly.graph_objects as go
+
+from tokamak.geometry import isoflux_points, resize_polygon
+
+# Slider steps are 0.05, so 1e-6 only merges float noise, never distinct values
+QUANTUM = 1e-6
+BOUNDARY_CACHE_SIZE = 256
+VESSEL_CACHE_SIZE = 32
+
+# Target wall time for one rerun of the design view
+RERUN_BUDGET_MS = 100.0
+
+VV_WALL_THICKNESS = 0.04
+
+
+def quantize(value, quantum=QUANTUM):
+    """Round a float onto the cache grid so equal slider values share a key"""
+    return round(round(float(value)/quantum)*quantum, 12)
+
+
+@lru_cache(maxsize=BOUNDARY_CACHE_SIZE)
+def _isoflux_boundary(npts, r0, z0, a, kappa, delta):
+    boundary = isoflux_points(npts, r0, z0, a, kappa, delta)
+    boundary.setflags(write=False)
+    return boundary
+
+
+def isoflux_boundary(npts, r0, z0, a, kappa, delta):
+    """Memoized isoflux boundary (see tokamak.geometry.isoflux_points) keyed on quantized plasma parameters
+
+    The returned array is shared between callers and marked read-only.
+    """
+    return _isoflux_boundary(int(npts), quantize(r0), quantize(z0), quantize(a),
+                             quantize(kappa), quantize(delta))
+
+
+def _closed(points):
+    """Return x and y arrays with the first point appended to close the polygon"""
+    points = np.asarray(points, dtype=np.float64)
+    return np.append(points[:, 0], points[0, 0]), np.append(points[:, 1], points[0, 1])
+
+
+def coords_key(coords):
+    """Hashable, quantized key for a list of [R, Z] points"""
+    return tuple((quantize(r), quantize(z)) for r, z in coords)
+
+
+@lru_cache(maxsize=VESSEL_CACHE_SIZE)
+def _vessel_traces(vv_key):
+    vv_boundary = np.array(vv_key, dtype=np.float64)
+    vv_outer = resize_polygon(vv_boundary, VV_WALL_THICKNESS)
+
+    outer_x, outer_y = _closed(vv_outer)
+    inner_x, inner_y = _closed(vv_boundary)
+    outer = go.Scatter(
+        x=outer_x, y=outer_y,
+        fill='toself',
+        fillcolor='rgba(25,31,52,1.0)',
+        line=dict(color='black', width=2),
+        mode='lines',
+        name='VV Outer',
+        hoverinfo='skip'
+    )
+    inner = go.Scatter(
+        x=inner_x, y=inner_y,
+        fill='toself',
+        fillcolor='white',
+        line=dict(color='black', width=2),
+        mode='lines',
+        name='VV Inner',
+        hoverinfo='skip'
+    )
+    return outer, inner
+
+
+def vessel_traces(vv_coords):
+    """Cached (VV Outer, VV Inner) traces, rebuilt only when the vessel changes"""
+    return _vessel_traces(coords_key(vv_coords))
+
+
+def plasma_trace(boundary_pts):
+    """Filled plasma cross-section trace"""
+    x, y = _closed(boundary_pts)
+    return go.Scatter(
+        x=x, y=y,
+        fill='toself',
+        fillcolor='rgba(0,100,255,0.3)',
+        line=dict(color='blue', width=2),
+        mode='lines',
+        name='Plasma',
+        hoverinfo='skip'
+    )
+
+
+def vv_point_trace(vv_coords):
+    """Clickable vacuum vessel vertices"""
+    points = np.asarray(vv_coords, dtype=np.float64)
+    return go.Scatter(
+        x=points[:, 0], y=points[:, 1],
+        mode='markers',
+        marker=dict(
+            size=15,
+            color='orange',
+            symbol='circle',
+            line=dict(width=3, color='black')
+        ),
+        name='VV Points',
+        customdata=['vv'] * len(points),
+        hovertemplate='VV Point %{pointIndex}<br>R: %{x:.2f}<br>Z: %{y:.2f}<br>Click to edit<extra></extra>'
+    )
+
+
+def coil_trace(coil_coords, invalid_coils):
+    """Clickable coils, colored red when inside the vessel or plasma"""
+    points = np.asarray(coil_coords, dtype=np.float64)
+    coil_colors = ['red' if bad else 'darkred' for bad in invalid_coils]
+    coil_names = [f'Coil {i+1} (INVALID)' if bad else f'Coil {i+1}' for i, bad in enumerate(invalid_coils)]
+    return go.Scatter(
+        x=points[:, 0], y=points[:, 1],
+        mode='markers',
+        marker=dict(
+            size=18,
+            color=coil_colors,
+            symbol='circle',
+            line=dict(width=3, color='black')
+        ),
+        name='Coils',
+        customdata=['coil'] * len(points),
+        hovertemplate='%{text}<br>R: %{x:.2f}<br>Z: %{y:.2f}<br>Click to edit<extra></extra>',
+        text=coil_names
+    )
+
+
+def _segments_xy(segments):
+    """Join (n, 2) segments into one x/y array pair, separated by NaN so Plotly breaks the line
+
+    Arrays (rather than lists) go to the browser as compact typed arrays.
+    """
+    if len(segments) == 0:
+        return np.zeros(0), np.zeros(0)
+    gap = np.full((1, 2), np.nan)
+    joined = np.concatenate([part for segment in segments for part in (np.asarray(segment, dtype=np.float64), gap)])
+    return joined[:, 0], joined[:, 1]
+
+
+def preview_traces(result, current=True):
+    """Flux contours and LCFS of a live preview result (see tokamak.preview)
+
+    A result for an older design is drawn faded until the new one is solved.
+    """
+    opacity = 1.0 if current else 0.35
+    x, y = _segments_xy(result.get("contours", []))
+    contours = go.Scatter(
+        x=x, y=y,
+        mode='lines',
+        line=dict(color='rgba(90,90,90,0.8)', width=1),
+        opacity=opacity,
+        name='Preview Flux',
+        hoverinfo='skip'
+    )
+    x, y = _segments_xy(result.get("lcfs", []))
+    lcfs = go.Scatter(
+        x=x, y=y,
+        mode='lines',
+        line=dict(color='green', width=3, dash='dash'),
+        opacity=opacity,
+        name='Preview LCFS',
+        hoverinfo='skip'
+    )
+    return [contours, lcfs]
+
+
+# Coil flux contours span these percentiles of psi, so the peaks at the coils do not flatten them
+FIELD_LEVELS = 24
+FIELD_PERCENTILES = (5, 95)
+
+
+def contour_segments(x, y, values, levels):
+    """Contour lines of values on the regular x, y grid, as a list of (n, 2) segments"""
+    import contourpy
+
+    generator = contourpy.contour_generator(x, y, values, line_type="Separate")
+    return [segment for level in levels for segment in generator.lines(level) if len(segment) > 1]
+
+
+def vacuum_field_traces(r, z, psi, nulls):
+    """Coil flux contours and poloidal field nulls (see tokamak.greens.VacuumField)"""
+    levels = np.linspace(*np.percentile(psi, FIELD_PERCENTILES), FIELD_LEVELS)
+    x, y = _segments_xy(contour_segments(r, z, psi, levels))
+    contours = go.Scatter(
+        x=x, y=y,
+        mode='lines',
+        line=dict(color='rgba(150,60,200,0.6)', width=1),
+        name='Coil Flux',
+        hoverinfo='skip'
+    )
+    null_points = go.Scatter(
+        x=nulls[:, 0], y=nulls[:, 1],
+        mode='markers',
+        marker=dict(size=12, color='purple', symbol='x'),
+        name='Field Nulls',
+        hovertemplate='Field null<br>R: %{x:.2f}<br>Z: %{y:.2f}<extra></extra>'
+    )
+    return [contours, null_points]
+
+
+DESIGN_LAYOUT = go.Layout(
+    width=800,
+    height=750,
+    xaxis_title="R (m)",
+    yaxis_title="Z (m)",
+    xaxis=dict(scaleanchor="y", scaleratio=1),
+    yaxis=dict(scaleanchor="x", scaleratio=1),
+    showlegend=True,
+    dragmode='pan',
+    hovermode='closest',
+    clickmode='event+select'
+)
+
+
+def build_design_figure(vv_coords, boundary_pts, coil_coords, invalid_coils, preview=None, preview_current=True,
+                        vacuum=None):
+    """Assemble the design view from cached vessel traces and fresh plasma/point traces
+
+    Trace order is fixed (VV Outer, VV Inner, Plasma, VV Points, Coils) because
+    the click handler in streamlit_app.py dispatches on curve number; live
+    preview traces and the coil vacuum field ((r, z, psi, nulls)), if any,
+    come after them.
+    """
+    traces = list(vessel_traces(vv_coords))
+    traces.append(plasma_trace(boundary_pts))
+    traces.append(vv_point_trace(vv_coords))
+    if len(coil_coords) > 0:
+        traces.append(coil_trace(coil_coords, invalid_coils))
+    if preview is not None and "error" not in preview:
+        traces.extend(preview_traces(preview, preview_current))
+    if vacuum is not None:
+        traces.extend(vacuum_field_traces(*vacuum))
+    return go.Figure(data=traces, layout=DESIGN_LAYOUT)
+
+
+class LatencyTracker:
+    """Rolling record of rerun wall times, kept in st.session_state"""
+
+    def __init__(self, budget_ms=RERUN_BUDGET_MS, window=50):
+        self.budget_ms = budget_ms
+        self.samples = {}
+        self.window = window
+
+    def record(self, name, elapsed_ms):
+        self.samples.setdefault(name, deque(maxlen=self.window)).append(elapsed_ms)
+
+    def time(self, name):
+        """Context manager that records the wall time of its body under name"""
+        return _Timer(self, name)
+
+    def summary(self, name):
+        """Return (last, p50, p95) in ms for name, or None if nothing recorded"""
+        samples = self.samples.get(name)
+        if not samples:
+            return None
+        values = np.asarray(samples)
+        return samples[-1], float(np.percentile(values, 50)), float(np.percentile(values, 95))
+
+    def over_budget(self, name):
+        summary = self.summary(name)
+        return summary is not None and summary[0] > self.budget_ms
+
+
+class _Timer:
+    def __init__(self, tracker, name):
+        self.tracker = tracker
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed_ms = (time.perf_counter() - self.start)*1e3
+        self.tracker.record(self.name, self.elapsed_ms)
+        return False
+
+
+def latency_caption(tracker, name, label):
+    """One-line summary of a tracked timing for st.caption"""
+    summary = tracker.summary(name)
+    if summary is None:
+        return f"⏱️ {label}: no samples yet"
+    last, p50, p95 = summary
+    status = "over budget" if tracker.over_budget(name) else "within budget"
+    return (f"⏱️ {label}: {last:.0f} ms (p50 {p50:.0f} ms, p95 {p95:.0f} ms, "
+            f"budget {tracker.budget_ms:.0f} ms, {status})")
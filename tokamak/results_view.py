@@ -0,0 +1,199 @@
+# Results dashboard helpers for the Streamlit app
+#
+# The results section reruns with every widget change, so nothing here is
+# decoded or read twice: previews and file contents are memoized on
+# (path, mtime, size), which also drops stale entries as soon as a new run
+# rewrites a file. Outputs are discovered from the outputs list in
+# run_summary.json (the run manifest) rather than a fixed list of names.
+#
+# The performance panel draws the run's trace (see tokamak.profiling) as a
+# Gantt chart, one row per nesting level and process, and compares the
+# stage times of earlier runs kept in the run index.
+
+import glob
+import io
+import json
+import os
+from functools import lru_cache
+
+from tokamak.pipeline import STAGES, SUMMARY_FILENAME
+from tokamak.profiling import TRACE_FILENAME, process_names
+
+# Width of the previews shown in the dashboard; figures are saved at 300 dpi
+PREVIEW_WIDTH = 720
+THUMBNAIL_WIDTH = 240
+PREVIEW_CACHE_SIZE = 64
+FILE_CACHE_SIZE = 8
+
+FIGURE_EXTENSIONS = (".png",)
+ANIMATION_MIME = {".gif": "image/gif", ".webp": "image/webp", ".apng": "image/apng", ".mp4": "video/mp4"}
+DATA_MIME = {".h5": "application/x-hdf5", ".json": "application/json", ".jsonl": "application/x-ndjson"}
+
+# Earlier runs from the run index shown next to the latest one
+COMPARE_RUNS = 5
+
+
+def file_key(path):
+    """(path, mtime, size) identifying the current contents of a file"""
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+@lru_cache(maxsize=PREVIEW_CACHE_SIZE)
+def _preview(path, mtime_ns, size, width):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.thumbnail((width, image.height))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def preview(path, width=PREVIEW_WIDTH):
+    """PNG bytes of the image downscaled to at most width pixels wide"""
+    return _preview(*file_key(path), width)
+
+
+@lru_cache(maxsize=FILE_CACHE_SIZE)
+def _file_bytes(path, mtime_ns, size):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def file_bytes(path):
+    """Contents of a file, read once per version of the file"""
+    return _file_bytes(*file_key(path))
+
+
+@lru_cache(maxsize=FILE_CACHE_SIZE)
+def _summary(path, mtime_ns, size):
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_summary(output_dir):
+    """Parsed run_summary.json, or None if the run has not written one"""
+    path = os.path.join(output_dir, SUMMARY_FILENAME)
+    if not os.path.exists(path):
+        return None
+    return _summary(*file_key(path))
+
+
+def manifest_outputs(output_dir, summary=None):
+    """Files the run wrote, in the order it wrote them
+
+    Taken from the outputs list in run_summary.json; a run stopped before
+    writing its summary falls back to the numbered files in output_dir.
+    Files that no longer exist are left out.
+    """
+    if summary is not None:
+        names = list(dict.fromkeys(summary.get("outputs", [])))
+    else:
+        names = sorted(os.path.basename(p) for p in glob.glob(os.path.join(output_dir, "[0-9][0-9]_*")))
+    return [name for name in names if os.path.isfile(os.path.join(output_dir, name))]
+
+
+def classify_outputs(names):
+    """Split output filenames into (figures, animations, data files)"""
+    figures, animations, data = [], [], []
+    for name in names:
+        ext = os.path.splitext(name)[1].lower()
+        if ext in FIGURE_EXTENSIONS:
+            figures.append(name)
+        elif ext in ANIMATION_MIME:
+            animations.append(name)
+        elif ext in DATA_MIME:
+            data.append(name)
+    return figures, animations, data
+
+
+def output_title(name):
+    """'05_growth_rate_vs_beta_p.png' -> '05 · Growth rate vs beta p'"""
+    stem = os.path.splitext(name)[0]
+    number, _, words = stem.partition("_")
+    if not number.isdigit():
+        return stem.replace("_", " ")
+    return f"{number} · {words.replace('_', ' ').capitalize()}"
+
+
+@lru_cache(maxsize=FILE_CACHE_SIZE)
+def _trace(path, mtime_ns, size):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_trace(output_dir):
+    """Spans from trace.jsonl, or None if the run has not written one"""
+    path = os.path.join(output_dir, TRACE_FILENAME)
+    if not os.path.exists(path):
+        return None
+    return _trace(*file_key(path))
+
+
+def trace_figure(events):
+    """Gantt chart of a run's spans: time across, one row per process and nesting level"""
+    import plotly.graph_objects as go
+
+    origin = min(event["start"] for event in events)
+    processes = process_names(events)
+    rows = {}
+    for event in events:
+        process = processes[event["pid"]]
+        rows.setdefault(event["name"], []).append((f"{process} · {event['depth']}", event))
+
+    fig = go.Figure()
+    for name, spans in rows.items():
+        fig.add_trace(go.Bar(
+            name=name,
+            orientation="h",
+            y=[row for row, _ in spans],
+            x=[event["wall"] for _, event in spans],
+            base=[event["start"] - origin for _, event in spans],
+            customdata=[[event["cpu"], event["peak_rss_mb"] or 0.0,
+                         ", ".join(f"{k}={v:.3g}" if isinstance(v, float) else f"{k}={v}"
+                                   for k, v in event["args"].items())] for _, event in spans],
+            hovertemplate=(f"<b>{name}</b><br>start %{{base:.2f}} s, wall %{{x:.3f}} s<br>"
+                           "cpu %{customdata[0]:.3f} s, peak RSS %{customdata[1]:.0f} MB<br>"
+                           "%{customdata[2]}<extra></extra>"),
+        ))
+    labels = sorted({row for spans in rows.values() for row, _ in spans},
+                    key=lambda row: (row.split(" · ")[0] != "pipeline", row))
+    fig.update_layout(barmode="overlay", height=140 + 28*len(labels), xaxis_title="Time since start [s]",
+                      yaxis={"categoryorder": "array", "categoryarray": labels[::-1]},
+                      margin={"l": 10, "r": 10, "t": 30, "b": 10}, legend={"orientation": "h"})
+    return fig
+
+
+def stage_table(summary):
+    """Rows of stage, wall, CPU, CPU/wall and peak RSS from a run summary's profile"""
+    profile = summary.get("profile", {})
+    rows = []
+    for name, entry in profile.items():
+        wall = entry["wall"]
+        rows.append({
+            "span": name,
+            "calls": entry["calls"],
+            "wall [s]": round(wall, 3),
+            "cpu [s]": round(entry["cpu"], 3),
+            "cpu/wall": round(entry["cpu"]/wall, 2) if wall > 0 else None,
+            "peak RSS [MB]": entry["peak_rss_mb"],
+            "iterations": ", ".join(f"{k} {entry[k]}" for k in ("nl_its", "lin_its", "nretry", "solves") if k in entry),
+            "errors": entry["errors"],
+        })
+    return rows
+
+
+def comparison_figure(runs):
+    """Stacked stage wall times of (label, summary) runs, oldest first"""
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    for stage in STAGES:
+        fig.add_trace(go.Bar(name=stage, x=[label for label, _ in runs],
+                             y=[summary.get("timings", {}).get(stage, 0.0) for _, summary in runs]))
+    fig.update_layout(barmode="stack", height=320, yaxis_title="Wall time [s]",
+                      margin={"l": 10, "r": 10, "t": 30, "b": 10}, legend={"orientation": "h"})
+    return fig
@@ -0,0 +1,275 @@
+# Persistent index of completed analysis runs
+#
+# Runs are keyed on a hash of everything that determines their results: the
+# plasma parameters, advanced settings, vessel and coil coordinates, mesh
+# resolutions and the pipeline options (beta solver, VDE stepper, store and
+# animation formats). A completed run's figures, animation, results.h5 and
+# run_summary.json are copied to .cache/runs/<key>/ and its scalar results
+# go into an SQLite table with indexed columns, so an identical design is
+# served from the index instead of being solved again and past runs can be
+# queried:
+#
+#   python -m tokamak.run_index query "feedback_capability_param < 2" "q_95 > 3"
+#
+# Stored runs are evicted least recently used first once they exceed
+# max_bytes.
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+from tokamak import CACHE_DIR
+from tokamak.mesh_cache import canonical
+
+INDEX_VERSION = 1
+DEFAULT_INDEX_DIR = os.path.join(CACHE_DIR, "runs")
+DEFAULT_MAX_BYTES = 2*1024**3
+INDEX_FILENAME = "index.sqlite"
+
+# Pipeline options that change a run's results or artifacts, with run_pipeline's defaults
+DEFAULT_OPTIONS = {
+    "beta_solver": "continuation",
+    "vde_stepper": "adaptive",
+    "float32": False,
+    "animation_format": "gif",
+    "vector_format": None,
+}
+
+# Scalar columns, and where each comes from in run_summary.json
+DESIGN_COLUMNS = {
+    "major_radius": ("plasma_parameters", "major_radius"),
+    "minor_radius": ("plasma_parameters", "minor_radius"),
+    "elongation": ("plasma_parameters", "elongation"),
+    "triangularity": ("plasma_parameters", "triangularity"),
+    "B0": ("advanced_settings", "B0"),
+    "Ip_target": ("advanced_settings", "Ip_target"),
+    "Ip_ratio_target": ("advanced_settings", "Ip_ratio_target"),
+}
+RESULT_COLUMNS = ("err_flag", "growth_rate", "wall_time", "feedback_capability_param")
+EQUILIBRIUM_COLUMNS = ("Ip", "q_95", "beta_pol", "beta_n", "beta_tor", "l_i", "kappa", "delta")
+QUERY_COLUMNS = ("created", "last_used", "total_time", "bytes") + tuple(DESIGN_COLUMNS) + RESULT_COLUMNS \
+    + EQUILIBRIUM_COLUMNS
+INDEXED_COLUMNS = ("feedback_capability_param", "growth_rate", "q_95", "beta_pol", "last_used")
+
+_CONDITION = re.compile(r"^\s*(\w+)\s*(<=|>=|==|!=|=|<|>)\s*(\S+)\s*$")
+
+
+def run_key(design, **options):
+    """Hash of the design inputs and pipeline options that determine a run's results"""
+    from tokamak.pipeline import load_design
+
+    design = load_design(design)
+    payload = {
+        "version": INDEX_VERSION,
+        "plasma_parameters": canonical(design["plasma_parameters"]),
+        "advanced_settings": canonical(design["advanced_settings"]),
+        "vv_boundary": canonical(design["vacuum_vessel"]["boundary_coordinates"]),
+        "coil_coordinates": canonical(design["coil_coordinates"]),
+        "mesh_resolution": canonical(design["mesh_resolution"]),
+        "options": canonical({**DEFAULT_OPTIONS, **options}),
+    }
+    blob = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def parse_condition(text):
+    """'q_95 > 3' -> ('q_95', '>', 3.0), rejecting columns that are not indexed scalars"""
+    match = _CONDITION.match(text)
+    if match is None:
+        raise ValueError(f"Cannot parse condition {text!r}, expected e.g. 'q_95 > 3'")
+    column, op, value = match.groups()
+    if column not in QUERY_COLUMNS:
+        raise ValueError(f"Unknown column {column!r}, expected one of {QUERY_COLUMNS}")
+    return column, "=" if op == "==" else op, float(value)
+
+
+class RunIndex:
+    """SQLite index and artifact store of completed runs
+
+    Every call opens its own connection, so one RunIndex can be shared by
+    the Streamlit script, background jobs and the command line.
+    """
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.index_dir = index_dir
+        self.max_bytes = max_bytes
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, INDEX_FILENAME)
+        with self._connect() as conn:
+            columns = ", ".join(f"{name} REAL" for name in QUERY_COLUMNS if name not in ("created", "last_used",
+                                                                                          "total_time", "bytes"))
+            conn.execute("CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, created REAL, last_used REAL, "
+                         f"total_time REAL, bytes INTEGER, status TEXT, design TEXT, options TEXT, results TEXT, "
+                         f"outputs TEXT, {columns})")
+            for name in INDEXED_COLUMNS:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS runs_{name} ON runs ({name})")
+
+    @contextmanager
+    def _connect(self):
+        """Connection committed on success and closed afterwards"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def run_dir(self, key):
+        return os.path.join(self.index_dir, key)
+
+    def add(self, run):
+        """Store a completed AnalysisRun's artifacts and scalar results, returning its key"""
+        from tokamak.pipeline import SUMMARY_FILENAME
+
+        key = run_key(run.design, **run.result_options)
+        with open(os.path.join(run.output_dir, SUMMARY_FILENAME)) as f:
+            summary = json.load(f)
+        filenames = list(dict.fromkeys(run.outputs + [SUMMARY_FILENAME]))
+
+        # Copy into a temporary folder and rename, so a stored run is always complete
+        staging = tempfile.mkdtemp(prefix=".staging_", dir=self.index_dir)
+        try:
+            for filename in filenames:
+                source = os.path.join(run.output_dir, filename)
+                if os.path.isfile(source):
+                    shutil.copy2(source, os.path.join(staging, filename))
+            target = self.run_dir(key)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            os.replace(staging, target)
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+        stored = [name for name in filenames if os.path.isfile(os.path.join(target, name))]
+        size = sum(os.path.getsize(os.path.join(target, name)) for name in stored)
+
+        results = summary.get("results", {})
+        row = {name: summary["design"].get(section, {}).get(field) for name, (section, field) in DESIGN_COLUMNS.items()}
+        row.update({name: results.get(name) for name in RESULT_COLUMNS})
+        row.update({name: results.get("equilibrium", {}).get(name) for name in EQUILIBRIUM_COLUMNS})
+        now = time.time()
+        row.update(key=key, created=now, last_used=now, total_time=summary.get("total_time"), bytes=size,
+                   status=summary.get("status"), design=json.dumps(summary["design"]),
+                   options=json.dumps(run.result_options), results=json.dumps(results), outputs=json.dumps(stored))
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO runs ({', '.join(row)}) VALUES ({', '.join('?'*len(row))})",
+                         list(row.values()))
+        self.evict()
+        return key
+
+    def get(self, key):
+        """Entry for key as a dict, or None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM runs WHERE key = ?", (key,)).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def lookup(self, design, **options):
+        """Stored entry for an identical design and options, or None
+
+        Entries whose files have gone missing are dropped and reported as a miss.
+        """
+        entry = self.get(run_key(design, **options))
+        if entry is None:
+            return None
+        if not all(os.path.isfile(os.path.join(self.run_dir(entry["key"]), name)) for name in entry["outputs"]):
+            self.remove(entry["key"])
+            return None
+        return entry
+
+    def restore(self, key, output_dir):
+        """Copy a stored run's files into output_dir and mark it as used"""
+        entry = self.get(key)
+        os.makedirs(output_dir, exist_ok=True)
+        for name in entry["outputs"]:
+            shutil.copy2(os.path.join(self.run_dir(key), name), os.path.join(output_dir, name))
+        with self._connect() as conn:
+            conn.execute("UPDATE runs SET last_used = ? WHERE key = ?", (time.time(), key))
+        return entry
+
+    def query(self, *conditions, order_by="created", limit=None):
+        """Entries matching every condition ('feedback_capability_param < 2', ...)"""
+        parsed = [parse_condition(c) for c in conditions]
+        if order_by not in QUERY_COLUMNS:
+            raise ValueError(f"Unknown column {order_by!r}, expected one of {QUERY_COLUMNS}")
+        sql = "SELECT * FROM runs"
+        if parsed:
+            sql += " WHERE " + " AND ".join(f"{column} {op} ?" for column, op, _ in parsed)
+        sql += f" ORDER BY {order_by}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self._connect() as conn:
+            rows = conn.execute(sql, [value for _, _, value in parsed]).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def remove(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM runs WHERE key = ?", (key,))
+        shutil.rmtree(self.run_dir(key), ignore_errors=True)
+
+    def fingerprint(self):
+        """(number of runs, newest creation time), which changes whenever a run is added"""
+        with self._connect() as conn:
+            return tuple(conn.execute("SELECT COUNT(*), COALESCE(MAX(created), 0) FROM runs").fetchone())
+
+    def total_bytes(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM runs").fetchone()[0]
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used runs until the stored files fit in max_bytes"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        total = self.total_bytes()
+        removed = []
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, bytes FROM runs ORDER BY last_used").fetchall()
+        for row in rows:
+            if total <= max_bytes:
+                break
+            self.remove(row["key"])
+            total -= row["bytes"]
+            removed.append(row["key"])
+        return removed
+
+    @staticmethod
+    def _entry(row):
+        entry = dict(row)
+        for name in ("design", "options", "results", "outputs"):
+            entry[name] = json.loads(entry[name]) if entry[name] is not None else None
+        return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query and maintain the index of completed runs")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="Folder holding index.sqlite and stored runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    query = commands.add_parser("query", help="List runs matching conditions such as 'q_95 > 3'")
+    query.add_argument("conditions", nargs="*")
+    query.add_argument("--order-by", default="created")
+    query.add_argument("--limit", type=int)
+    evict = commands.add_parser("evict", help="Remove least recently used runs beyond a size budget")
+    evict.add_argument("--max-bytes", type=float, default=DEFAULT_MAX_BYTES)
+    args = parser.parse_args(argv)
+
+    index = RunIndex(args.index_dir)
+    if args.command == "evict":
+        removed = index.evict(int(args.max_bytes))
+        print(f"Removed {len(removed)} runs, {index.total_bytes()/1E6:.1f} MB stored")
+        return
+    columns = ("major_radius", "elongation", "triangularity", "B0", "growth_rate", "feedback_capability_param", "q_95")
+    print(f"{'key':12s} " + " ".join(f"{c[:12]:>12s}" for c in columns))
+    for entry in index.query(*args.conditions, order_by=args.order_by, limit=args.limit):
+        values = [entry[c] for c in columns]
+        print(f"{entry['key'][:12]:12s} " + " ".join(f"{v:12.4g}" if v is not None else f"{'-':>12s}" for v in values))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# HDF5 store for the numeric results of an analysis run
+#
+# run_pipeline() writes results.h5 next to the figures:
+#
+#   mesh/r, mesh/lc, mesh/reg           mesh the run was solved on
+#   equilibrium/psi                     initial equilibrium (attrs: stats)
+#   scan/<index>/psi                    psi snapshots of the VDE evolution, (steps, nodes)
+#   scan/<index>/zhist                  [[time, Z_opoint], ...] including t = 0
+#   scan/<index>/mode                   most unstable eigenmode
+#   scan/<index> attrs                  beta_target, beta_p, growth, stats, solves, vde
+#
+# In a serial scan every psi snapshot is appended to scan/<index>/psi as the
+# VDE takes it (point_snapshots), written APPEND_BLOCK at a time since each
+# h5py write has a fixed cost, so no point's history is held in memory;
+# points from the parallel scan's workers arrive whole and are written as
+# they finish. The rest of a point is written when it finishes, and psi
+# histories are read back lazily. psi histories are stored one snapshot per
+# chunk with gzip compression, optionally as float32. A point cut short by
+# cancellation has only its psi and is not listed by scan_indices().
+
+import json
+
+import numpy as np
+
+STORE_VERSION = 1
+STORE_FILENAME = "results.h5"
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+# Snapshots buffered by SnapshotSeries.append() before they are written together
+APPEND_BLOCK = 8
+
+
+def _json_attr(value):
+    """Encode a dict of results as a JSON string attribute"""
+    def convert(v):
+        if isinstance(v, np.generic):
+            return v.item()
+        if isinstance(v, np.ndarray):
+            return v.tolist()
+        return v
+    return json.dumps(value, default=convert)
+
+
+class SnapshotSeries:
+    """Rows of a stored 2-D dataset, read from the file one row at a time
+
+    Behaves like the list of psi arrays it replaces: len(), indexing and
+    iteration return numpy arrays, and append() adds a row while the store
+    is open for writing (written in blocks of APPEND_BLOCK, or by flush()).
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.shape = store.dataset(name).shape
+        self.pending = []
+
+    def __len__(self):
+        return self.shape[0] + len(self.pending)
+
+    def __getitem__(self, index):
+        self.flush()
+        return self.store.dataset(self.name)[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, row):
+        self.pending.append(np.asarray(row))
+        if len(self.pending) >= APPEND_BLOCK:
+            self.flush()
+
+    def flush(self):
+        """Write the appended rows still buffered"""
+        if not self.pending:
+            return
+        dataset = self.store.dataset(self.name)
+        start = self.shape[0]
+        dataset.resize(start + len(self.pending), axis=0)
+        dataset[start:] = np.array(self.pending)
+        self.shape = dataset.shape
+        self.pending = []
+
+
+class RunStore:
+    """results.h5 for one run, open for writing until close()
+
+    After close() (or for a store opened with mode="r") datasets are read
+    through a read-only handle opened on first access.
+    """
+
+    def __init__(self, path, mode="w", float32=False):
+        import h5py
+
+        self.path = path
+        self.float32 = float32
+        self.file = h5py.File(path, mode)
+        if mode != "r":
+            self.file.attrs["version"] = STORE_VERSION
+            self.file.attrs["float32"] = float32
+        else:
+            self.float32 = bool(self.file.attrs.get("float32", False))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _handle(self):
+        if self.file is None:
+            import h5py
+            self.file = h5py.File(self.path, "r")
+        return self.file
+
+    def dataset(self, name):
+        return self._handle()[name]
+
+    @property
+    def _field_dtype(self):
+        return np.float32 if self.float32 else np.float64
+
+    def write_mesh(self, mesh_pts, mesh_lc, mesh_reg):
+        group = self.file.require_group("mesh")
+        for name, data in (("r", mesh_pts), ("lc", mesh_lc), ("reg", mesh_reg)):
+            if name in group:
+                del group[name]
+            group.create_dataset(name, data=np.asarray(data), compression=COMPRESSION,
+                                 compression_opts=COMPRESSION_LEVEL)
+
+    def write_equilibrium(self, psi, stats):
+        group = self.file.require_group("equilibrium")
+        if "psi" in group:
+            del group["psi"]
+        group.create_dataset("psi", data=np.asarray(psi, dtype=self._field_dtype))
+        group.attrs["stats"] = _json_attr(stats)
+
+    def _new_point(self, name, psi):
+        if name in self.file:
+            del self.file[name]
+        group = self.file.create_group(name)
+        group.create_dataset("psi", data=psi, chunks=(1, psi.shape[1]),
+                             maxshape=(None,) + psi.shape[1:], compression=COMPRESSION,
+                             compression_opts=COMPRESSION_LEVEL, shuffle=True)
+        return group
+
+    def point_snapshots(self, index, nodes):
+        """Start scan point index with an empty psi history, returned as a SnapshotSeries to append to"""
+        name = f"scan/{index:03d}"
+        self._new_point(name, np.zeros((0, nodes), dtype=self._field_dtype))
+        return SnapshotSeries(self, name + "/psi")
+
+    def write_point(self, index, beta_target, point):
+        """Write one scan_point() result, returning a SnapshotSeries over its psi history
+
+        A psi history already appended through point_snapshots() is kept as written.
+        """
+        name = f"scan/{index:03d}"
+        results = point["results"]
+        if isinstance(results, SnapshotSeries) and results.store is self and results.name == name + "/psi":
+            results.flush()
+            group = self.file[name]
+        else:
+            psi = np.asarray(results, dtype=self._field_dtype).reshape(-1, len(point["mode"]))
+            group = self._new_point(name, psi)
+        group.create_dataset("zhist", data=np.asarray(point["zhist"], dtype=np.float64))
+        group.create_dataset("mode", data=np.asarray(point["mode"], dtype=self._field_dtype),
+                             compression=COMPRESSION, compression_opts=COMPRESSION_LEVEL)
+        group.attrs["beta_target"] = float(beta_target)
+        group.attrs["beta_p"] = float(point["beta_p"])
+        group.attrs["growth"] = float(point["growth"])
+        group.attrs["sim_time"] = float(point["sim_time"])
+        for key in ("stats", "vde"):
+            if point.get(key) is not None:
+                group.attrs[key] = _json_attr(point[key])
+        group.attrs["solves"] = _json_attr({k: point.get(k) for k in ("solves", "solve_time", "converged")})
+        self.file.flush()
+        return SnapshotSeries(self, name + "/psi")
+
+    def scan_indices(self):
+        """Indices of the scan points in the file, in scan order"""
+        scan = self._handle().get("scan")
+        return sorted(int(name) for name, group in scan.items() if "zhist" in group) if scan is not None else []
+
+    def read_point(self, index):
+        """Scalars and lazy psi history of one scan point"""
+        name = f"scan/{index:03d}"
+        group = self._handle()[name]
+        point = {key: value for key, value in group.attrs.items()}
+        for key in ("stats", "vde", "solves"):
+            if key in point:
+                point[key] = json.loads(point[key])
+        point["zhist"] = group["zhist"][()]
+        point["mode"] = group["mode"][()]
+        point["results"] = SnapshotSeries(self, name + "/psi")
+        return point
+
+
+def open_run_store(path):
+    """Open an existing results.h5 for lazy reading"""
+    return RunStore(path, mode="r")
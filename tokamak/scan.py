@@ -0,0 +1,156 @@
+# Parallel beta_p stability scan
+#
+# Every beta_p point re-solves its own equilibrium, so points are
+# independent apart from the warm start carried between neighbours.
+# parallel_beta_scan() hands the points to a pool of spawned processes; each
+# worker builds its own OFT_env and TokaMaker once from the parent's mesh
+# arrays, then runs pipeline.scan_point() for every point it is given.
+# Points are handed out in scan order so each worker's warm start (the
+# previous converged psi and Ip_ratio scale) comes from a nearby point, and
+# results are put back in scan order.
+#
+# Scaling benchmark:
+#   python -m tokamak.scan examples/negative_triangulation/design_20250630_171055.json --max-workers 4
+
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from tokamak import oft
+
+# How often the parent checks for cancellation while waiting on workers
+POLL_SECONDS = 0.5
+
+_worker_run = None
+_worker_seed = None
+
+
+def _init_worker(design, output_dir, mesh_arrays, boundary_pts, nthreads, beta_solver, vde_stepper):
+    """Build this worker's TokaMaker from the shared mesh, ready for scan_point()"""
+    global _worker_run
+    from tokamak import pipeline
+
+    oft.ensure_oft_path()
+    run = pipeline.AnalysisRun(design, output_dir, nthreads=nthreads, beta_solver=beta_solver,
+                               vde_stepper=vde_stepper)
+    run.boundary_pts = boundary_pts
+    run.vv_boundary = np.array(run.design["vacuum_vessel"]["boundary_coordinates"], dtype=np.float64)
+    run.mesh_pts, run.mesh_lc, run.mesh_reg, run.coil_dict, run.cond_dict = mesh_arrays
+    pipeline.setup_tokamaker(run)
+    pipeline.start_beta_scan(run)
+    _worker_run = run
+
+
+def _scan_task(task):
+    global _worker_seed
+    from tokamak import pipeline
+
+    index, beta_target = task
+    print('Computing Beta_approx [%] {0:.2f}'.format(beta_target*100.0))
+    point, _worker_seed = pipeline.scan_point(_worker_run, beta_target, _worker_seed)
+    # The worker's spans (its setup included, with the first point) go back to the parent's trace
+    point["trace"] = _worker_run.tracer.take()
+    return index, point
+
+
+def parallel_beta_scan(run, beta_targets):
+    """Run scan_point() for every target on run.scan_workers processes
+
+    Fills run.beta_p, growth, modes, zhist and psi_history in scan order.
+    Cancellation is checked while waiting on workers; the pool is
+    terminated and the points finished so far are kept.
+    """
+    from tokamak.pipeline import RunCancelled, add_scan_point, start_beta_scan, store_scan_point
+
+    beta_targets = list(beta_targets)
+    npoints = len(beta_targets)
+    workers = min(run.scan_workers, npoints)
+    start_beta_scan(run)
+    points = [None]*npoints
+    mesh_arrays = (run.mesh_pts, run.mesh_lc, run.mesh_reg, run.coil_dict, run.cond_dict)
+
+    run.progress("beta_scan", step=0, total=npoints, message=f"Starting {workers} scan workers")
+    context = multiprocessing.get_context("spawn")
+    try:
+        with context.Pool(workers, initializer=_init_worker,
+                          initargs=(run.design, run.output_dir, mesh_arrays, run.boundary_pts, run.worker_threads,
+                                    run.beta_solver, run.vde_stepper)) as pool:
+            pending = pool.imap_unordered(_scan_task, list(enumerate(beta_targets)))
+            for done in range(1, npoints + 1):
+                while True:
+                    try:
+                        index, point = pending.next(timeout=POLL_SECONDS)
+                        break
+                    except multiprocessing.TimeoutError:
+                        if run.cancelled:
+                            raise RunCancelled("Cancelled during beta_scan")
+                run.tracer.extend(point.pop("trace"))
+                # Store on arrival so only unfinished points' snapshots stay in memory
+                store_scan_point(run, index, beta_targets[index], point)
+                points[index] = point
+                run.progress("beta_scan", step=done, total=npoints,
+                             message='Computed Beta_p = {0:.2f} ({1}/{2})'.format(point["beta_p"], done, npoints))
+    finally:
+        for point in points:
+            if point is not None:
+                add_scan_point(run, point)
+
+
+def benchmark_scaling(design, output_dir, max_workers, worker_threads=1, beta_targets=None,
+                      beta_solver="continuation"):
+    """Time the beta_p scan on 1..max_workers processes
+
+    Returns a list of (workers, seconds, equilibrium solves, max growth
+    rate difference from the serial scan).
+    """
+    from tokamak import pipeline
+
+    beta_targets = pipeline.BETA_SCAN if beta_targets is None else beta_targets
+    run = pipeline.AnalysisRun(design, output_dir, nthreads=worker_threads, worker_threads=worker_threads,
+                               beta_solver=beta_solver)
+    pipeline.prepare_geometry(run)
+    pipeline.build_mesh(run)
+    pipeline.setup_tokamaker(run)
+
+    rows = []
+    reference = None
+    for workers in range(1, max_workers + 1):
+        run.scan_workers = workers
+        start = time.perf_counter()
+        pipeline.run_beta_scan(run, beta_targets)
+        seconds = time.perf_counter() - start
+        growth = np.array(run.growth)
+        if reference is None:
+            reference = growth
+        solves = sum(point["solves"] for point in run.scan_solves)
+        rows.append((workers, seconds, solves, float(np.max(np.abs(growth - reference)))))
+    return rows
+
+
+def main(argv=None):
+    from tokamak.pipeline import latest_design_file
+
+    parser = argparse.ArgumentParser(description="Benchmark the beta_p scan on 1..N worker processes")
+    parser.add_argument("design", help="Design JSON, or a folder to take the newest design from")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count(), help="Largest pool to time")
+    parser.add_argument("--worker-threads", type=int, default=1, help="OFT threads per worker")
+    parser.add_argument("--points", type=int, default=10, help="Number of beta_p points")
+    parser.add_argument("--beta-solver", choices=("continuation", "fixed"), default="continuation",
+                        help="How scan points reach their beta_p target")
+    args = parser.parse_args(argv)
+
+    design_path = latest_design_file(args.design) if os.path.isdir(args.design) else args.design
+    output_dir = os.path.dirname(os.path.abspath(design_path))
+    rows = benchmark_scaling(design_path, output_dir, args.max_workers, args.worker_threads,
+                             np.linspace(0.01, 0.5, args.points), args.beta_solver)
+    serial = rows[0][1]
+    print(f"{'workers':>8s} {'wall [s]':>10s} {'speedup':>8s} {'efficiency':>10s} {'GS solves':>10s} {'max |dgamma|':>13s}")
+    for workers, seconds, solves, dgamma in rows:
+        print(f"{workers:8d} {seconds:10.2f} {serial/seconds:8.2f} {serial/seconds/workers:10.2f} {solves:10d} {dgamma:13.3e}")
+
+
+if __name__ == "__main__":
+    main()
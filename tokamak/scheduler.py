@@ -0,0 +1,302 @@
+# Run directories and a shared worker queue for the Streamlit server
+#
+# Every Lock Design gets its own run ID and folder under examples/runs, so
+# sessions on one server never write to or clear each other's outputs.
+# Analyses, and the coil optimizer's TokaMaker confirmations, are submitted
+# to one JobScheduler per server process: at most `workers`
+# tokamak.jobs.AnalysisJob processes run at once, each pinned to its own
+# threads_per_job cores and run under a memory and CPU time limit; the rest
+# wait in a bounded queue. The queue is fair-share between sessions: the
+# next job to start is the oldest one from the session with the fewest
+# running jobs, so one session queueing several runs cannot hold back the
+# others. A daemon thread starts queued jobs as workers free up.
+# submit_group() queues several jobs that belong together, such as one coil
+# confirmation per candidate so free workers solve them side by side; the
+# group counts once towards the session's queued runs.
+#
+# `load` measures the throughput and queue/turnaround latency percentiles
+# of N simulated sessions submitting at once:
+#
+#   python -m tokamak.scheduler load examples/negative_triangulation --sessions 8 --workers 2 --threads 1
+
+import argparse
+import itertools
+import json
+import os
+import secrets
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from tokamak import layout
+from tokamak.jobs import AnalysisJob
+
+DEFAULT_RUNS_DIR = os.environ.get("TOKAMAK_RUNS_DIR", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples", "runs"))
+# Concurrent analyses; unset or 0 fits as many as the cores allow
+DEFAULT_WORKERS = int(os.environ.get("TOKAMAK_ANALYSIS_WORKERS", "0")) or None
+MAX_QUEUED = 16
+QUEUED_PER_OWNER = 2
+# Share of the machine's memory divided between the running jobs
+MEMORY_SHARE = 0.8
+DISPATCH_SECONDS = 0.5
+RUN_RETENTION_DAYS = 7
+LOAD_FILENAME = "load.json"
+
+
+class QueueFull(RuntimeError):
+    """The scheduler's queue, or the session's share of it, is full"""
+
+
+def new_run_id():
+    """Sortable, collision-resistant ID for a locked design"""
+    return f"{time.strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}"
+
+
+def run_dir(run_id, runs_dir=DEFAULT_RUNS_DIR):
+    return os.path.join(runs_dir, run_id)
+
+
+def new_run(design, runs_dir=DEFAULT_RUNS_DIR):
+    """Create a run folder holding design as design_<timestamp>.json; returns (run_id, folder, design_path)"""
+    run_id = new_run_id()
+    folder = run_dir(run_id, runs_dir)
+    os.makedirs(folder)
+    design_path = os.path.join(folder, f"design_{design.get('timestamp', run_id[:15])}.json")
+    with open(design_path, "w") as f:
+        json.dump(dict(design, run_id=run_id), f, indent=2)
+    return run_id, folder, design_path
+
+
+def prune_runs(runs_dir=DEFAULT_RUNS_DIR, max_age_days=RUN_RETENTION_DAYS, keep=()):
+    """Delete run folders not modified for max_age_days, except those in keep; returns the removed run IDs"""
+    if not os.path.isdir(runs_dir):
+        return []
+    cutoff = time.time() - max_age_days*86400
+    removed = []
+    for run_id in os.listdir(runs_dir):
+        folder = os.path.join(runs_dir, run_id)
+        if run_id in keep or not os.path.isdir(folder) or os.path.getmtime(folder) > cutoff:
+            continue
+        shutil.rmtree(folder, ignore_errors=True)
+        removed.append(run_id)
+    return removed
+
+
+def available_cpus():
+    """Cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def default_memory_mb(workers):
+    """MEMORY_SHARE of physical memory split between workers, None where it cannot be read"""
+    try:
+        total = os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+    return MEMORY_SHARE*total/1024**2/workers
+
+
+class JobScheduler:
+    """Bounded, fair-share queue of analysis jobs on a fixed number of worker slots
+
+    threads_per_job defaults to the planned sweep layout's threads per
+    process (see tokamak.layout) and workers to as many jobs as fit on the
+    available cores with that many threads each. memory_mb and cpu_seconds are the
+    per-job limits (memory_mb defaults to default_memory_mb(workers)).
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, threads_per_job=None, max_queued=MAX_QUEUED,
+                 queued_per_owner=QUEUED_PER_OWNER, memory_mb=None, cpu_seconds=None, dispatch_thread=True):
+        cpus = available_cpus()
+        self.threads_per_job = threads_per_job or layout.plan("sweep")["nthreads"]
+        self.workers = workers or max(1, layout.available_cores()//self.threads_per_job)
+        self.max_queued = max_queued
+        self.queued_per_owner = queued_per_owner
+        self.memory_mb = memory_mb if memory_mb is not None else default_memory_mb(self.workers)
+        self.cpu_seconds = cpu_seconds
+        self.free_cpus = cpus
+        self.queue = []
+        self.running = []
+        self.groups = itertools.count()
+        self.lock = threading.Lock()
+        self._thread = None
+        if dispatch_thread:
+            self._thread = threading.Thread(target=self._dispatch_loop, name="job-scheduler", daemon=True)
+            self._thread.start()
+
+    def submit(self, design, output_dir, owner, **options):
+        """Queue a run of design writing to output_dir, returning its AnalysisJob; raises QueueFull"""
+        return self.submit_group(design, owner, [(output_dir, options)])[0]
+
+    def submit_group(self, design, owner, runs):
+        """Queue one job per (output_dir, options) in runs, all or none, returning their AnalysisJobs
+
+        The group counts as one of the owner's queued runs; raises QueueFull.
+        """
+        with self.lock:
+            if len(self.queue) + len(runs) > self.max_queued:
+                needed = "" if len(runs) == 1 else f" and these {len(runs)} need room"
+                raise QueueFull(f"{len(self.queue)} analyses are already waiting{needed}, try again shortly")
+            if len({job.group for job in self.queue if job.owner == owner}) >= self.queued_per_owner:
+                raise QueueFull(f"This session already has {self.queued_per_owner} analyses waiting")
+            group = next(self.groups)
+            jobs = []
+            for output_dir, options in runs:
+                job = AnalysisJob(design, output_dir, nthreads=self.threads_per_job, owner=owner,
+                                  memory_mb=self.memory_mb, cpu_seconds=self.cpu_seconds, **options)
+                job.group = group
+                jobs.append(job)
+            self.queue.extend(jobs)
+            self._dispatch()
+        return jobs
+
+    def cancel(self, job, terminate=False):
+        """Cancel a queued or running job; terminate stops a running one without waiting for a checkpoint"""
+        with self.lock:
+            if job in self.queue:
+                self.queue.remove(job)
+        if terminate:
+            job.terminate()
+        else:
+            job.cancel()
+
+    def _order(self):
+        """Queued jobs in the order they will start"""
+        counts = {}
+        for job in self.running:
+            counts[job.owner] = counts.get(job.owner, 0) + 1
+        waiting = list(self.queue)
+        order = []
+        while waiting:
+            job = min(waiting, key=lambda queued: (counts.get(queued.owner, 0), queued.submitted))
+            waiting.remove(job)
+            order.append(job)
+            counts[job.owner] = counts.get(job.owner, 0) + 1
+        return order
+
+    def position(self, job):
+        """1-based place of job in the queue, None once it has started"""
+        with self.lock:
+            order = self._order()
+        return order.index(job) + 1 if job in order else None
+
+    def status(self):
+        with self.lock:
+            return {"workers": self.workers, "running": len(self.running), "queued": len(self.queue)}
+
+    def dispatch(self):
+        """Release the slots of finished jobs and start queued ones in their place"""
+        with self.lock:
+            self._dispatch()
+
+    def _dispatch(self):
+        for job in [job for job in self.running if job.exitcode is not None]:
+            self.running.remove(job)
+            if job.cpus:
+                self.free_cpus = sorted(self.free_cpus + job.cpus)
+        while self.queue and len(self.running) < self.workers:
+            job = self._order()[0]
+            self.queue.remove(job)
+            cpus = None
+            if len(self.free_cpus) >= self.threads_per_job:
+                cpus, self.free_cpus = self.free_cpus[:self.threads_per_job], self.free_cpus[self.threads_per_job:]
+            job.start(cpus)
+            self.running.append(job)
+
+    def _dispatch_loop(self):
+        while True:
+            time.sleep(DISPATCH_SECONDS)
+            self.dispatch()
+
+
+def _percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return {}
+    return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+            "max": float(values.max())}
+
+
+def measure_load(design, sessions, runs_dir, scheduler, poll_seconds=1.0):
+    """Submit design from `sessions` simulated sessions at once and poll them as the app would
+
+    Returns throughput (completed runs per minute) and percentiles of the
+    queue wait and the submit-to-finish turnaround.
+    """
+    from tokamak.pipeline import load_design
+
+    design = load_design(design)
+    jobs = []
+    start = time.time()
+    for session in range(sessions):
+        run_id, folder, _ = new_run(design, runs_dir)
+        jobs.append(scheduler.submit(design, folder, owner=f"session_{session}"))
+    while not all(job.finished for job in jobs):
+        time.sleep(poll_seconds)
+        scheduler.dispatch()
+        for job in jobs:
+            job.poll()
+    end = max(job.events[-1]["time"] if job.events else time.time() for job in jobs)
+
+    completed = [job for job in jobs if job.status == "completed"]
+    return {
+        "sessions": sessions,
+        "workers": scheduler.workers,
+        "threads_per_job": scheduler.threads_per_job,
+        "memory_mb": scheduler.memory_mb,
+        "completed": len(completed),
+        "failed": sum(job.status == "failed" for job in jobs),
+        "makespan": end - start,
+        "throughput_per_minute": 60.0*len(completed)/(end - start),
+        "wait": _percentiles([job.waited for job in jobs]),
+        "turnaround": _percentiles([job.events[-1]["time"] - job.submitted for job in completed]),
+        "run": _percentiles([job.elapsed for job in completed]),
+    }
+
+
+def main(argv=None):
+    from tokamak.pipeline import latest_design_file
+
+    parser = argparse.ArgumentParser(description="Load-test the analysis queue and maintain run folders")
+    parser.add_argument("--runs-dir", default=DEFAULT_RUNS_DIR, help="Folder holding one folder per run")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("load", help="Throughput and latency of N sessions analysing at once")
+    load.add_argument("design", help="Design JSON, or a folder to take the newest design from")
+    load.add_argument("--sessions", type=int, default=4, help="Simulated concurrent sessions")
+    load.add_argument("--workers", type=int, help="Concurrent runs (default: cores // threads)")
+    load.add_argument("--threads", type=int, help="OFT threads per run (default: the planned layout)")
+    load.add_argument("--memory-mb", type=float, help="Memory limit per run")
+    load.add_argument("--cpu-seconds", type=float, help="CPU time limit per run")
+    prune = commands.add_parser("prune", help="Delete run folders older than --max-age-days")
+    prune.add_argument("--max-age-days", type=float, default=RUN_RETENTION_DAYS)
+    args = parser.parse_args(argv)
+
+    if args.command == "prune":
+        removed = prune_runs(args.runs_dir, args.max_age_days)
+        print(f"Removed {len(removed)} run folders from {args.runs_dir}")
+        return
+
+    design_path = latest_design_file(args.design) if os.path.isdir(args.design) else args.design
+    scheduler = JobScheduler(args.workers, args.threads, max_queued=args.sessions, queued_per_owner=1,
+                             memory_mb=args.memory_mb, cpu_seconds=args.cpu_seconds, dispatch_thread=False)
+    result = measure_load(design_path, args.sessions, args.runs_dir, scheduler)
+    print(f"{result['sessions']} sessions on {result['workers']} workers x {result['threads_per_job']} threads: "
+          f"{result['completed']} completed, {result['failed']} failed in {result['makespan']:.1f} s "
+          f"({result['throughput_per_minute']:.2f} runs/min)")
+    print(f"{'seconds':12s} {'p50':>8s} {'p95':>8s} {'max':>8s}")
+    for name in ("wait", "run", "turnaround"):
+        stats = result[name]
+        if stats:
+            print(f"{name:12s} {stats['p50']:8.1f} {stats['p95']:8.1f} {stats['max']:8.1f}")
+    os.makedirs(args.runs_dir, exist_ok=True)
+    with open(os.path.join(args.runs_dir, LOAD_FILENAME), "w") as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# Eigen-solves of the stability stage
+#
+# The analysis only uses the most unstable plasma mode (eig_vals[0, 0] and
+# eig_vecs[0, :] of eig_td) and the second wall eigenvalue of eig_wall (the
+# wall time), so:
+#
+#   - eig_wall depends on the mesh and the vessel resistivity only, not on
+#     the plasma. WallModeCache keeps its eigenpairs on disk under the mesh
+#     key, so runs and sweep designs on the same mesh differing in B0, Ip or
+#     profiles skip the solve.
+#     The entries loaded last are also kept in memory, so a process running
+#     the same mesh again (a sweep, the app's worker) skips the .npz read.
+#   - eig_td asks for TD_NEIGS eigenpairs instead of 10. Along the beta_p
+#     scan, each point shifts it to SHIFT_FACTOR times the previous point's
+#     dominant eigenvalue. The mode it is looking for is then the one
+#     nearest the shift, where shift-invert converges fastest. OFT's eig_td
+#     takes no starting vector, so the shift is the only part of the
+#     previous solution that can be reused. A shifted solve that finds no
+#     unstable mode is repeated with the cold shift.
+#
+# Every solve is traced as a span of the run and timed into the list passed
+# as solves, so the saving shows up in run_summary.json (see
+# pipeline.format_eig_solves).
+
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from tokamak import CACHE_DIR
+
+DEFAULT_CACHE_DIR = os.path.join(CACHE_DIR, "wall_modes")
+DEFAULT_MAX_BYTES = 100*1024**2
+CACHE_VERSION = 1
+# Entries kept in memory per process, shared by all WallModeCache instances
+LOADED_ENTRIES = 8
+
+TD_NEIGS = 3
+# The wall time is 1/eigval_wall[1, 0]
+WALL_NEIGS = 2
+BASELINE_OMEGA = -1.E4
+SCAN_OMEGA = -1.E5
+SHIFT_FACTOR = 1.25
+
+
+def wall_key(mesh_key, order, neigs=WALL_NEIGS):
+    """Cache key of the wall modes of a mesh (mesh_key already covers the vessel resistivity)"""
+    return f"{mesh_key}_o{order}_n{neigs}_v{CACHE_VERSION}"
+
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+
+
+def _remember(path, modes):
+    with _loaded_lock:
+        _loaded[path] = modes
+        _loaded.move_to_end(path)
+        while len(_loaded) > LOADED_ENTRIES:
+            _loaded.popitem(last=False)
+
+
+class WallModeCache:
+    """Size-bounded, least-recently-used store of eig_wall results
+
+    Each entry is one .npz file of the eigenvalues and eigenvectors; file
+    mtimes track recency as in tokamak.mesh_cache.MeshCache. The last
+    LOADED_ENTRIES entries read or written are served from memory while
+    their file exists.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """(eig_vals, eig_vecs) or None on a miss; unreadable entries are deleted"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with _loaded_lock:
+            modes = _loaded.get(path)
+        if modes is None:
+            try:
+                with np.load(path) as data:
+                    modes = data["vals"], data["vecs"]
+            except Exception:
+                self._discard(path)
+                return None
+        _remember(path, modes)
+        os.utime(path)
+        return modes
+
+    def put(self, key, vals, vecs):
+        """Store wall modes under key, then evict old entries beyond max_bytes"""
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, vals=np.asarray(vals), vecs=np.asarray(vecs))
+            os.replace(tmp_path, self.path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        _remember(self.path(key), (np.asarray(vals), np.asarray(vecs)))
+        self.evict()
+
+    def evict(self):
+        """Delete least-recently-used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((os.path.join(self.cache_dir, name), stat.st_size, stat.st_mtime))
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total <= self.max_bytes:
+                break
+            self._discard(path)
+            total -= size
+
+    def _discard(self, path):
+        with _loaded_lock:
+            _loaded.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _record(solves, call, seconds, **info):
+    if solves is not None:
+        solves.append({"call": call, "seconds": seconds, **info})
+
+
+def plasma_modes(run, omega, neigs=TD_NEIGS, include_bounds=True, solves=None):
+    """eig_td at shift omega, sorted most unstable (most negative) first"""
+    with run.span("eig_td", omega=float(omega), neigs=neigs):
+        start = time.perf_counter()
+        vals, vecs = run.tokamaker.eig_td(omega, neigs, include_bounds)
+        seconds = time.perf_counter() - start
+    _record(solves, "eig_td", seconds, omega=float(omega), neigs=neigs)
+    order = np.argsort(vals[:, 0])
+    return vals[order], vecs[order]
+
+
+def scan_shift(previous):
+    """eig_td shift for a scan point whose neighbour's dominant eigenvalue was previous (None: cold)"""
+    if previous is None or not np.isfinite(previous) or previous >= 0.0:
+        return SCAN_OMEGA
+    return SHIFT_FACTOR*previous
+
+
+def dominant_mode(run, previous=None, solves=None):
+    """Most unstable mode of the current equilibrium for a scan point
+
+    Shifted from the previous point's eigenvalue when there is one; a
+    shifted solve that returns no unstable mode is repeated cold. Returns
+    (eig_vals, eig_vecs).
+    """
+    omega = scan_shift(previous)
+    vals, vecs = plasma_modes(run, omega, include_bounds=False, solves=solves)
+    if omega != SCAN_OMEGA and not (np.isfinite(vals[0, 0]) and vals[0, 0] < 0.0):
+        vals, vecs = plasma_modes(run, SCAN_OMEGA, include_bounds=False, solves=solves)
+    return vals, vecs
+
+
+def wall_modes(run, order, cache=None, solves=None):
+    """eig_wall eigenpairs, from the cache when run's mesh has been solved before
+
+    A run without a mesh_key (a mesh not from the mesh cache) skips the cache.
+    """
+    mesh_key = getattr(run, "mesh_key", None)
+    key = None if mesh_key is None else wall_key(mesh_key, order)
+    with run.span("eig_wall", neigs=WALL_NEIGS) as span:
+        start = time.perf_counter()
+        modes = None
+        if key is not None:
+            cache = WallModeCache() if cache is None else cache
+            modes = cache.get(key)
+        span["cached"] = modes is not None
+        if modes is None:
+            modes = run.tokamaker.eig_wall(WALL_NEIGS)
+            if key is not None:
+                cache.put(key, *modes)
+        seconds = time.perf_counter() - start
+    _record(solves, "eig_wall", seconds, neigs=WALL_NEIGS, cached=span["cached"])
+    return modes
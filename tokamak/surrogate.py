@@ -0,0 +1,323 @@
+# Surrogate models of the analysis for instant feedback in the designer
+#
+# Completed runs in the run index (and, when trained from the command line,
+# design sweeps) are turned into samples: a fixed-length design vector and
+# the growth rate, feedback capability parameter, largest coil current and
+# q95 the pipeline computed for it. Each target gets a Gaussian-process
+# regressor (squared-exponential kernel on min/max-normalized features,
+# length scale and noise picked by marginal likelihood), which predicts a
+# mean and a standard deviation in well under a millisecond.
+#
+# Models are saved to .cache/surrogate/model.npz. get_surrogate() reloads
+# them and refits whenever the run index has gained runs, so predictions
+# improve as analyses land.
+#
+#   python -m tokamak.surrogate train --sweep examples/sweep_1
+
+import argparse
+import glob
+import json
+import re
+import os
+import time
+
+import numpy as np
+
+from tokamak import CACHE_DIR
+
+DEFAULT_MODEL_PATH = os.path.join(CACHE_DIR, "surrogate", "model.npz")
+TARGETS = ("growth_rate", "feedback_capability_param", "max_coil_current", "q_95")
+MIN_SAMPLES = 3
+# Seconds between checks of the run index for new runs
+REFRESH_SECONDS = 5.0
+# Search hyperparameters again once the training set has grown by this factor
+RESEARCH_GROWTH = 1.25
+
+LENGTH_SCALES = (0.1, 0.2, 0.5, 1.0, 2.0)
+NOISE_LEVELS = (1E-6, 1E-4, 1E-2, 1E-1)
+# Reused noise levels are raised 100-fold at most this many times before fitting gives up
+NOISE_RETRIES = 3
+
+PLASMA_FEATURES = ("major_radius", "minor_radius", "elongation", "triangularity")
+SETTING_FEATURES = ("B0", "Ip_target", "Ip_ratio_target", "ffp_alpha", "ffp_gamma", "pp_alpha", "pp_gamma")
+# The vessel can have any number of points, so it is described by its extent and area
+VESSEL_FEATURES = ("vv_rmin", "vv_rmax", "vv_zmin", "vv_zmax", "vv_area")
+NCOILS = 8
+FEATURES = PLASMA_FEATURES + SETTING_FEATURES + VESSEL_FEATURES \
+    + tuple(f"PF_{i}_{axis}" for i in range(1, NCOILS + 1) for axis in "RZ")
+
+# Sweep rows hold each coil's current as coil_<name>; other coil_ columns are sweep parameters
+SWEEP_COIL_CURRENT = re.compile(r"coil_PF_\d+")
+
+_surrogate = None
+_checked = 0.0
+
+
+def design_features(design):
+    """Fixed-length feature vector of a design dict, in FEATURES order"""
+    from tokamak.pipeline import DEFAULT_ADVANCED_SETTINGS
+
+    settings = {**DEFAULT_ADVANCED_SETTINGS, **design.get("advanced_settings", {})}
+    vv = np.asarray(design["vacuum_vessel"]["boundary_coordinates"], dtype=np.float64)
+    r, z = vv[:, 0], vv[:, 1]
+    area = 0.5*abs(np.dot(r, np.roll(z, -1)) - np.dot(z, np.roll(r, -1)))
+    coils = np.zeros((NCOILS, 2))
+    coil_coords = np.asarray(design["coil_coordinates"], dtype=np.float64)[:NCOILS]
+    coils[:len(coil_coords)] = coil_coords
+    return np.concatenate([
+        [design["plasma_parameters"][name] for name in PLASMA_FEATURES],
+        [settings[name] for name in SETTING_FEATURES],
+        [r.min(), r.max(), z.min(), z.max(), area],
+        coils.ravel(),
+    ]).astype(np.float64)
+
+
+def run_targets(results):
+    """Target values from run_summary.json "results" (NaN where missing)"""
+    coil_currents = results.get("coil_currents") or {}
+    return np.array([
+        results.get("growth_rate", np.nan),
+        results.get("feedback_capability_param", np.nan),
+        max((abs(v) for v in coil_currents.values()), default=np.nan),
+        (results.get("equilibrium") or {}).get("q_95", np.nan),
+    ], dtype=np.float64)
+
+
+def sweep_targets(row):
+    """Target values from a tokamak.sweep row"""
+    coil_currents = [abs(v) for k, v in row.items() if SWEEP_COIL_CURRENT.fullmatch(k)]
+    return np.array([
+        row.get("growth_rate", np.nan),
+        row.get("feedback_capability_param", np.nan),
+        max(coil_currents, default=np.nan),
+        row.get("eq_q_95", np.nan),
+    ], dtype=np.float64)
+
+
+def collect_samples(run_index=None, sweep_dirs=()):
+    """Design features X and targets Y from the run index and sweep.jsonl files"""
+    from tokamak.sweep import ROWS_FILENAME
+
+    X, Y = [], []
+    if run_index is not None:
+        for entry in run_index.query():
+            X.append(design_features(entry["design"]))
+            Y.append(run_targets(entry["results"]))
+    for sweep_dir in sweep_dirs:
+        path = os.path.join(sweep_dir, ROWS_FILENAME)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                row = json.loads(line)
+                if row.get("status") == "ok" and "design" in row:
+                    X.append(design_features(row["design"]))
+                    Y.append(sweep_targets(row))
+    if not X:
+        return np.zeros((0, len(FEATURES))), np.zeros((0, len(TARGETS)))
+    return np.array(X), np.array(Y)
+
+
+class GaussianProcess:
+    """Zero-mean GP regressor with a squared-exponential kernel on standardized targets"""
+
+    def __init__(self, length_scale=None, noise=None):
+        self.length_scale = length_scale
+        self.noise = noise
+
+    @staticmethod
+    def _sqdist(A, B):
+        return np.maximum((A*A).sum(1)[:, None] + (B*B).sum(1)[None, :] - 2.0*A @ B.T, 0.0)
+
+    def _factor(self, d2, y, length_scale, noise):
+        # scipy.linalg is imported on first use, it is most of this module's import time
+        from scipy.linalg import cho_solve
+
+        K = np.exp(-0.5*d2/length_scale**2) + noise*np.eye(len(y))
+        L = np.linalg.cholesky(K)
+        alpha = cho_solve((L, True), y)
+        log_likelihood = -0.5*y @ alpha - np.log(np.diag(L)).sum()
+        return L, alpha, log_likelihood
+
+    def fit(self, X, y):
+        """Fit to normalized inputs X and targets y, searching hyperparameters unless they are set"""
+        self.X = X
+        self.y_mean = y.mean()
+        self.y_std = y.std() if y.std() > 0 else 1.0
+        ys = (y - self.y_mean)/self.y_std
+        d2 = self._sqdist(X, X)
+        if self.length_scale is None or self.noise is None:
+            # Scale the length grid with the number of features that vary
+            active = max(int((X.max(0) > X.min(0)).sum()), 1) if len(X) else 1
+            best = None
+            for length_scale in np.array(LENGTH_SCALES)*np.sqrt(active):
+                for noise in NOISE_LEVELS:
+                    try:
+                        _, _, log_likelihood = self._factor(d2, ys, length_scale, noise)
+                    except np.linalg.LinAlgError:
+                        continue
+                    if best is None or log_likelihood > best[0]:
+                        best = (log_likelihood, length_scale, noise)
+            if best is None:
+                raise np.linalg.LinAlgError(f"No kernel in the hyperparameter grid is positive definite on "
+                                            f"these {len(y)} samples")
+            _, self.length_scale, self.noise = best
+        for _ in range(NOISE_RETRIES + 1):
+            try:
+                self.L, self.alpha, self.log_likelihood = self._factor(d2, ys, self.length_scale, self.noise)
+                return self
+            except np.linalg.LinAlgError:
+                # Reused hyperparameters can be too tight for newly added near-duplicate designs
+                self.noise *= 100.0
+        raise np.linalg.LinAlgError(f"Kernel with length scale {self.length_scale:g} is not positive definite "
+                                    f"even with noise {self.noise/100.0:g}")
+
+    def predict(self, x):
+        """Mean and standard deviation at one normalized input x"""
+        from scipy.linalg import solve_triangular
+
+        k = np.exp(-0.5*self._sqdist(x[None, :], self.X)[0]/self.length_scale**2)
+        mean = k @ self.alpha
+        v = solve_triangular(self.L, k, lower=True)
+        var = max(1.0 + self.noise - v @ v, 0.0)
+        return self.y_mean + self.y_std*mean, self.y_std*np.sqrt(var)
+
+
+class Surrogate:
+    """One GaussianProcess per target, fitted on a shared feature normalization"""
+
+    def __init__(self, X, Y, fingerprint=None, sweep_dirs=(), hyperparameters=None, searched_at=None):
+        self.X = X
+        self.Y = Y
+        self.fingerprint = fingerprint
+        self.sweep_dirs = list(sweep_dirs)
+        self.trained = time.time()
+        self.lo = X.min(0) if len(X) else np.zeros(len(FEATURES))
+        span = X.max(0) - self.lo if len(X) else np.ones(len(FEATURES))
+        self.span = np.where(span > 0, span, 1.0)
+        hyperparameters = hyperparameters or {}
+        # Reuse the previous hyperparameters until the data has grown enough to search again
+        research = searched_at is None or len(X) >= RESEARCH_GROWTH*searched_at
+        self.searched_at = len(X) if research else searched_at
+        self.models = {}
+        for j, target in enumerate(TARGETS):
+            rows = np.isfinite(Y[:, j])
+            if rows.sum() < MIN_SAMPLES:
+                continue
+            length_scale, noise = (None, None) if research else hyperparameters.get(target, (None, None))
+            self.models[target] = GaussianProcess(length_scale, noise).fit(self.normalize(X[rows]), Y[rows, j])
+
+    @property
+    def nsamples(self):
+        return len(self.X)
+
+    def normalize(self, X):
+        return (X - self.lo)/self.span
+
+    def predict(self, design):
+        """{target: (mean, std)} for a design dict, for every target with enough samples"""
+        x = self.normalize(design_features(design))
+        return {target: model.predict(x) for target, model in self.models.items()}
+
+    def hyperparameters(self):
+        return {target: (model.length_scale, model.noise) for target, model in self.models.items()}
+
+    def save(self, path=DEFAULT_MODEL_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {"fingerprint": self.fingerprint, "sweep_dirs": self.sweep_dirs, "trained": self.trained,
+                "hyperparameters": self.hyperparameters(), "searched_at": self.searched_at, "features": FEATURES}
+        # np.savez appends .npz to names without it, so write to a name that already has it
+        partial_path = path[:-len(".npz")] + ".partial.npz"
+        np.savez(partial_path, X=self.X, Y=self.Y, meta=json.dumps(meta))
+        os.replace(partial_path, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_MODEL_PATH):
+        """Saved surrogate, or None if there is none or it was saved with other features"""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            X, Y, meta = data["X"], data["Y"], json.loads(str(data["meta"]))
+        if tuple(meta.get("features", ())) != FEATURES:
+            return None
+        fingerprint = tuple(meta["fingerprint"]) if meta.get("fingerprint") is not None else None
+        surrogate = cls(X, Y, fingerprint, meta.get("sweep_dirs", ()),
+                        {k: tuple(v) for k, v in meta.get("hyperparameters", {}).items()}, meta.get("searched_at"))
+        surrogate.trained = meta.get("trained", surrogate.trained)
+        return surrogate
+
+
+def train(run_index=None, sweep_dirs=(), previous=None, path=DEFAULT_MODEL_PATH):
+    """Fit a Surrogate on everything in the run index and sweep_dirs and save it"""
+    X, Y = collect_samples(run_index, sweep_dirs)
+    fingerprint = run_index.fingerprint() if run_index is not None else None
+    hyperparameters, searched_at = (previous.hyperparameters(), previous.searched_at) if previous else (None, None)
+    surrogate = Surrogate(X, Y, fingerprint, sweep_dirs, hyperparameters, searched_at)
+    if path is not None:
+        surrogate.save(path)
+    return surrogate
+
+
+def get_surrogate(run_index=None, path=DEFAULT_MODEL_PATH):
+    """Process-wide surrogate, loaded from disk and refit when the run index has new runs
+
+    The index is checked at most every REFRESH_SECONDS, so calling this on
+    every rerun costs a time comparison. Returns None until there is a model
+    with at least one target.
+    """
+    global _surrogate, _checked
+    if _surrogate is None:
+        _surrogate = Surrogate.load(path)
+    now = time.time()
+    if run_index is not None and now - _checked > REFRESH_SECONDS:
+        _checked = now
+        if _surrogate is None or _surrogate.fingerprint != run_index.fingerprint():
+            previous = _surrogate
+            _surrogate = train(run_index, previous.sweep_dirs if previous else (), previous, path)
+    return _surrogate if _surrogate is not None and _surrogate.models else None
+
+
+def leave_one_out(X, Y):
+    """Mean absolute leave-one-out error and mean predicted std for each target"""
+    errors = {}
+    for j, target in enumerate(TARGETS):
+        rows = np.flatnonzero(np.isfinite(Y[:, j]))
+        if len(rows) <= MIN_SAMPLES:
+            continue
+        residuals, stds = [], []
+        for i in rows:
+            keep = rows[rows != i]
+            model_X = X[keep]
+            lo = model_X.min(0)
+            span = np.where(model_X.max(0) > lo, model_X.max(0) - lo, 1.0)
+            model = GaussianProcess().fit((model_X - lo)/span, Y[keep, j])
+            mean, std = model.predict((X[i] - lo)/span)
+            residuals.append(abs(mean - Y[i, j]))
+            stds.append(std)
+        errors[target] = (float(np.mean(residuals)), float(np.mean(stds)))
+    return errors
+
+
+def main(argv=None):
+    from tokamak.run_index import DEFAULT_INDEX_DIR, RunIndex
+
+    parser = argparse.ArgumentParser(description="Train the designer's surrogate models")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="Fit on the run index and sweep results and save the model")
+    train_parser.add_argument("--sweep", action="append", default=[], help="Sweep output folder (repeatable, globs allowed)")
+    train_parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="Run index folder")
+    train_parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Where to save the model")
+    train_parser.add_argument("--validate", action="store_true", help="Report leave-one-out errors")
+    args = parser.parse_args(argv)
+
+    sweep_dirs = sorted({os.path.abspath(d) for pattern in args.sweep for d in glob.glob(pattern)})
+    start = time.perf_counter()
+    surrogate = train(RunIndex(args.index_dir), sweep_dirs, path=args.model)
+    print(f"Trained on {surrogate.nsamples} samples in {time.perf_counter() - start:.2f} s: {sorted(surrogate.models)}")
+    if args.validate:
+        for target, (error, std) in leave_one_out(surrogate.X, surrogate.Y).items():
+            print(f"  {target:<26s} LOO mean |error| {error:10.4g}  mean predicted std {std:10.4g}")
+
+
+if __name__ == "__main__":
+    main()
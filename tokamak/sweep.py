@@ -0,0 +1,305 @@
+# Batch design sweeps: equilibrium and stability for many design variants
+#
+# A sweep spec is a JSON file naming a base design (a Lock Design JSON) and
+# the parameters to vary, as a full grid and/or a Latin hypercube:
+#
+#   {
+#     "base": "design_20250630_171055.json",
+#     "grid": {"major_radius": [4.4, 4.55, 4.7], "B0": [9.0, 11.0]},
+#     "lhs": {"samples": 50, "seed": 0,
+#             "ranges": {"triangularity": [-0.6, -0.3], "coil_coordinates.6.0": [2.7, 3.0]}}
+#   }
+#
+# Plasma parameter, advanced setting and mesh resolution names can be used as
+# they are; anything else is a dotted path into the design, with list indices
+# (coil_coordinates.6.0 is the R of PF_7). With both "grid" and "lhs" every
+# grid point is combined with every hypercube sample.
+#
+# Each design runs prepare_geometry through run_stability on a pool of
+# spawned workers, each with its own OFT_env reused across designs. Worker
+# and thread counts default to the machine's planned "sweep" layout (see
+# tokamak.layout). A design
+# that raises is recorded as failed; one that exceeds the timeout has its
+# worker killed and replaced. Rows are appended to sweep.jsonl as designs
+# finish, so a sweep that is interrupted keeps everything it finished. The
+# table (CSV or Parquet) is rewritten from them every TABLE_EVERY rows and
+# when the sweep ends; rows differ in their columns (a failed design has no
+# results), so it is not appended to row by row.
+#
+#   python -m tokamak.sweep sweep.json -o examples/sweep_1 --workers 4 --timeout 300
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+import traceback
+
+import numpy as np
+
+from tokamak import layout, oft
+
+ROWS_FILENAME = "sweep.jsonl"
+TABLE_FORMATS = ("csv", "parquet")
+DEFAULT_TIMEOUT = 300.0
+TABLE_EVERY = 25
+
+# Sections searched for a bare parameter name, in order
+PARAMETER_SECTIONS = ("plasma_parameters", "advanced_settings", "mesh_resolution")
+
+
+def parameter_path(design, name):
+    """Path of keys/indices into the design for a sweep parameter name"""
+    if "." in name:
+        return [int(part) if part.lstrip("-").isdigit() else part for part in name.split(".")]
+    for section in PARAMETER_SECTIONS:
+        if name in design.get(section, {}):
+            return [section, name]
+    raise KeyError(f"Unknown sweep parameter {name!r}; use a dotted path such as coil_coordinates.0.1")
+
+
+def set_parameter(design, name, value):
+    path = parameter_path(design, name)
+    target = design
+    for key in path[:-1]:
+        target = target[key]
+    target[path[-1]] = value
+
+
+def latin_hypercube(ranges, samples, seed=None):
+    """samples points stratified in every dimension of ranges ({name: [low, high]})"""
+    rng = np.random.default_rng(seed)
+    points = {}
+    for name, (low, high) in ranges.items():
+        strata = (rng.permutation(samples) + rng.random(samples))/samples
+        points[name] = low + strata*(high - low)
+    return [{name: float(values[i]) for name, values in points.items()} for i in range(samples)]
+
+
+def expand_spec(spec, base):
+    """List of (parameters, design) for every variant described by spec"""
+    from tokamak.pipeline import load_design
+
+    base = load_design(base)
+    grid = spec.get("grid", {})
+    grid_points = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    lhs = spec.get("lhs")
+    lhs_points = latin_hypercube(lhs["ranges"], lhs["samples"], lhs.get("seed")) if lhs else [{}]
+    variants = []
+    for grid_point, lhs_point in itertools.product(grid_points, lhs_points):
+        parameters = {**grid_point, **lhs_point}
+        design = json.loads(json.dumps(base))
+        for name, value in parameters.items():
+            set_parameter(design, name, value)
+        # Validation in the Lock Design output describes the base design, not this variant
+        design.pop("validation", None)
+        variants.append((parameters, design))
+    return variants
+
+
+def evaluate_design(design, output_dir, nthreads=1):
+    """Equilibrium and stability metrics of one design, as a flat dict"""
+    from tokamak import pipeline
+
+    start = time.perf_counter()
+    run = pipeline.AnalysisRun(design, output_dir, nthreads=nthreads, scan_workers=1)
+    pipeline.prepare_geometry(run)
+    pipeline.build_mesh(run)
+    pipeline.setup_tokamaker(run)
+    pipeline.solve_equilibrium(run)
+    pipeline.run_stability(run)
+
+    row = {
+        "err_flag": int(run.err_flag),
+        "converged": run.err_flag == 0,
+        "invalid_coils": len(run.invalid_coils),
+        "mesh_cached": run.mesh_cached,
+        "growth_rate": float(run.growth_rate),
+        "wall_time": float(run.wall_time),
+        "feedback_capability_param": float(run.feedback_capability_param),
+    }
+    row.update({f"eq_{k}": float(v) for k, v in run.eq_stats.items() if np.isscalar(v)})
+    row.update({f"coil_{k}": float(v) for k, v in run.coil_currents.items()})
+    row.update({f"time_{stage}": seconds for stage, seconds in run.timings.items()})
+    row["elapsed"] = time.perf_counter() - start
+    return row
+
+
+def _worker_main(conn, output_dir, nthreads):
+    """Evaluate designs sent over conn until it is closed"""
+    oft.ensure_oft_path()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        index, design = task
+        start = time.perf_counter()
+        try:
+            row = {"status": "ok", **evaluate_design(design, output_dir, nthreads)}
+        except Exception as e:
+            row = {"status": "failed", "elapsed": time.perf_counter() - start, "error": str(e),
+                   "traceback": traceback.format_exc()}
+        conn.send((index, row))
+
+
+class _Worker:
+    """One spawned evaluation process and the design it is working on"""
+
+    def __init__(self, context, output_dir, nthreads):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, output_dir, nthreads), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+    def send(self, index, design):
+        self.task = index
+        self.started = time.perf_counter()
+        self.conn.send((index, design))
+
+    def stop(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout=5)
+
+
+def run_sweep(variants, output_dir, workers=None, nthreads=None, timeout=DEFAULT_TIMEOUT,
+              table_format="csv", progress=print):
+    """Evaluate every (parameters, design) on workers processes, returning the table as a DataFrame
+
+    Rows are written to output_dir/sweep.jsonl as they finish and the table
+    to output_dir/sweep.<table_format> every TABLE_EVERY rows and at the
+    end. workers and nthreads left as None come from the planned sweep
+    layout.
+    """
+    import pandas as pd
+
+    planned = layout.plan("sweep")
+    workers = planned["workers"] if workers is None else workers
+    nthreads = planned["nthreads"] if nthreads is None else nthreads
+
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f"table_format must be one of {TABLE_FORMATS}, got {table_format!r}")
+    if table_format == "parquet":
+        # Fail before the sweep rather than after it
+        pd.io.parquet.get_engine("auto")
+    os.makedirs(output_dir, exist_ok=True)
+    rows_path = os.path.join(output_dir, ROWS_FILENAME)
+    table_path = os.path.join(output_dir, f"sweep.{table_format}")
+    if os.path.exists(rows_path):
+        os.remove(rows_path)
+
+    rows = []
+
+    def write_table():
+        # Tracebacks and designs stay in sweep.jsonl, the table keeps the one-line error
+        table = pd.DataFrame(rows).drop(columns=["traceback"], errors="ignore").sort_values("design_id")
+        if table_format == "csv":
+            table.to_csv(table_path, index=False)
+        else:
+            table.to_parquet(table_path, index=False)
+
+    def record(index, row):
+        parameters, design = variants[index]
+        row = {"design_id": index, **parameters, **row}
+        rows.append(row)
+        # The full design goes with the row so sweeps can train tokamak.surrogate
+        with open(rows_path, "a") as f:
+            f.write(json.dumps({**row, "design": design}) + "\n")
+        if len(rows) % TABLE_EVERY == 0:
+            write_table()
+        progress(f"[{len(rows)}/{len(variants)}] design {index} {row['status']}"
+                 + (f" in {row['elapsed']:.1f} s" if "elapsed" in row else f": {row.get('error', '')}"))
+
+    context = multiprocessing.get_context("spawn")
+    queue = list(range(len(variants)))
+    pool = [_Worker(context, output_dir, nthreads) for _ in range(min(workers, len(variants)))]
+    try:
+        while queue or any(worker.task is not None for worker in pool):
+            for worker in pool:
+                if worker.task is None and queue:
+                    index = queue.pop(0)
+                    worker.send(index, variants[index][1])
+
+            busy = [worker for worker in pool if worker.task is not None]
+            now = time.perf_counter()
+            wait = max(0.0, min(worker.started + timeout - now for worker in busy))
+            ready = multiprocessing.connection.wait([worker.conn for worker in busy] +
+                                                    [worker.process.sentinel for worker in busy], timeout=wait)
+            for i, worker in enumerate(pool):
+                if worker.task is None:
+                    continue
+                crashed = not worker.process.is_alive()
+                if worker.conn in ready:
+                    try:
+                        index, row = worker.conn.recv()
+                        worker.task = None
+                        record(index, row)
+                        continue
+                    except EOFError:
+                        crashed = True
+                elapsed = time.perf_counter() - worker.started
+                if not crashed and elapsed < timeout:
+                    continue
+                # Timed out, or the worker died (e.g. a crash inside OFT): replace it
+                status = "crashed" if crashed else "timeout"
+                index = worker.task
+                worker.stop()
+                record(index, {"status": status, "elapsed": elapsed,
+                               "error": f"worker exit code {worker.process.exitcode}" if status == "crashed" else None})
+                pool[i] = _Worker(context, output_dir, nthreads)
+    finally:
+        for worker in pool:
+            worker.stop()
+        if rows:
+            write_table()
+    return pd.DataFrame(rows).sort_values("design_id") if rows else pd.DataFrame()
+
+
+def load_spec(path):
+    """Sweep spec from JSON, with the base design path resolved relative to the spec"""
+    with open(path) as f:
+        spec = json.load(f)
+    if "base" in spec and not os.path.isabs(spec["base"]):
+        spec["base"] = os.path.join(os.path.dirname(os.path.abspath(path)), spec["base"])
+    return spec
+
+
+def main(argv=None):
+    from tokamak.pipeline import latest_design_file
+
+    parser = argparse.ArgumentParser(description="Run equilibrium and stability for a grid or Latin hypercube of designs")
+    parser.add_argument("spec", help="Sweep spec JSON (see tokamak/sweep.py)")
+    parser.add_argument("-o", "--output", required=True, help="Folder for sweep.jsonl and the results table")
+    parser.add_argument("--design", help="Base design JSON or folder, overriding the spec's 'base'")
+    parser.add_argument("--workers", type=int, help="Designs evaluated at once (default: the planned layout)")
+    parser.add_argument("--nthreads", type=int, help="OFT threads per worker (default: the planned layout)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Seconds allowed per design")
+    parser.add_argument("--format", choices=TABLE_FORMATS, default="csv", help="Results table format")
+    args = parser.parse_args(argv)
+
+    spec = load_spec(args.spec)
+    base = args.design or spec.get("base")
+    if base is None:
+        parser.error("the spec has no 'base' design; pass --design")
+    if os.path.isdir(base):
+        base = latest_design_file(base)
+    variants = expand_spec(spec, base)
+    planned = layout.plan("sweep")
+    workers = args.workers or planned["workers"]
+    nthreads = args.nthreads or planned["nthreads"]
+    print(f"Sweeping {len(variants)} designs on {min(workers, len(variants))} workers x {nthreads} threads")
+    start = time.perf_counter()
+    table = run_sweep(variants, args.output, workers=workers, nthreads=nthreads, timeout=args.timeout,
+                      table_format=args.format)
+    counts = table["status"].value_counts().to_dict() if len(table) else {}
+    print(f"Finished in {time.perf_counter() - start:.1f} s: {counts}")
+
+
+if __name__ == "__main__":
+    main()